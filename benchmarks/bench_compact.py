@@ -0,0 +1,66 @@
+from easiest import cdo
+from easiest.platform_libs.ripe_atlas import ra_mro
+import subprocess
+import resource
+import sys
+import gc
+
+"""
+compares per object memory of the regular (__dict__ based) result / location classes against their __slots__ based
+Compact variants
+
+tracemalloc isn't available in python 2, so each case is built in a fresh interpreter and measured as the growth of
+its peak resident set size (ru_maxrss) while building num_objects objects from the same raw (RIPE Atlas style) record
+
+usage: python bench_compact.py [num_objects]
+"""
+
+ping = {"fw": 4790, "lts": 30, "dst_name": "8.8.8.8", "af": 4, "dst_addr": "8.8.8.8", "src_addr": "10.0.0.2",
+        "proto": "ICMP", "ttl": 57, "size": 48, "result": [{"rtt": 4.2}, {"rtt": 4.3}, {"rtt": 4.1}],
+        "prb_id": 6001, "msm_id": 1001, "timestamp": 1500000000, "msm_name": "Ping", "from": "1.2.3.4",
+        "type": "ping", "group_id": 1001, "step": None, "stored_timestamp": 1500000003, "min": 4.1, "max": 4.3,
+        "avg": 4.2, "dup": 0, "sent": 3, "rcvd": 3}
+dns = {"fw": 4790, "lts": 30, "from": "1.2.3.4", "msm_id": 1002, "prb_id": 6001, "timestamp": 1500000000,
+       "proto": "UDP", "af": 4, "dst_addr": "10.0.0.1", "src_addr": "10.0.0.2", "type": "dns", "group_id": 1002,
+       "msm_name": "Tdig", "stored_timestamp": 1500000003,
+       "result": {"rt": 3.2, "size": 45, "ID": 1, "ANCOUNT": 1, "ARCOUNT": 0, "NSCOUNT": 0, "QDCOUNT": 1,
+                  "abuf": "AAGBAAABAAEAAAAAB2V4YW1wbGUDY29tAAABAAHADAABAAEAAAEsAAQBAgMB"}}
+probe = {"id": 6001, "probe_id": 6001, "address_v4": "10.0.0.2", "ipv4": "10.0.0.2", "asn_v4": 3333,
+         "prefix_v4": "10.0.0.0/8", "country_code": "NL", "is_anchor": False, "is_public": True,
+         "status_since": 1500000000, "first_connected": 1400000000, "last_connected": 1500000000,
+         "total_uptime": 100000000, "type": "Probe", "description": "probe",
+         "status": {"id": 1, "name": "Connected", "since": "2017-07-14T02:40:00Z"}, "tags": list(),
+         "geometry": {"type": "Point", "coordinates": [4.9, 52.3]}}
+
+cases = [
+    ('PingResult', lambda: ra_mro.PingResult(platform='ripe_atlas', **ping)),
+    ('CompactPingResult', lambda: ra_mro.CompactPingResult(platform='ripe_atlas', **ping)),
+    ('DNSResult', lambda: ra_mro.DNSResult(platform='ripe_atlas', **dns)),
+    ('CompactDNSResult', lambda: ra_mro.CompactDNSResult(platform='ripe_atlas', **dns)),
+    ('Location', lambda: cdo.Location(**probe)),
+    ('CompactLocation', lambda: cdo.CompactLocation(**probe)),
+]
+
+
+def measure(name, num_objects):
+    """
+    :return: (float) bytes of peak RSS growth per object
+    """
+    make = dict(cases)[name]
+    make()
+    gc.disable()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    objects = [make() for _ in xrange(num_objects)]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on linux
+    return (after - before) * 1024.0 / len(objects)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'measure':
+        print(measure(sys.argv[2], int(sys.argv[3])))
+        sys.exit(0)
+    num_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    for name, _ in cases:
+        out = subprocess.check_output([sys.executable, __file__, 'measure', name, str(num_objects)])
+        print(name.ljust(20)+str(int(float(out)))+" bytes / object")
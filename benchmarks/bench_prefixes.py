@@ -0,0 +1,58 @@
+from easiest import prefixes
+import numpy as np
+import socket
+import struct
+import tempfile
+import time
+import os
+
+"""
+loader and lookup benchmarks for prefixes.PrefixIndex, using a synthetic pfx2as file sized like a
+full routing table
+"""
+
+num_prefixes = 800000
+num_lookups = 2000000
+rng = np.random.RandomState(0)
+
+
+def int_to_ip(val):
+    return socket.inet_ntoa(struct.pack('!I', val))
+
+
+# build a synthetic CAIDA style pfx2as file
+masklens = rng.randint(8, 25, size=num_prefixes)
+addrs = rng.randint(0, 2**32, size=num_prefixes, dtype=np.int64)
+addrs &= ~((1 << (32 - masklens)) - 1)
+fd, path = tempfile.mkstemp(suffix='.pfx2as')
+with os.fdopen(fd, 'w') as f:
+    for addr, masklen, asn in zip(addrs, masklens, rng.randint(1, 400000, size=num_prefixes)):
+        f.write(int_to_ip(int(addr))+'\t'+str(masklen)+'\t'+str(asn)+'\n')
+
+start = time.time()
+index = prefixes.load_pfx2as(path)
+print("loaded "+str(len(index))+" prefixes in "+str(round(time.time() - start, 2))+"s")
+os.remove(path)
+
+# vectorized lookup over integer addresses
+ints = rng.randint(0, 2**32, size=num_lookups, dtype=np.int64)
+start = time.time()
+inds = index.lookup_ints(ints)
+elapsed = time.time() - start
+print("lookup_ints: "+str(num_lookups)+" addresses in "+str(round(elapsed, 3))+"s ("
+      + str(round(elapsed / num_lookups * 1e6, 3))+" us/lookup)")
+
+# per-address lookups from strings (what Location.asn_v4 does)
+ips = [int_to_ip(int(z)) for z in ints[:200000]]
+start = time.time()
+for ip in ips:
+    index.lookup(ip)
+elapsed = time.time() - start
+print("lookup: "+str(len(ips))+" addresses in "+str(round(elapsed, 3))+"s ("
+      + str(round(elapsed / len(ips) * 1e6, 3))+" us/lookup)")
+
+start = time.time()
+index.lookup_many(ips)
+elapsed = time.time() - start
+print("lookup_many: "+str(len(ips))+" addresses in "+str(round(elapsed, 3))+"s ("
+      + str(round(elapsed / len(ips) * 1e6, 3))+" us/lookup)")
@@ -0,0 +1,66 @@
+from easiest import cdo
+import random
+import time
+
+"""
+compares the compiled TargetLocation.filter path against the previous per-client, reflective __contains__ check
+"""
+
+num_clients = 30000
+random.seed(0)
+countries = ['US', 'DE', 'FR', 'JP', 'BR', 'IN', 'AU', 'ZA', 'KE', 'IT']
+
+
+def reflective_contains(target, location):
+    # the pre-compilation TargetLocation.__contains__ loop, kept here for comparison
+    for constraint in vars(target):
+        if constraint.startswith('_'):
+            continue
+        if hasattr(target, constraint+"_contains"):
+            try:
+                if not getattr(target, constraint+"_contains")(location):
+                    return False
+            except KeyError:
+                return False
+        elif hasattr(location, constraint):
+            if isinstance(getattr(target, constraint), type(getattr(location, constraint))):
+                if getattr(location, constraint) != getattr(target, constraint):
+                    return False
+            elif hasattr(getattr(target, constraint), '__contains__'):
+                if getattr(location, constraint) not in getattr(target, constraint):
+                    return False
+            else:
+                return False
+        else:
+            return False
+    return True
+
+
+clients = list()
+for i in range(num_clients):
+    loc = cdo.Location(probe_id=i, country_code=random.choice(countries), status_name=random.choice(['Connected',
+                       'Disconnected']), coordinates=(random.uniform(20, 70), random.uniform(-30, 50)))
+    clients.append(cdo.Client('ripe_atlas', loc))
+cg = cdo.ClientGroup(clients)
+
+tl = cdo.TargetLocation(status_name='Connected')
+tl.set_countries(['US', 'DE', 'FR'])
+tl.set_coordinate_circle((45.0, 0.0), 3000.0)
+
+start = time.time()
+reflective = [c for c in cg if reflective_contains(tl, c.location)]
+reflective_time = time.time() - start
+
+start = time.time()
+contained = [c for c in cg if c in tl]
+contains_time = time.time() - start
+
+start = time.time()
+filtered = tl.filter(cg)
+filter_time = time.time() - start
+
+assert [c.probe_id for c in reflective] == [c.probe_id for c in filtered] == [c.probe_id for c in contained]
+print(str(len(filtered.clients))+" of "+str(num_clients)+" clients matched")
+print("reflective __contains__: "+str(round(reflective_time, 3))+"s")
+print("compiled __contains__:   "+str(round(contains_time, 3))+"s")
+print("compiled filter:         "+str(round(filter_time, 3))+"s")
@@ -1,16 +1,58 @@
 from IPy import IP
 from geopy.distance import vincenty
-from geopy.geocoders import Nominatim
-from helpers import Extendable
+from helpers import Extendable, Compact
 from helpers import asn_lookup
+from helpers import logger, TokenBucket
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 import random
 import platform_libs
-from numpy import ceil
-
-
-class Location(Extendable):
-    """base class for a client's location"""
+from geocoding import NetworkGeocoder, haversine, HAVERSINE_ERROR
+from prefixes import ip_to_int, PrefixIndex
+import numpy as np
+
+
+network_geocoder = NetworkGeocoder()
+
+
+def reverse_geocode_country(coordinates, throttle=None, geocoder=None):
+    """
+    :param coordinates: (tuple(float, float)) (lat, long)
+    :param throttle: (helpers.TokenBucket) optional rate limit, applied only if the network geocoder is used
+    :param geocoder: optional offline geocoder to try first (see BaseLocation.geocoder)
+    :return: (str) capitalized, 2 char country code at coordinates, or None if it couldn't be determined
+    """
+    if geocoder is not None:
+        country = geocoder.reverse(coordinates)
+        if country is not None:
+            return country
+    if throttle is not None:
+        throttle.consume()
+    return network_geocoder.reverse(coordinates)
+
+
+def geocode_coordinates(country_code, throttle=None, geocoder=None):
+    """
+    :param country_code: (str) 2 char country code
+    :param throttle: (helpers.TokenBucket) optional rate limit, applied only if the network geocoder is used
+    :param geocoder: optional offline geocoder to try first (see BaseLocation.geocoder)
+    :return: (tuple(float, float)) (lat, long) for the country
+    """
+    if geocoder is not None:
+        coordinates = geocoder.geocode(country_code)
+        if coordinates is not None:
+            return coordinates
+    if throttle is not None:
+        throttle.consume()
+    return network_geocoder.geocode(country_code)
+
+
+class BaseLocation(Extendable):
+    """
+    behavior shared by Location and CompactLocation; the settings below apply to both when set on BaseLocation, or
+    to just one of them when set on that class
+    """
+    __slots__ = ()
 
     # use geocoding to determine (as needed) a missing country attribute using other attributes (e.g. coordinates)
     infer_country_code = True
@@ -18,16 +60,12 @@ class Location(Extendable):
     infer_coordinates = False
     # use lookup to determine (as needed) a missing ASN attribute using other attributes (e.g. IPv4)
     infer_asn = True
-
-    def __init__(self, **kwargs):
-        self.inferences = list()
-        for k in kwargs:
-            # self.set(k, kwargs[k])
-            try:
-                setattr(self, k, kwargs[k])
-            except Exception as e:
-                print k
-                raise e
+    # optional offline prefix -> ASN table (e.g. prefixes.load_pfx2as(...)); when set, ASN inference uses it
+    # instead of live whois lookups
+    asn_resolver = None
+    # optional offline geocoder (e.g. geocoding.OfflineGeocoder()); when set, country / coordinates inference
+    # tries it first and only falls back to (cached) network geocoding when it has no answer
+    geocoder = None
 
     @property
     def ipv4(self):
@@ -57,19 +95,37 @@ class Location(Extendable):
     def get_ipv6_subnet(self, masklen):
         return IP(str(self.ipv6) + '/' + str(masklen))
 
+    @classmethod
+    def lookup_asn(cls, ip, throttle=None):
+        if cls.asn_resolver is not None:
+            return cls.asn_resolver.lookup(ip)
+        if throttle is not None:
+            throttle.consume()
+        return asn_lookup(str(ip))
+
+    @classmethod
+    def reverse_geocode(cls, coordinates, throttle=None):
+        return reverse_geocode_country(coordinates, throttle, cls.geocoder)
+
+    @classmethod
+    def geocode(cls, country_code, throttle=None):
+        return geocode_coordinates(country_code, throttle, cls.geocoder)
+
+    def record_inference(self, member, val):
+        setattr(self, '_'+member, val)
+        if self.inferences is None:
+            self.inferences = list()
+        self.inferences.append((member, val))
+
     @property
     def country_code(self):
         if hasattr(self, '_country_code'):
             return self._country_code
         elif self.infer_country_code:
             if hasattr(self, '_coordinates'):
-                geolocator = Nominatim()
-                loc = geolocator.reverse(self.coordinates)
-                country = loc.raw['address']['country_code']
-                if type(country) is str and len(country) == 2:
-                    country = country.upper()
-                    self._country_code = country
-                    self.inferences.append(('country_code', country))
+                country = self.reverse_geocode(self.coordinates)
+                if country is not None:
+                    self.record_inference('country_code', country)
                     return country
             # throw an error if we don't have any way to get the country
             return None
@@ -94,11 +150,8 @@ class Location(Extendable):
             return self._coordinates
         elif self.infer_coordinates:
             if hasattr(self, '_country_code'):
-                geolocator = Nominatim()
-                loc = geolocator.geocode(self.country_code)
-                coordinates = (loc.latitude, loc.longitude)
-                self._coordinates = coordinates
-                self.inferences.append(('coordinates', coordinates))
+                coordinates = self.geocode(self.country_code)
+                self.record_inference('coordinates', coordinates)
                 return coordinates
             # throw an error if we don't have any way to get the coordinates
             return None
@@ -115,9 +168,8 @@ class Location(Extendable):
             return self._asn_v4
         elif self.infer_asn:
             if self.ipv4 is not None:
-                asn = asn_lookup(str(self.ipv4))
-                self._asn_v4 = asn
-                self.inferences.append(('asn_v4', asn))
+                asn = self.lookup_asn(self.ipv4)
+                self.record_inference('asn_v4', asn)
                 return asn
             # throw an error if we don't have any way to get the ASN
             return None
@@ -135,9 +187,8 @@ class Location(Extendable):
             return self._asn_v6
         elif self.infer_asn:
             if self.ipv6 is not None:
-                asn = asn_lookup(str(self.ipv6))
-                self._asn_v6 = asn
-                self.inferences.append(('asn_v6', asn))
+                asn = self.lookup_asn(self.ipv6)
+                self.record_inference('asn_v6', asn)
                 return asn
             # throw an error if we don't have any way to get the ASN
             raise KeyError("member 'asn' has not been defined for this location")
@@ -150,6 +201,34 @@ class Location(Extendable):
         self._asn_v6 = val
 
 
+class Location(BaseLocation):
+    """base class for a client's location"""
+    def __init__(self, **kwargs):
+        self.inferences = list()
+        for k in kwargs:
+            # self.set(k, kwargs[k])
+            try:
+                setattr(self, k, kwargs[k])
+            except Exception as e:
+                print k
+                raise e
+
+
+class CompactLocation(Compact, BaseLocation):
+    """
+    Location without a per instance __dict__ (see helpers.Compact), for holding very many (e.g. RIPE Atlas probe)
+    locations; probe fields it doesn't have a slot for are kept in its overflow dict
+    """
+    __slots__ = ('_ipv4', '_ipv6', '_country_code', '_coordinates', '_asn_v4', '_asn_v6', 'inferences', 'probe_id',
+                 'id', 'address_v4', 'address_v6', 'prefix_v4', 'prefix_v6', 'is_anchor', 'is_public', 'status',
+                 'status_name', 'status_since', 'first_connected', 'last_connected', 'total_uptime', 'tags', 'type',
+                 'geometry', 'description')
+
+    def __init__(self, **kwargs):
+        for k in kwargs:
+            self.set(k, kwargs[k])
+
+
 class Client(Extendable):
     """base class for a client that will perform measurements"""
     def __init__(self, platform, location, **kwargs):
@@ -191,13 +270,168 @@ class Client(Extendable):
             return self.location.get(member)  # added this to avoid abstraction confusion
 
 
-class TargetLocation(Extendable):
+def attribute_predicate(name, target):
+    """
+    :return: (func) predicate checking that an object's member name equals target (if target is of the same type)
+    or is contained in target
+    """
+    def predicate(obj):
+        if not hasattr(obj, name):
+            return False
+        val = getattr(obj, name)
+        if isinstance(target, type(val)):
+            return val == target
+        elif hasattr(target, '__contains__'):
+            return val in target
+        return False
+    return predicate
+
+
+def attribute_filter(name, target, predicate, subject):
+    """
+    :return: (func) bulk version of predicate (see attribute_predicate), which uses the group's vectorized match()
+    when it has one for member name
+    """
+    def bulk(group):
+        mask = group.match(name, target)
+        if mask is None:
+            mask = [predicate(subject(z)) for z in group]
+        return group.select(mask)
+    return bulk
+
+
+def subnet_index(subnets, version):
+    """
+    :param subnets: (str, IPy.IP or iter) prefix, or any number of prefixes
+    :param version: (int) IP version (4 or 6) every prefix must have
+    :return: (IP or list(IP), PrefixIndex) the normalized prefix(es), and an interval index over them
+    """
+    single = isinstance(subnets, (str, type(u''), IP))
+    nets = [IP(z, make_net=True) for z in ([subnets] if single else subnets)]
+    for net in nets:
+        if net.version() != version:
+            raise ValueError("expected IPv"+str(version)+" prefix, got "+str(net))
+    index = PrefixIndex([(z, True) for z in nets])
+    index.build()
+    return (nets[0] if single else nets), index
+
+
+def guarded_predicate(func):
+    """wraps func so that a KeyError (i.e. a missing value) fails the check instead of propagating"""
+    def predicate(obj):
+        try:
+            return func(obj)
+        except KeyError:
+            return False
+    return predicate
+
+
+class Constraints(Extendable):
+    """
+    base class for sets of client selection constraints; every public member is a constraint, checked either by a
+    matching <member>_contains method or by comparing it against the same member of the object being checked
+
+    constraints are compiled into an ordered list of predicates (cheapest first) the first time they're needed, and
+    recompiled whenever a member is set
+
+    NOTE: compiled predicates bind the constraint values they compare against; call compile() after modifying a
+    constraint in place (e.g. appending to a list) rather than setting it
+    """
+    # relative cost of checking each constraint (lower is checked first); unlisted constraints cost 0
+    constraint_costs = dict()
+    # members that are not constraints
+    non_constraints = ()
+
+    def __setattr__(self, name, val):
+        object.__setattr__(self, name, val)
+        if name != '_predicates':
+            object.__setattr__(self, '_predicates', None)
+
+    def subject(self, client):
+        """
+        :return: the object predicates should be applied to for client
+        """
+        return client
+
+    def constraint_names(self):
+        names = list()
+        for member in vars(self):
+            if member == '_predicates':
+                continue
+            elif member.startswith('_'):
+                # property backed constraints (e.g. ipv4_subnet) are stored as _<name>
+                if isinstance(getattr(type(self), member[1:], None), property):
+                    names.append(member[1:])
+            elif member not in self.non_constraints:
+                names.append(member)
+        return names
+
+    def compile(self):
+        """
+        :return: (list) (constraint name, predicate, bulk filter or None) for each constraint, in the order they
+        should be checked
+        """
+        predicates = list()
+        for name in self.constraint_names():
+            if hasattr(self, name+"_contains"):
+                func = guarded_predicate(getattr(self, name+"_contains"))
+                bulk = getattr(self, name+"_filter", None)
+            else:
+                func = attribute_predicate(name, getattr(self, name))
+                bulk = attribute_filter(name, getattr(self, name), func, self.subject)
+            predicates.append((self.constraint_costs.get(name, 0), name, func, bulk))
+        predicates.sort(key=lambda z: z[0])
+        self._predicates = [z[1:] for z in predicates]
+        return self._predicates
+
+    @property
+    def predicates(self):
+        if getattr(self, '_predicates', None) is None:
+            self.compile()
+        return self._predicates
+
+    def check(self, obj):
+        for name, func, bulk in self.predicates:
+            if not func(obj):
+                return False
+        return True
+
+    def filter(self, clients):
+        """
+        :param clients: (ClientGroup or list(Client))
+        :return: (ClientGroup) the clients that meet every constraint (same group type as clients, if clients is a
+        ClientGroup); each constraint is applied to the whole (remaining) group at once, using its bulk
+        <member>_filter method when it has one
+        """
+        group = clients if isinstance(clients, ClientGroup) else ClientGroup(list(clients))
+        for name, func, bulk in self.predicates:
+            if len(group) == 0:
+                break
+            if bulk is not None:
+                group = bulk(group)
+            else:
+                group = group.select([func(self.subject(z)) for z in group])
+        return group
+
+
+class TargetLocation(Constraints):
     """class for describing the set of required location constraints for client selection"""
 
+    # geocoding / whois backed and geometric checks go last
+    constraint_costs = {
+        'countries': 1,
+        'ipv4_subnet': 2,
+        'ipv6_subnet': 2,
+        'v4_asns': 3,
+        'v6_asns': 3,
+        'coordinate_circle': 4,
+    }
+
     def __init__(self, **kwargs):
         """
 
-        :param kwargs: coordinate_circle, countries, ipv[4/6]_subnet, v[4/6]_asns
+        :param kwargs: coordinate_circle, countries, ipv[4/6]_subnet, v[4/6]_asns; ipv[4/6]_subnet may be a single
+        prefix or a list of (any number of) prefixes
         """
         for k in kwargs:
             setattr(self, k, kwargs[k])
@@ -223,22 +457,38 @@ class TargetLocation(Extendable):
         return self._ipv4_subnet
 
     @ipv4_subnet.setter
-    def ipv4_subnet(self, subnet):
-        self._ipv4_subnet = IP(subnet, make_net=True)
+    def ipv4_subnet(self, subnets):
+        self._ipv4_subnet, self._ipv4_index = subnet_index(subnets, 4)
 
     @property
     def ipv6_subnet(self):
         return self._ipv6_subnet
 
     @ipv6_subnet.setter
-    def ipv6_subnet(self, subnet):
-        self._ipv6_subnet = IP(subnet, make_net=True)
+    def ipv6_subnet(self, subnets):
+        self._ipv6_subnet, self._ipv6_index = subnet_index(subnets, 6)
 
     def ipv4_subnet_contains(self, location):
-        return IP(location.ipv4) in self.ipv4_subnet
+        return location.ipv4 is not None and location.ipv4 in self._ipv4_index
+
+    def ipv4_subnet_filter(self, clients):
+        """
+        bulk version of ipv4_subnet_contains: the group's addresses are matched against every prefix in one
+        vectorized pass
+        :param clients: (ClientGroup or list(Client))
+        :return: (ClientGroup) the clients whose IPv4 address falls inside ipv4_subnet
+        """
+        if not isinstance(clients, ClientGroup):
+            clients = ClientGroup(list(clients))
+        return clients.select(self._ipv4_index.lookup_ints(clients.ipv4_ints()) >= 0)
 
     def ipv6_subnet_contains(self, location):
-        return IP(location.ipv6) in self.ipv6_subnet
+        return location.ipv6 is not None and location.ipv6 in self._ipv6_index
+
+    def ipv6_subnet_filter(self, clients):
+        if not isinstance(clients, ClientGroup):
+            clients = ClientGroup(list(clients))
+        return clients.select([z is not None for z in self._ipv6_index.lookup_many(clients.values('ipv6'))])
 
     def coordinate_circle_contains(self, location):
         coordinates = self.coordinate_circle['coordinates']
@@ -246,124 +496,305 @@ class TargetLocation(Extendable):
         if location.coordinates is not None:
             return vincenty(location.coordinates, coordinates).kilometers <= radius
 
+    def coordinate_circle_filter(self, clients):
+        """
+        bulk version of coordinate_circle_contains: distances for the whole group are computed at once with
+        haversine, and only clients close enough to the edge of the circle for the approximation to matter are
+        checked with vincenty
+        :param clients: (ClientGroup or list(Client))
+        :return: (ClientGroup) the clients whose coordinates fall inside coordinate_circle
+        """
+        if not isinstance(clients, ClientGroup):
+            clients = ClientGroup(list(clients))
+        center = self.coordinate_circle['coordinates']
+        radius = self.coordinate_circle['radius']
+        coords = clients.coordinate_array()
+        if len(coords) == 0:
+            return clients.select([])
+        # missing coordinates are nan, which fails every comparison below
+        with np.errstate(invalid='ignore'):
+            dists = haversine(coords[:, 0], coords[:, 1], center[0], center[1])
+            margin = radius * HAVERSINE_ERROR + 1e-3
+            inside = dists <= radius - margin
+            borderline = np.abs(dists - radius) < margin
+        for i in np.nonzero(borderline)[0]:
+            try:
+                inside[i] = vincenty(tuple(coords[i]), center).kilometers <= radius
+            except ValueError:
+                # vincenty doesn't converge for nearly antipodal points; keep the haversine answer
+                inside[i] = dists[i] <= radius
+        return clients.select(inside)
+
     def countries_contains(self, location):
-        return location.get_country_code() in self.countries
+        return location.country_code in self.countries
+
+    def countries_filter(self, clients):
+        return self.member_filter(clients, 'country_code', self.countries, self.countries_contains)
 
     def v4_asns_contains(self, location):
-        return location.get_v4_asn() in self.v4_asns
+        return location.asn_v4 in self.v4_asns
+
+    def v4_asns_filter(self, clients):
+        return self.member_filter(clients, 'asn_v4', self.v4_asns, self.v4_asns_contains)
 
     def v6_asns_contains(self, location):
-        return location.get_v6_asn() in self.v6_asns
+        return location.asn_v6 in self.v6_asns
+
+    def member_filter(self, clients, member, values, predicate):
+        if not isinstance(clients, ClientGroup):
+            clients = ClientGroup(list(clients))
+        mask = clients.match(member, values)
+        if mask is None:
+            mask = [guarded_predicate(predicate)(z.location) for z in clients]
+        return clients.select(mask)
+
+    def subject(self, client):
+        return client.location
 
     def __contains__(self, location):
-        if type(location) is Client:
+        if isinstance(location, Client):
             location = location.location
-        elif type(location) is not Location:
+        elif not isinstance(location, (BaseLocation, ClientRow)):
             raise ValueError("expected input type to be Client or Location")
+        return self.check(location)
 
-        # we only need to check the constraints that have actually been set for this target location
-        for constraint in vars(self):  # dynamic check
-            if hasattr(self, constraint+"_contains"):
-                try:
-                    if not getattr(self, constraint+"_contains")(location):
-                        return False
-                except KeyError:
-                    return False
-            elif hasattr(location, constraint):
-                if isinstance(getattr(self, constraint), type(getattr(location, constraint))):
-                    if getattr(location, constraint) != getattr(self, constraint):
-                        return False
-                elif hasattr(getattr(self, constraint), '__contains__'):
-                    if getattr(location, constraint) not in getattr(self, constraint):
-                        return False
-                else:
-                    return False
-            else:
-                return False
-        return True
 
+class TargetClientGroup(Constraints):
+    # client level constraints are checked before the (typically more expensive) location ones
+    constraint_costs = {'target_location': 10}
+    non_constraints = ('target_quantity',)
 
-class TargetClientGroup(Extendable):
     def __init__(self, target_location, target_quantity=None, **kwargs):
         self.target_location = target_location
         self.target_quantity = target_quantity
         for k in kwargs:
             self.set(k, kwargs[k])
 
-    def __contains__(self, client):
-        if client.location not in self.target_location:
-            return False
+    def target_location_contains(self, client):
+        return self.target_location.check(client.location)
 
-        # we only need to check the constraints that have actually been set for this target location
-        for constraint in vars(self):  # dynamic check
-            if hasattr(self, constraint+"_contains"):
-                try:
-                    if not getattr(self, constraint+"_contains")(client):
-                        return False
-                except KeyError:
-                    return False
-            elif hasattr(client, constraint):
-                if isinstance(getattr(self, constraint), type(getattr(client, constraint))):
-                    if getattr(client, constraint) != getattr(self, constraint):
-                        return False
-                elif hasattr(getattr(self, constraint), '__contains__'):
-                    if getattr(client, constraint) not in getattr(self, constraint):
-                        return False
-                else:
-                    return False
-            else:
-                return False
-        return True
+    def target_location_filter(self, clients):
+        return self.target_location.filter(clients)
 
-    def get_ClientGroup(self, platform, **kwargs):
+    def __contains__(self, client):
+        return self.check(client)
+
+    def get_ClientGroup(self, platform, groupby=None, groupsize=None, dedupe='ipv4', seed=None, **kwargs):
+        """
+        :param platform: (str) name of the platform library to get clients from
+        :param groupby: (str) if set (and target_quantity is set), sample evenly across clients grouped by this member;
+        see stratified_sample
+        :param groupsize: (int or dict) max clients per group (or group -> max clients)
+        :param dedupe: (str) with groupby, only take one client per 'ipv4', '/24' or 'asn' (None to allow duplicates)
+        :param seed: seed for reproducible groupby sampling
+        :param kwargs: passed on to the platform's get_TargetLocation_clients
+        :return: (ClientGroup)
+        """
         pl = getattr(platform_libs, platform)
         cg = getattr(pl, "get_TargetLocation_clients")(self.target_location, **kwargs)
         if self.target_quantity is not None:
-            if 'groupby' in kwargs:
-                groupby = kwargs['groupby']
-                vals = [z.get(kwargs['groupby']) for z in cg.clients]
-                if 'groupsize' in kwargs:
-                    groupsize = kwargs['groupsize']
-                else:
-                    groupsize = int(ceil(float(self.target_quantity) / float(len(vals))))
-                clients = list()
-                i = 0
-                counts = defaultdict(int)
-                groups = defaultdict(list)
-                for c in cg.clients:
-                    groups[c.get(groupby)].append(c)
-                keys = sorted(groups.keys(), key=lambda z: len(groups[z]), reverse=True)
-                for k in keys:
-                    for c in groups[k]:
-                        if counts[k] < groupsize and not any([c.ipv4 == z.ipv4 for z in clients]):
-                            clients.append(c)
-                            counts[c.get(groupby)] += 1
-                        elif counts[k] >= groupsize:
-                            break
-                    if len(clients) > self.target_quantity - 1:
-                        break
-                return ClientGroup(random.sample(clients, self.target_quantity))
-
+            if groupby is not None:
+                return stratified_sample(cg, groupby, self.target_quantity, quotas=groupsize, dedupe=dedupe,
+                                         seed=seed)
             else:
-                return ClientGroup(cg.random_sample(self.target_quantity))
+                return cg.sample(self.target_quantity)
         else:
             return cg
 
 
+def allocate_quotas(available, quantity, rng):
+    """
+    splits quantity as evenly as possible across strata (water filling): strata with fewer than their fair share
+    available give up the rest of their share to the others
+    :param available: (dict) stratum -> number of clients that can be taken from it
+    :param quantity: (int) total number of clients to take
+    :param rng: (random.Random) used to break ties when quantity doesn't split evenly
+    :return: (dict) stratum -> number of clients to take
+    """
+    keys = sorted(available, key=lambda z: available[z])
+    alloc = dict()
+    remaining = quantity
+    for i, k in enumerate(keys):
+        alloc[k] = min(available[k], remaining // (len(keys) - i))
+        remaining -= alloc[k]
+    spare = [k for k in keys if alloc[k] < available[k]]
+    rng.shuffle(spare)
+    for k in spare[:remaining]:
+        alloc[k] += 1
+    return alloc
+
+
+def dedupe_keys(group, dedupe):
+    """
+    :param dedupe: (str) 'ipv4', '/24', 'asn' or None
+    :return: (list) hashable key per client (None for clients that can't be deduplicated), or None if dedupe is None
+    """
+    if dedupe is None:
+        return None
+    if dedupe == 'asn':
+        return group.values('asn_v4')
+    ints = group.ipv4_ints()
+    if dedupe == '/24':
+        ints = ints >> 8
+    elif dedupe != 'ipv4':
+        raise ValueError("dedupe must be one of 'ipv4', '/24', 'asn' or None")
+    return [z if z >= 0 else None for z in ints.tolist()]
+
+
+def stratified_sample(group, groupby, quantity, quotas=None, dedupe='ipv4', seed=None):
+    """
+    samples quantity clients spread as evenly as possible across the values of groupby, in O(n)
+
+    :param group: (ClientGroup) candidates
+    :param groupby: (str) member to stratify by (e.g. 'country_code', 'asn_v4')
+    :param quantity: (int) number of clients to return; fewer are only returned if there aren't enough (distinct)
+    candidates within the quotas
+    :param quotas: (int or dict) max clients per stratum (or stratum -> max clients); no limit if None
+    :param dedupe: (str) keep at most one client per 'ipv4', '/24' or 'asn' (None to allow duplicates)
+    :param seed: seed for the random number generator, for reproducible samples
+    :return: (ClientGroup) the sample, as a group of the same type as group
+    """
+    rng = random.Random(seed)
+    strata_keys = group.values(groupby)
+    dkeys = dedupe_keys(group, dedupe)
+    order = list(range(len(strata_keys)))
+    rng.shuffle(order)
+    seen = set()
+    strata = defaultdict(list)
+    for pos in order:
+        if dkeys is not None and dkeys[pos] is not None:
+            if dkeys[pos] in seen:
+                continue
+            seen.add(dkeys[pos])
+        strata[strata_keys[pos]].append(pos)
+    available = dict()
+    for k in strata:
+        cap = quotas.get(k, len(strata[k])) if type(quotas) is dict else quotas
+        available[k] = len(strata[k]) if cap is None else min(cap, len(strata[k]))
+    alloc = allocate_quotas(available, quantity, rng)
+    positions = [pos for k in strata for pos in strata[k][:alloc[k]]]
+    rng.shuffle(positions)
+    if len(positions) < quantity:
+        logger.warning("only "+str(len(positions))+" of "+str(quantity)+" requested clients could be sampled")
+    return group.take(positions)
+
+
+# field -> (location member the field is inferred from, name of the location classmethod doing the inference, rate
+# limited backend); methods take the key to resolve and an optional throttle to apply before any network call, and
+# are looked up on each location's own class so its asn_resolver / geocoder settings apply
+enrichment_sources = {
+    'asn_v4': ('ipv4', 'lookup_asn', 'whois'),
+    'asn_v6': ('ipv6', 'lookup_asn', 'whois'),
+    'country_code': ('coordinates', 'reverse_geocode', 'geocoder'),
+    'coordinates': ('country_code', 'geocode', 'geocoder'),
+}
+
+# default max requests per second for each enrichment backend
+enrichment_rate_limits = {
+    'whois': 5.0,
+    'geocoder': 1.0,
+}
+
+
+def probe_id_of(client):
+    try:
+        return client.probe_id
+    except AttributeError:
+        return None
+
 
 class ClientGroup(Extendable):
-    """base class for a group of clients that will perform measurements"""
+    """
+    base class for a group of clients that will perform measurements; clients are indexed by probe_id and IPv4
+    address as they're added, so membership checks and set operations don't need to scan the group
+    """
     def __init__(self, clients=None):
+        self._clients = list()
+        self._probe_id_list = list()
+        self._by_probe_id = dict()
+        self._by_ipv4 = dict()
         if type(clients) is list:
-            self._clients = clients
-        else:
-            self._clients = list()
+            self.add_clients(clients)
 
     def add_client(self, client):
+        """
+        appends client (duplicates are kept; see dedupe) and indexes it; lookups by probe_id / IPv4 return the first
+        client added with that key
+        """
         self._clients.append(client)
+        probe_id = probe_id_of(client)
+        self._probe_id_list.append(probe_id)
+        if probe_id is not None and probe_id not in self._by_probe_id:
+            self._by_probe_id[probe_id] = client
+        ipv4 = client.location.ipv4
+        if ipv4 is not None and str(ipv4) not in self._by_ipv4:
+            self._by_ipv4[str(ipv4)] = client
 
     def add_clients(self, clients):
-        self._clients += clients
+        for client in clients:
+            self.add_client(client)
+
+    def get_client(self, probe_id=None, ipv4=None):
+        """
+        :return: (Client) the client with probe_id (or IPv4 address ipv4), or None if it isn't in the group
+        """
+        if probe_id is not None:
+            return self._by_probe_id.get(probe_id)
+        return self._by_ipv4.get(str(ipv4))
+
+    def __contains__(self, item):
+        """
+        :param item: a client (matched on probe_id), a probe_id (int), or an IPv4 address (str or IPy.IP)
+        """
+        if isinstance(item, (Client, ClientRow)):
+            probe_id = probe_id_of(item)
+            if probe_id is None:
+                return any([z is item for z in self._clients])
+            return probe_id in self._by_probe_id
+        elif isinstance(item, (str, type(u''), IP)):
+            return str(item) in self._by_ipv4
+        return item in self._by_probe_id
+
+    def union(self, *groups):
+        """
+        :return: (ClientGroup) clients of this group followed by those of groups, keeping only the first client with
+        each probe_id (clients without a probe_id are all kept)
+        """
+        cg = ClientGroup()
+        for group in (self,) + groups:
+            for client in group:
+                probe_id = probe_id_of(client)
+                if probe_id is None or probe_id not in cg._by_probe_id:
+                    cg.add_client(client)
+        return cg
+
+    def intersection(self, group):
+        """
+        :return: (ClientGroup) clients of this group whose probe_id is also in group
+        """
+        return self.select([probe_id_of(z) in group for z in self])
+
+    def difference(self, group):
+        """
+        :return: (ClientGroup) clients of this group whose probe_id is not in group
+        """
+        return self.select([probe_id_of(z) not in group for z in self])
+
+    def dedupe(self, key='probe_id'):
+        """
+        :param key: (str) 'probe_id' or 'ipv4'; clients missing the key are all kept
+        :return: (ClientGroup) the first client for each distinct key, in order
+        """
+        if key == 'probe_id':
+            keys = self._probe_id_list
+        else:
+            keys = [str(z) if z is not None else None for z in self.values(key)]
+        seen = set()
+        keep = list()
+        for k in keys:
+            keep.append(k is None or k not in seen)
+            seen.add(k)
+        return self.select(keep)
 
     def split(self, check_method):
         """
@@ -379,24 +810,85 @@ class ClientGroup(Extendable):
 
     @staticmethod
     def merge(*groups):
-        cg = ClientGroup()
-        for group in groups:
-            cg.add_clients(group.clients)
-        return cg
+        """
+        :return: (ClientGroup) union of groups (see union), so clients already in an earlier group aren't repeated
+        """
+        if len(groups) == 0:
+            return ClientGroup()
+        if all([isinstance(z, ColumnarClientGroup) for z in groups]):
+            return ColumnarClientGroup.merge(*groups)
+        return ClientGroup.union(*groups)
 
     def random_sample(self, sample_size):
         return random.sample(self.clients, sample_size)
 
+    def sample(self, sample_size):
+        """
+        :return: (ClientGroup) random sample of sample_size clients, as a group of the same type as this one
+        """
+        return ClientGroup(self.random_sample(sample_size))
+
+    def select(self, keep):
+        """
+        :param keep: (iter(bool)) one flag per client, in order
+        :return: (ClientGroup) group of the clients whose flag is True
+        """
+        return ClientGroup([c for c, k in zip(self.clients, keep) if k])
+
+    def take(self, positions):
+        """
+        :param positions: (iter(int)) positions of clients in this group
+        :return: (ClientGroup) group of the clients at positions, in that order
+        """
+        clients = self.clients
+        return ClientGroup([clients[i] for i in positions])
+
+    def values(self, member):
+        """
+        :return: (list) value of member for each client, in order
+        """
+        return [c.get(member) for c in self.clients]
+
+    def ipv4_ints(self):
+        """
+        :return: (numpy.ndarray) integer IPv4 address per client; -1 where the address is unknown
+        """
+        return np.array([c.location.ipv4.int() if c.location.ipv4 is not None else -1 for c in self.clients],
+                        dtype=np.int64)
+
+    def match(self, member, target):
+        """
+        vectorized equality (or, if target is a list/tuple/set, membership) check of member against target
+        :return: (numpy.ndarray(bool)) mask over the clients, or None if the group can't check member in bulk
+        """
+        return None
+
+    def coordinate_array(self):
+        """
+        :return: (numpy.ndarray) n x 2 array of (lat, long) per client; nan where coordinates are unknown
+        """
+        coords = np.full((len(self.clients), 2), np.nan)
+        for i, client in enumerate(self.clients):
+            coordinates = client.location.coordinates
+            if coordinates is not None:
+                coords[i] = coordinates
+        return coords
+
     def __iter__(self):
         for client in self.clients:
             yield client
 
+    def __len__(self):
+        return len(self.clients)
+
     @property
     def clients(self):
         return self._clients
 
     @clients.setter
     def clients(self, clients):
+        # replaces (rather than extends) the group, so clients can be filtered with cg.clients = [...]
+        ClientGroup.__init__(self)
         for c in clients:
             if type(c) is dict:
                 self.add_client(Client(**c))
@@ -405,15 +897,532 @@ class ClientGroup(Extendable):
 
     @property
     def probe_ids(self):
-        return [z.probe_id for z in self.clients]
+        return list(self._probe_id_list)
 
     @probe_ids.setter
     def probe_ids(self, val):
         self._probe_ids = val
 
-    def intersection(self, cg2):
-        ids1 = self.probe_ids
-        ids2 = cg2.probe_ids
-        overlap = set(ids1).intersection(ids2)
-        return [z.probe_id for z in self.clients if z.probe_id not in overlap]
+    def enrich(self, fields=('asn_v4', 'country_code'), max_workers=8, rate_limits=None):
+        """
+        fills in missing location fields for every client in one pass; each distinct key (IP, coordinates, etc.)
+        is resolved once, concurrently, and the result is written back (and recorded in inferences) for every
+        location sharing that key
+        :param fields: (iter(str)) fields to fill in, in order; see enrichment_sources for options
+        :param max_workers: (int) max number of concurrent lookups
+        :param rate_limits: (dict) backend -> max requests per second; overrides enrichment_rate_limits
+        :return: (dict) field -> number of distinct keys resolved (lookups that failed or found nothing aren't
+        counted, and are logged)
+        """
+        limits = dict(enrichment_rate_limits)
+        if rate_limits is not None:
+            limits.update(rate_limits)
+        buckets = dict((k, TokenBucket(limits[k])) for k in limits)
+        lookups = dict()
+        pool = ThreadPool(max_workers)
+        try:
+            for field in fields:
+                source, method, backend = enrichment_sources[field]
+                pending = defaultdict(list)
+                for client in self.clients:
+                    loc = client.location
+                    key = getattr(loc, '_'+source, None)
+                    if key is None or hasattr(loc, '_'+field):
+                        continue
+                    if type(key) is list:
+                        key = tuple(key)
+                    elif source.startswith('ipv'):
+                        key = str(key)
+                    # locations of different classes may resolve the same key differently
+                    pending[(type(loc), key)].append(loc)
+                bucket = buckets.get(backend)
+
+                def resolve(job):
+                    cls, key = job
+                    try:
+                        return job, getattr(cls, method)(key, bucket)
+                    except Exception as e:
+                        logger.warning("failed to infer "+field+" from "+str(key)+": "+str(e))
+                        return job, None
+
+                resolved = 0
+                for job, val in pool.imap_unordered(resolve, list(pending)):
+                    if val is not None:
+                        resolved += 1
+                        for loc in pending[job]:
+                            loc.record_inference(field, val)
+                if resolved < len(pending):
+                    logger.warning("couldn't infer "+field+" for "+str(len(pending) - resolved)+" of "+
+                                   str(len(pending))+" keys")
+                lookups[field] = resolved
+        finally:
+            pool.close()
+            pool.join()
+        return lookups
+
+
+class ClientColumns(object):
+    """
+    array backed storage for the core fields of many clients; shared (never copied) by the ColumnarClientGroups and
+    ClientRows that view it
+    """
+    # column -> (numpy dtype, missing value)
+    schema = {
+        'probe_id': (np.int64, -1),
+        'ipv4': (np.int64, -1),
+        'asn_v4': (np.int64, -1),
+        'asn_v6': (np.int64, -1),
+        'country_code': ('S2', ''),
+        'latitude': (np.float64, np.nan),
+        'longitude': (np.float64, np.nan),
+        'status': ('S16', ''),
+        'ipv6': (object, None),
+    }
+
+    def __init__(self, platform=None, extras=None, **columns):
+        """
+        :param platform: (str) platform shared by every client in the columns
+        :param extras: (list(dict)) optional per client dicts of any other members
+        :param columns: column name -> sequence of values (see schema); missing columns are filled with their
+        missing value
+        """
+        self.platform = platform
+        size = max([len(columns[z]) for z in columns] + [0])
+        for name in self.schema:
+            dtype, missing = self.schema[name]
+            if name in columns:
+                setattr(self, name, np.asarray(columns[name], dtype=dtype))
+            else:
+                col = np.empty(size, dtype=dtype)
+                col.fill(missing)
+                setattr(self, name, col)
+        self.extras = extras
+        self.inferences = defaultdict(list)
+
+    def __len__(self):
+        return len(self.probe_id)
+
+    @staticmethod
+    def row_values(probe_id=None, ipv4=None, ipv6=None, asn_v4=None, asn_v6=None, country_code=None,
+                   coordinates=None, status=None):
+        """
+        :return: (dict) column -> value for one client, with missing values filled in per the schema
+        """
+        lat, lon = coordinates if coordinates is not None else (np.nan, np.nan)
+        if type(status) is dict:
+            status = status.get('name')
+        return {
+            'probe_id': probe_id if probe_id is not None else -1,
+            'ipv4': ip_to_int(ipv4)[1] if ipv4 is not None else -1,
+            'ipv6': str(ipv6) if ipv6 is not None else None,
+            'asn_v4': asn_v4 if asn_v4 is not None else -1,
+            'asn_v6': asn_v6 if asn_v6 is not None else -1,
+            'country_code': country_code if country_code is not None else '',
+            'latitude': lat,
+            'longitude': lon,
+            'status': status if status is not None else '',
+        }
+
+    @classmethod
+    def from_rows(cls, rows, platform=None, extras=None):
+        """
+        :param rows: (list(dict)) output of row_values() for each client
+        """
+        columns = dict((name, [z[name] for z in rows]) for name in cls.schema)
+        return cls(platform=platform, extras=extras, **columns)
+
+    @classmethod
+    def from_probes(cls, probes, platform='ripe_atlas', keep_extras=False):
+        """
+        :param probes: (iter(dict)) RIPE Atlas style probe descriptions
+        :param keep_extras: (bool) if True, keep every other (non None) probe member in extras
+        """
+        core = {'id', 'address_v4', 'address_v6', 'asn_v4', 'asn_v6', 'country_code', 'geometry', 'status',
+                'status_name'}
+        rows = list()
+        extras = list() if keep_extras else None
+        for probe in probes:
+            coordinates = None
+            geometry = probe.get('geometry')
+            if geometry is not None and geometry.get('coordinates') is not None:
+                lon, lat = geometry['coordinates']
+                coordinates = (lat, lon)
+            status = probe.get('status')
+            if type(status) is not dict and probe.get('status_name') is not None:
+                status = probe['status_name']
+            rows.append(cls.row_values(probe_id=probe.get('id'), ipv4=probe.get('address_v4'),
+                                       ipv6=probe.get('address_v6'), asn_v4=probe.get('asn_v4'),
+                                       asn_v6=probe.get('asn_v6'), country_code=probe.get('country_code'),
+                                       coordinates=coordinates, status=status))
+            if keep_extras:
+                extras.append(dict((k, probe[k]) for k in probe if k not in core and probe[k] is not None))
+        return cls.from_rows(rows, platform=platform, extras=extras)
+
+    @classmethod
+    def from_clients(cls, clients):
+        """
+        :param clients: (iter(Client)) clients to copy; only the schema fields are kept
+        """
+        rows = list()
+        platform = None
+        for client in clients:
+            loc = client.location
+            platform = client.platform
+            rows.append(cls.row_values(probe_id=getattr(loc, 'probe_id', None), ipv4=loc.ipv4, ipv6=loc.ipv6,
+                                       asn_v4=getattr(loc, '_asn_v4', None), asn_v6=getattr(loc, '_asn_v6', None),
+                                       country_code=getattr(loc, '_country_code', None),
+                                       coordinates=getattr(loc, '_coordinates', None),
+                                       status=getattr(loc, 'status', None)))
+        return cls.from_rows(rows, platform=platform)
+
+    def take(self, index):
+        """
+        :return: (ClientColumns) new columns holding copies of the rows at index
+        """
+        columns = dict((name, getattr(self, name)[index]) for name in self.schema)
+        extras = [self.extras[i] for i in index] if self.extras is not None else None
+        return ClientColumns(platform=self.platform, extras=extras, **columns)
+
+
+class ClientRow(object):
+    """
+    lightweight view of one row of a ClientColumns; offers the same get(...) / attribute interface as a Client (and
+    acts as its own location)
+    """
+    __slots__ = ('_columns', '_row')
+
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = int(row)
+
+    # inference backends (see enrichment_sources); rows follow BaseLocation's asn_resolver / geocoder settings
+    @staticmethod
+    def lookup_asn(ip, throttle=None):
+        return BaseLocation.lookup_asn(ip, throttle)
+
+    @staticmethod
+    def reverse_geocode(coordinates, throttle=None):
+        return BaseLocation.reverse_geocode(coordinates, throttle)
+
+    @staticmethod
+    def geocode(country_code, throttle=None):
+        return BaseLocation.geocode(country_code, throttle)
+
+    def _value(self, name):
+        val = getattr(self._columns, name)[self._row]
+        missing = ClientColumns.schema[name][1]
+        if val is missing or val == missing or (type(missing) is float and np.isnan(val)):
+            return None
+        # hand out plain python values (e.g. so they stay json serializable)
+        return val.item() if isinstance(val, np.generic) else val
+
+    @property
+    def location(self):
+        return self
+
+    @property
+    def platform(self):
+        return self._columns.platform
+
+    @property
+    def probe_id(self):
+        return self._value('probe_id')
+
+    @property
+    def ipv4(self):
+        val = self._value('ipv4')
+        return IP(int(val), ipversion=4) if val is not None else None
+
+    @property
+    def ipv6(self):
+        val = self._value('ipv6')
+        return IP(val) if val is not None else None
+
+    @property
+    def asn_v4(self):
+        return self._value('asn_v4')
+
+    @property
+    def asn_v6(self):
+        return self._value('asn_v6')
+
+    @property
+    def country_code(self):
+        return self._value('country_code')
+
+    @property
+    def country(self):
+        return self.country_code
+
+    @property
+    def coordinates(self):
+        lat, lon = self._columns.latitude[self._row], self._columns.longitude[self._row]
+        if np.isnan(lat) or np.isnan(lon):
+            return None
+        return float(lat), float(lon)
+
+    @property
+    def status(self):
+        return self._value('status')
+
+    @property
+    def status_name(self):
+        return self.status
+
+    @property
+    def inferences(self):
+        return self._columns.inferences[self._row]
+
+    def record_inference(self, member, val):
+        if member == 'coordinates':
+            self._columns.latitude[self._row], self._columns.longitude[self._row] = val
+        else:
+            getattr(self._columns, member)[self._row] = val
+        self.inferences.append((member, val))
+
+    def __getattr__(self, name):
+        # mirror Location's _<member> convention for values that are actually stored (used by enrich)
+        if name.startswith('_') and (name[1:] in ClientColumns.schema or name == '_coordinates'):
+            val = getattr(self, name[1:])
+            if val is not None:
+                return val
+        elif self._columns.extras is not None and name in self._columns.extras[self._row]:
+            return self._columns.extras[self._row][name]
+        raise AttributeError(name)
+
+    def get(self, member):
+        return getattr(self, member)
+
+    def to_dict(self, skip_nones=True):
+        """
+        :return: (dict) the row in Client.to_dict() form, so it loads back as a Client
+        """
+        loc = dict()
+        if self._columns.extras is not None:
+            loc.update(self._columns.extras[self._row])
+        for k in ('probe_id', 'ipv4', 'ipv6', 'asn_v4', 'asn_v6', 'country_code', 'coordinates', 'status'):
+            val = getattr(self, k)
+            if val is not None or not skip_nones:
+                loc[k] = str(val) if isinstance(val, IP) else val
+        loc['inferences'] = [list(z) for z in self.inferences]
+        loc['CLASS'] = 'Location'
+        return {'platform': self.platform, 'location': loc, 'CLASS': 'Client'}
+
+    def __eq__(self, other):
+        return isinstance(other, ClientRow) and other._columns is self._columns and other._row == self._row
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._columns), self._row))
+
+    def __repr__(self):
+        return "<ClientRow: "+str(self.probe_id)+">"
+
+
+class ColumnarClientGroup(ClientGroup):
+    """
+    ClientGroup backed by ClientColumns; the group itself is just an array of row positions, so selections, splits,
+    samples and merges of groups sharing the same columns never copy client data
+    """
+    json_properties = ('clients',)
+
+    def __init__(self, columns=None, index=None):
+        """
+        :param columns: (ClientColumns) backing storage
+        :param index: (array-like(int)) rows of columns in this group; defaults to all of them
+        """
+        self._columns = columns if columns is not None else ClientColumns()
+        if index is None:
+            index = np.arange(len(self._columns))
+        self._index = np.asarray(index, dtype=np.int64)
+        self._lookup = None
+
+    @classmethod
+    def from_probes(cls, probes, platform='ripe_atlas', keep_extras=False):
+        return cls(ClientColumns.from_probes(probes, platform, keep_extras))
+
+    @classmethod
+    def from_clients(cls, clients):
+        return cls(ClientColumns.from_clients(clients))
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def index(self):
+        return self._index
+
+    def column(self, name):
+        """
+        :return: (numpy.ndarray) values of column name for this group's rows, in order
+        """
+        return getattr(self._columns, name)[self._index]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        for row in self._index:
+            yield ClientRow(self._columns, row)
+
+    @property
+    def clients(self):
+        return list(self)
+
+    @clients.setter
+    def clients(self, clients):
+        self.set_storage(*ColumnarClientGroup.from_clients(
+            [Client(**c) if type(c) is dict else c for c in clients]).get_storage())
+
+    def get_storage(self):
+        return self._columns, self._index
+
+    def set_storage(self, columns, index):
+        self._columns = columns
+        self._index = index
+        self._lookup = None
+
+    @property
+    def lookup(self):
+        """
+        :return: (dict, dict) probe_id -> position and IPv4 int -> position (first occurrence), built on first use
+        """
+        if self._lookup is None:
+            by_probe_id = dict()
+            by_ipv4 = dict()
+            for pos, (probe_id, ipv4) in enumerate(zip(self.column('probe_id').tolist(),
+                                                      self.column('ipv4').tolist())):
+                if probe_id >= 0 and probe_id not in by_probe_id:
+                    by_probe_id[probe_id] = pos
+                if ipv4 >= 0 and ipv4 not in by_ipv4:
+                    by_ipv4[ipv4] = pos
+            self._lookup = (by_probe_id, by_ipv4)
+        return self._lookup
+
+    def get_client(self, probe_id=None, ipv4=None):
+        if probe_id is not None:
+            pos = self.lookup[0].get(probe_id)
+        else:
+            pos = self.lookup[1].get(ip_to_int(ipv4)[1])
+        return ClientRow(self._columns, self._index[pos]) if pos is not None else None
+
+    def __contains__(self, item):
+        if isinstance(item, (Client, ClientRow)):
+            return probe_id_of(item) in self.lookup[0]
+        elif isinstance(item, (str, type(u''), IP)):
+            return ip_to_int(item)[1] in self.lookup[1]
+        return item in self.lookup[0]
+
+    def union(self, *groups):
+        return ColumnarClientGroup.merge(self, *groups)
+
+    def id_mask(self, group):
+        """
+        :return: (numpy.ndarray(bool)) mask of this group's rows whose probe_id is in group
+        """
+        if isinstance(group, ColumnarClientGroup):
+            ids = group.column('probe_id')
+        else:
+            ids = [z for z in group.probe_ids if z is not None]
+        return np.in1d(self.column('probe_id'), ids) & (self.column('probe_id') >= 0)
+
+    def intersection(self, group):
+        return self.select(self.id_mask(group))
+
+    def difference(self, group):
+        return self.select(~self.id_mask(group))
+
+    def dedupe(self, key='probe_id'):
+        if key not in ('probe_id', 'ipv4'):
+            return ClientGroup.dedupe(self, key)
+        col = self.column(key)
+        keep = col < 0
+        keep[np.unique(col, return_index=True)[1]] = True
+        return self.select(keep)
+
+    def add_clients(self, clients):
+        merged = ColumnarClientGroup.concat(self, ColumnarClientGroup.from_clients(clients))
+        self.set_storage(*merged.get_storage())
+
+    def add_client(self, client):
+        self.add_clients([client])
+
+    def select(self, keep):
+        keep = np.asarray(keep, dtype=bool) if len(self._index) > 0 else np.zeros(0, dtype=bool)
+        return ColumnarClientGroup(self._columns, self._index[keep])
+
+    def sample(self, sample_size):
+        return self.take(random.sample(range(len(self._index)), sample_size))
+
+    def take(self, positions):
+        return ColumnarClientGroup(self._columns, self._index[np.asarray(positions, dtype=np.int64)])
+
+    def values(self, member):
+        if member not in self.matchable:
+            return ClientGroup.values(self, member)
+        missing = ClientColumns.schema[self.matchable[member]][1]
+        return [z if z != missing else None for z in self.column(self.matchable[member]).tolist()]
+
+    def ipv4_ints(self):
+        return self.column('ipv4')
+
+    def random_sample(self, sample_size):
+        return self.sample(sample_size).clients
+
+    def split(self, check_method):
+        positions = defaultdict(list)
+        for pos, client in enumerate(self):
+            positions[check_method(client)].append(pos)
+        return dict((k, ColumnarClientGroup(self._columns, self._index[positions[k]])) for k in positions)
+
+    @staticmethod
+    def merge(*groups):
+        """
+        :return: (ColumnarClientGroup) union of groups, keeping the first row for each probe_id; zero-copy if every
+        group views the same columns, otherwise the rows are copied into new columns
+        """
+        return ColumnarClientGroup.concat(*groups).dedupe()
+
+    @staticmethod
+    def concat(*groups):
+        """
+        :return: (ColumnarClientGroup) concatenation of groups, duplicates included; zero-copy if every group views
+        the same columns
+        """
+        groups = [z if isinstance(z, ColumnarClientGroup) else ColumnarClientGroup.from_clients(z) for z in groups]
+        if len(groups) == 0:
+            return ColumnarClientGroup()
+        if all([z.columns is groups[0].columns for z in groups]):
+            return ColumnarClientGroup(groups[0].columns, np.concatenate([z.index for z in groups]))
+        parts = [z.columns.take(z.index) for z in groups]
+        columns = dict((name, np.concatenate([getattr(z, name) for z in parts])) for name in ClientColumns.schema)
+        extras = None
+        if all([z.extras is not None for z in parts]):
+            extras = [e for z in parts for e in z.extras]
+        return ColumnarClientGroup(ClientColumns(platform=parts[0].platform, extras=extras, **columns))
+
+    @property
+    def probe_ids(self):
+        return self.column('probe_id').tolist()
+
+    # member -> column, for members whose values are stored as is (IPs are stored as integers, so aren't listed)
+    matchable = {'probe_id': 'probe_id', 'asn_v4': 'asn_v4', 'asn_v6': 'asn_v6', 'country_code': 'country_code',
+                 'country': 'country_code', 'status': 'status', 'status_name': 'status'}
+
+    def match(self, member, target):
+        if member not in self.matchable:
+            return None
+        col = self.column(self.matchable[member])
+        if type(target) in (list, tuple, set, frozenset):
+            return np.in1d(col, list(target))
+        return col == target
+
+    @probe_ids.setter
+    def probe_ids(self, val):
+        pass
 
+    def coordinate_array(self):
+        return np.column_stack((self.column('latitude'), self.column('longitude')))
@@ -0,0 +1,269 @@
+from geopy.geocoders import Nominatim
+from collections import defaultdict
+from math import floor, cos, radians
+import threading
+import numpy as np
+import json
+from helpers import top_dir, logger
+
+"""
+geocoding backends for cdo.Location inference:
+    OfflineGeocoder - answers from bundled country borders / centroids (see geo_data/) plus optional reference points
+    NetworkGeocoder - Nominatim lookups, cached in memory
+"""
+
+EARTH_RADIUS_KM = 6371.0088
+# upper bound on the relative error of haversine (spherical) distances vs. ellipsoidal (vincenty) ones
+HAVERSINE_ERROR = 0.006
+default_centroids_path = top_dir+'geo_data/country_centroids.csv'
+default_borders_path = top_dir+'geo_data/country_borders.json'
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    great circle distance; works on scalars and (broadcastable) numpy arrays alike
+    :return: distance(s) in kilometers
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(z) for z in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0)**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def point_in_ring(x, y, ring):
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i]
+        xj, yj = ring[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+class OfflineGeocoder(object):
+    """reverse geocoding (coordinates -> country) and country -> coordinates without any network calls"""
+    def __init__(self, centroids_path=default_centroids_path, borders_path=default_borders_path,
+                 reference_path=None, cell_size=5.0, max_distance=500.0, snap_distance=50.0, border_margin=25.0):
+        """
+        :param centroids_path: (str) csv of country_code,latitude,longitude[,name]; used for country -> coordinates
+        and as reference points for reverse lookups; None to skip
+        :param borders_path: (str) json of country_code -> list of GeoJSON polygons ([lon, lat] rings); None to skip
+        :param reference_path: (str) optional extra reference points, either in the centroids csv format or as a
+        GeoNames dump (e.g. cities1000.txt)
+        :param cell_size: (float) size, in degrees, of the grid cells used to index borders and reference points
+        :param max_distance: (float) km; reverse lookups that aren't inside any border only match reference points
+        (including border vertices) at most this far away
+        :param snap_distance: (float) km; points this close to the centroid of a country that has no border polygon
+        (small states like SG or HK) resolve to that country before borders are checked
+        :param border_margin: (float) km; the bundled borders are simplified, so reverse lookups this close to another
+        country's border are ambiguous and return None (letting callers fall back to e.g. NetworkGeocoder); 0 to
+        always answer
+        """
+        self.cell_size = float(cell_size)
+        self.max_distance = max_distance
+        self.snap_distance = snap_distance
+        self.border_margin = border_margin
+        self.centroids = dict()
+        self._polygons = list()  # (country_code, (min_lon, min_lat, max_lon, max_lat), rings)
+        self._polygon_cells = defaultdict(list)
+        self._point_cells = defaultdict(list)
+        self._borderless_cells = defaultdict(list)
+        if centroids_path is not None:
+            self.load_points(centroids_path, centroids=True)
+        if borders_path is not None:
+            self.load_borders(borders_path)
+        if reference_path is not None:
+            self.load_points(reference_path)
+        bordered = set([z[0] for z in self._polygons])
+        for country in self.centroids:
+            if country not in bordered:
+                lat, lon = self.centroids[country]
+                self._borderless_cells[self.cell(lat, lon)].append((lat, lon, country))
+
+    def cell(self, lat, lon):
+        return int(floor(lat / self.cell_size)), int(floor(lon / self.cell_size))
+
+    def load_borders(self, path):
+        with open(path, 'r+') as f:
+            borders = json.load(f)
+        for country in borders:
+            for rings in borders[country]:
+                xs = [z[0] for z in rings[0]]
+                ys = [z[1] for z in rings[0]]
+                bbox = (min(xs), min(ys), max(xs), max(ys))
+                self._polygons.append((str(country), bbox, rings))
+                for lon, lat in rings[0]:
+                    self.add_point(lat, lon, str(country))
+                lat0, lon0 = self.cell(bbox[1], bbox[0])
+                lat1, lon1 = self.cell(bbox[3], bbox[2])
+                for i in range(lat0, lat1 + 1):
+                    for j in range(lon0, lon1 + 1):
+                        self._polygon_cells[(i, j)].append(len(self._polygons) - 1)
+
+    def add_point(self, lat, lon, country_code):
+        self._point_cells[self.cell(lat, lon)].append((lat, lon, country_code))
+
+    def load_points(self, path, centroids=False):
+        skipped = 0
+        with open(path, 'r+') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    if len(fields) >= 9:
+                        # GeoNames dump format
+                        lat, lon, country = float(fields[4]), float(fields[5]), fields[8]
+                    else:
+                        fields = line.strip().split(',')
+                        country, lat, lon = fields[0], float(fields[1]), float(fields[2])
+                except (ValueError, IndexError):
+                    skipped += 1
+                    continue
+                if len(country) != 2:
+                    skipped += 1
+                    continue
+                country = country.upper()
+                self.add_point(lat, lon, country)
+                if centroids:
+                    self.centroids[country] = (lat, lon)
+        if skipped > 1:  # the header line is expected
+            logger.debug("skipped "+str(skipped)+" lines loading reference points from "+path)
+
+    def border_country(self, lat, lon):
+        """
+        :return: (str) country code of the border polygon containing (lat, lon), or None
+        """
+        for ind in self._polygon_cells.get(self.cell(lat, lon), []):
+            country, bbox, rings = self._polygons[ind]
+            if not bbox[0] <= lon <= bbox[2] or not bbox[1] <= lat <= bbox[3]:
+                continue
+            if point_in_ring(lon, lat, rings[0]) and not any([point_in_ring(lon, lat, z) for z in rings[1:]]):
+                return country
+        return None
+
+    def countries_near(self, lat, lon, distance):
+        """
+        :param distance: (float) km
+        :return: (set) country codes of the border polygons that contain (lat, lon) or have an edge within distance
+        of it
+        """
+        dlat = distance / 111.0
+        dlon = min(180.0, dlat / max(cos(radians(min(abs(lat) + dlat, 89.9))), 1e-6))
+        lat0, lon0 = self.cell(lat - dlat, lon - dlon)
+        lat1, lon1 = self.cell(lat + dlat, lon + dlon)
+        inds = set()
+        for i in range(lat0, lat1 + 1):
+            for j in range(lon0, lon1 + 1):
+                inds.update(self._polygon_cells.get((i, j), []))
+        countries = set()
+        # equirectangular projection around (lat, lon), in km; plenty accurate at these distances
+        kx = 111.32 * cos(radians(lat))
+        for ind in inds:
+            country, bbox, rings = self._polygons[ind]
+            if country in countries or not bbox[0] - dlon <= lon <= bbox[2] + dlon or \
+                    not bbox[1] - dlat <= lat <= bbox[3] + dlat:
+                continue
+            for ring in rings:
+                ring = np.array(ring, dtype=float)
+                x = (ring[:, 0] - lon) * kx
+                y = (ring[:, 1] - lat) * 110.57
+                x0, y0, x1, y1 = x[:-1], y[:-1], x[1:], y[1:]
+                dx, dy = x1 - x0, y1 - y0
+                t = np.clip(-(x0*dx + y0*dy) / np.maximum(dx*dx + dy*dy, 1e-12), 0.0, 1.0)
+                if len(t) > 0 and np.min(np.hypot(x0 + t*dx, y0 + t*dy)) <= distance:
+                    countries.add(country)
+                    break
+            else:
+                if point_in_ring(lon, lat, rings[0]):
+                    countries.add(country)
+        return countries
+
+    def nearest_country(self, lat, lon, max_distance=None, cells=None):
+        """
+        :param max_distance: (float) km; defaults to self.max_distance
+        :param cells: grid of points to search; defaults to all reference points
+        :return: (str) country code of the closest reference point within max_distance of (lat, lon), or None
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        if cells is None:
+            cells = self._point_cells
+        dlat = max_distance / 111.0
+        dlon = min(180.0, dlat / max(cos(radians(min(abs(lat) + dlat, 89.9))), 1e-6))
+        lat0, lon0 = self.cell(lat - dlat, lon - dlon)
+        lat1, lon1 = self.cell(lat + dlat, lon + dlon)
+        candidates = list()
+        for i in range(lat0, lat1 + 1):
+            for j in range(lon0, lon1 + 1):
+                # wrap around the antimeridian
+                j = (j + int(180 / self.cell_size)) % int(360 / self.cell_size) - int(180 / self.cell_size)
+                candidates += cells.get((i, j), [])
+        if len(candidates) == 0:
+            return None
+        dists = haversine(lat, lon, np.array([z[0] for z in candidates]), np.array([z[1] for z in candidates]))
+        best = int(np.argmin(dists))
+        if dists[best] <= max_distance:
+            return candidates[best][2]
+        return None
+
+    def reverse(self, coordinates):
+        """
+        :param coordinates: (tuple(float, float)) (lat, long)
+        :return: (str) capitalized, 2 char country code, or None if it couldn't be determined (including points
+        within border_margin of another country)
+        """
+        lat, lon = float(coordinates[0]), float(coordinates[1])
+        country = self.nearest_country(lat, lon, self.snap_distance, self._borderless_cells)
+        if country is not None:
+            return country
+        country = self.border_country(lat, lon)
+        if country is None:
+            country = self.nearest_country(lat, lon)
+        if country is not None and self.border_margin > 0 and \
+                len(self.countries_near(lat, lon, self.border_margin) - set([country])) > 0:
+            return None
+        return country
+
+    def geocode(self, country_code):
+        """
+        :param country_code: (str) 2 char country code
+        :return: (tuple(float, float)) (lat, long) centroid of the country, or None if it isn't in the table
+        """
+        return self.centroids.get(str(country_code).upper())
+
+
+class NetworkGeocoder(object):
+    """Nominatim backed geocoding, with answers cached in memory"""
+    def __init__(self, precision=4):
+        """
+        :param precision: (int) decimal places coordinates are rounded to when used as cache keys
+        """
+        self.precision = precision
+        self._reverse_cache = dict()
+        self._geocode_cache = dict()
+        self._lock = threading.Lock()
+
+    def reverse(self, coordinates):
+        key = tuple([round(float(z), self.precision) for z in coordinates])
+        with self._lock:
+            if key in self._reverse_cache:
+                return self._reverse_cache[key]
+        loc = Nominatim().reverse(coordinates)
+        country = loc.raw['address']['country_code']
+        if isinstance(country, basestring) and len(country) == 2:
+            country = country.upper()
+        else:
+            country = None
+        with self._lock:
+            self._reverse_cache[key] = country
+        return country
+
+    def geocode(self, country_code):
+        with self._lock:
+            if country_code in self._geocode_cache:
+                return self._geocode_cache[country_code]
+        loc = Nominatim().geocode(country_code)
+        coordinates = (loc.latitude, loc.longitude)
+        with self._lock:
+            self._geocode_cache[country_code] = coordinates
+        return coordinates
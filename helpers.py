@@ -7,6 +7,11 @@ import datetime
 import json
 import tarfile
 import subprocess
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from IPy import IP
 
 """
 NOTE: most of the helper functions are just to make main code less cluttered
@@ -37,6 +42,9 @@ logging.config.fileConfig(top_dir+'logging.conf',
 logger = logging.getLogger(__name__)
 logger.debug("top directory level set to: "+top_dir)
 
+with open(top_dir+'config.json', 'r+') as f:
+    config_data = json.load(f)
+
 ##############################################################
 #                        FILE I/O
 ##############################################################
@@ -120,6 +128,108 @@ def append_file(path, content):
     logger.debug("successfully appended to "+path)
 
 
+class JsonLinesSink(object):
+    """
+    append-only JSON Lines file: every append() writes a batch of records, one per line, and (optionally) fsyncs, so
+    everything appended before a crash can be read back with read_jsonl()
+    """
+    def __init__(self, path, fsync=True):
+        """
+        :param path: (str) file to append to (created on first append)
+        :param fsync: (bool) if True, every batch is flushed to disk before append() returns
+        """
+        self.path = path
+        self.fsync = fsync
+        self.records = 0
+        self._f = None
+        self._lock = threading.Lock()
+
+    def repair(self):
+        """
+        drops a partially written last line (left behind by a crash in the middle of an append), and rewrites a file
+        that still holds a single JSON list (see read_jsonl) as JSON Lines, so appending to it keeps it readable
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            is_list = f.read(1) == '['
+        if is_list:
+            records = list(read_jsonl(self.path))
+            logger.warning("rewriting "+self.path+" as JSON Lines")
+            with open(self.path, 'w') as f:
+                f.write(''.join([json.dumps(z, default=str)+'\n' for z in records]))
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, 2)
+            end = f.tell()
+            pos = end
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                chunk = f.read(step)
+                ind = chunk.rfind('\n')
+                if ind >= 0:
+                    pos = pos - step + ind + 1
+                    break
+                pos -= step
+            if pos < end:
+                logger.warning("dropping "+str(end - pos)+" bytes of partial record from "+self.path)
+                f.truncate(pos)
+
+    def append(self, records):
+        """
+        :param records: (list) json serializable records
+        """
+        if len(records) == 0:
+            return
+        data = ''.join([json.dumps(z, default=str)+'\n' for z in records])
+        with self._lock:
+            if self._f is None:
+                self.repair()
+                self._f = open(self.path, 'a')
+            self._f.write(data)
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+            self.records += len(records)
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+def read_jsonl(path):
+    """
+    :param path: (str) JSON Lines file (e.g. written by JsonLinesSink); missing files are treated as empty
+    :return: (generator) the records in path; a partially written last line is skipped
+
+    NOTE: raw files written before results were streamed hold a single JSON list (of per-msm lists of results)
+    instead; those are detected by their leading '[' and their results are yielded one by one
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        if f.read(1) == '[':
+            f.seek(0)
+            for record in json.load(f):
+                if type(record) is list:
+                    for z in record:
+                        yield z
+                else:
+                    yield record
+            return
+        f.seek(0)
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning("skipping unparseable line in "+path)
+
+
 def format_dirpath(path):
     """
     :param path: (str) a path to a dir in a filesystem; assumes path uses '/' as
@@ -219,21 +329,328 @@ def remove(fname):
 ##############################################################
 
 
+# types json can encode as they are
+json_leaf_types = frozenset([str, type(u''), int, long, float, bool, type(None)])
+
+
+def list_to_dict(item):
+    return [to_dict(z) for z in item]
+
+
+def dict_to_dict(item):
+    for k in item:
+        if type(k) not in json_leaf_types:
+            return str(item)
+    return dict((k, to_dict(item[k])) for k in item)
+
+
+def converter(t, item):
+    """
+    :return: (function) how to_dict converts objects of type t (e.g. item); see to_dict
+    """
+    if isinstance(item, Extendable) and t.to_dict == Extendable.to_dict:
+        return schema_of(t).to_dict
+    elif hasattr(item, 'to_dict'):
+        return lambda z: z.to_dict()
+    elif t in (list, tuple):
+        return list_to_dict
+    elif isinstance(item, dict):
+        return dict_to_dict
+    elif hasattr(item, '__iter__'):
+        return list_to_dict
+    # catch for objects I didn't make that need to be transformed into a str first
+    try:
+        _ = json.dumps({"entry": item})
+        return lambda z: z
+    except:
+        return str
+
+
+# type -> conversion used by to_dict, worked out the first time each type is seen
+converters = dict()
+
+
 def to_dict(item):
-    if hasattr(item, 'to_dict'):
-        return item.to_dict()
-    elif hasattr(item, '__iter__') and type(item) is not dict:
-        return [to_dict(z) for z in item]
-    else:
-        # catch for objects I didn't make that need to be transformed into a str first
+    t = type(item)
+    if t in json_leaf_types:
+        return item
+    convert = converters.get(t)
+    if convert is None:
+        convert = converter(t, item)
+        converters[t] = convert
+    return convert(item)
+
+
+class Schema(object):
+    """
+    serialization recipe for one Extendable class, worked out once (see schema_of) rather than with hasattr() calls
+    on every member of every object:
+        - public members are read through get_<member> if the class has one
+        - settable properties stored under _<name> (e.g. Location.ipv4, ClientGroup.clients) are read from that
+        storage, so serializing never triggers inference (geocoding, whois lookups)
+        - properties named in the class' json_properties are read through the property
+    """
+    def __init__(self, cls):
+        self.name = cls.__name__
+        self.cls = cls
+        self.getters = dict()
+        self.backed = list()
+        self.read = list(cls.json_properties)
+        for k in dir(cls):
+            attr = getattr(cls, k, None)
+            if not k.startswith('_') and isinstance(attr, property) and attr.fset is not None \
+                    and k not in self.read:
+                self.backed.append(('_'+k, k))
+
+    def getter(self, member):
+        """
+        :return: (function) unbound get_<member> method, or None if the class doesn't have one
+        """
         try:
-            _ = json.dumps({"entry": item})
-            return item
-        except:
-            return str(item)
+            return self.getters[member]
+        except KeyError:
+            getter = getattr(self.cls, 'get_'+member, None)
+            self.getters[member] = getter
+            return getter
+
+    def members(self, obj):
+        """
+        :return: (list) (name, raw value) of each of obj's serialized members
+        """
+        out = list()
+        members = obj.members()
+        getters = self.getters
+        for m in members:
+            if m[0] != '_':
+                getter = getters[m] if m in getters else self.getter(m)
+                out.append((m, members[m] if getter is None else getter(obj)))
+        for backing, m in self.backed:
+            if backing in members:
+                out.append((m, members[backing]))
+        for m in self.read:
+            out.append((m, getattr(obj, m)))
+        return out
+
+    def to_dict(self, obj, skip_nones=True):
+        # same as converting members(obj), inlined since this runs once per object
+        d = dict()
+        members = obj.members()
+        getters = self.getters
+        for m in members:
+            if m[0] != '_':
+                getter = getters[m] if m in getters else self.getter(m)
+                val = to_dict(members[m] if getter is None else getter(obj))
+                if val is not None or not skip_nones:
+                    d[m] = val
+        for backing, m in self.backed:
+            if backing in members:
+                val = to_dict(members[backing])
+                if val is not None or not skip_nones:
+                    d[m] = val
+        for m in self.read:
+            val = to_dict(getattr(obj, m))
+            if val is not None or not skip_nones:
+                d[m] = val
+        d['CLASS'] = self.name
+        return d
+
+
+schemas = dict()
+
+
+def schema_of(cls):
+    """
+    :return: (Schema) cls' (cached) Schema
+    """
+    try:
+        return schemas[cls]
+    except KeyError:
+        schemas[cls] = Schema(cls)
+        return schemas[cls]
+
+
+def write_json(item, f, chunk_size=1000, skip_nones=True):
+    """
+    writes item as json to stream f as it's serialized; Extendables are written member by member, and lists
+    chunk_size elements at a time, so the full dict of e.g. a large ClientGroup is never built in memory (and each
+    chunk goes through json's C encoder instead of json.dump's pure python one)
+    :param skip_nones: (bool) applies to item itself; nested objects always skip None members (as in to_dict)
+    """
+    if isinstance(item, Extendable) and type(item).to_dict == Extendable.to_dict:
+        f.write('{')
+        for m, val in schema_of(type(item)).members(item):
+            if val is not None or not skip_nones:
+                f.write(json.dumps(m)+': ')
+                write_json(val, f, chunk_size)
+                f.write(', ')
+        f.write('"CLASS": '+json.dumps(type(item).__name__)+'}')
+    elif type(item) in (list, tuple):
+        f.write('[')
+        for i in range(0, len(item), chunk_size):
+            if i > 0:
+                f.write(', ')
+            f.write(json.dumps([to_dict(z) for z in item[i:i+chunk_size]])[1:-1])
+        f.write(']')
+    else:
+        f.write(json.dumps(to_dict(item)))
+
+
+# CLASS tag -> Extendable subclass (see json_class)
+json_classes = dict()
+
+
+def json_class(name):
+    """
+    :param name: (str) CLASS tag written by to_dict
+    :return: (class) the Extendable subclass with that name, or None; when several share a name (e.g. a platform's
+    PingResult and mms.mro's), the one closest to Extendable is used, since to_dict output holds plain member names
+    rather than a platform's raw fields
+    """
+    if name not in json_classes:
+        # classes may have been defined since the last lookup
+        level = [Extendable]
+        while len(level) > 0:
+            below = list()
+            for cls in level:
+                json_classes.setdefault(cls.__name__, cls)
+                below += cls.__subclasses__()
+            level = below
+    return json_classes.get(name)
+
+
+def from_dict(d):
+    """
+    json object_hook: rebuilds dicts tagged with the CLASS of an Extendable (see to_dict) as instances of that class
+    """
+    if 'CLASS' in d:
+        cls = json_class(d['CLASS'])
+        if cls is not None:
+            return cls.from_dict(d)
+    return d
+
+
+class JsonReader(object):
+    """
+    incremental json reader: the top level object is read one member at a time, and list members one element at a
+    time, so memory use is bounded by the largest element rather than the size of the document
+    """
+    def __init__(self, f, build=True, chunk_size=1 << 16):
+        """
+        :param f: (file) stream to read from
+        :param build: (bool) if True, objects tagged with a CLASS are rebuilt as instances of that class (see
+        from_dict); otherwise, they're left as dicts
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder(object_hook=from_dict if build else None)
+
+    def fill(self):
+        """
+        drops what has been read from the buffer and reads (at least) the next chunk
+        :return: (bool) False if the end of the stream was reached
+        """
+        if self.eof:
+            return False
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        :return: (str) the next non whitespace character, or '' at the end of the stream
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError("expected one of '"+chars+"', got "+repr(c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        :return: the next complete json value
+        """
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number cut off by the end of the buffer (e.g. '2.' of '2.5') decodes as a shorter one
+                if self.eof or (end < len(self.buf) and self.buf[end] not in '0123456789.eE+-'):
+                    self.pos = end
+                    return val
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def elements(self):
+        """
+        :return: (generator) elements of the list at the current position
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def items(self, lazy=()):
+        """
+        :param lazy: (iter(str)) names of list members to return as generators (see elements), which must be
+        consumed before moving on to the next member; any other list is returned as a list
+        :return: (generator) (name, value) of each member of the top level object
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if self.peek() == '[':
+                val = self.elements()
+                if key in lazy:
+                    yield key, val
+                    # skip whatever the caller didn't read
+                    for _ in val:
+                        pass
+                else:
+                    yield key, list(val)
+            else:
+                yield key, self.value()
+            if self.expect(',}') == '}':
+                return
 
 
 class Extendable(object):
+    # empty, so Compact subclasses can do without a per instance __dict__
+    __slots__ = ()
+    # names of (computed) properties to_dict should include; see Schema
+    json_properties = ()
+
+    def members(self):
+        """
+        :return: (dict) the instance's members, i.e. vars(self)
+        """
+        return vars(self)
+
     def get(self, member):
         """
         :param member: (str) name of member whose value should be returned
@@ -257,14 +674,7 @@ class Extendable(object):
             setattr(self, member_name, val)
 
     def to_dict(self, skip_nones=True):
-        members = [v for v in vars(self) if not callable(v) and not v.startswith('_')]
-        d = dict()
-        for m in members:
-            tmp = to_dict(self.get(m))
-            if tmp is not None and skip_nones: # skip None entries to save space
-                d[m] = to_dict(self.get(m))
-        d['CLASS'] = self.__class__.__name__
-        return d
+        return schema_of(type(self)).to_dict(self, skip_nones)
 
     def save_json(self, file_path=None, skip_nones=True):
         if file_path is None:
@@ -272,21 +682,274 @@ class Extendable(object):
                 file_path = self.get('file_path')
             else:
                 raise ValueError('file_path must be defined')
-        data = self.to_dict(skip_nones)
         with open(file_path, "w+") as f:
-            json.dump(data, f)
+            write_json(self, f, skip_nones=skip_nones)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        :param d: (dict) output of to_dict
+        :return: a new instance with d's members; members __init__ takes are passed to it, and the rest are set
+        afterwards (if d is missing some of __init__'s required args, __init__ is skipped and every member is set)
+        """
+        members = dict((str(k), d[k]) for k in d if k != 'CLASS')
+        try:
+            args, _, keywords, defaults = inspect.getargspec(cls.__init__)
+        except TypeError:
+            # object.__init__ (a slot wrapper) takes nothing
+            args, keywords, defaults = ['self'], None, None
+        required = args[1:len(args) - len(defaults or ())]
+        if all([z in members for z in required]):
+            accepted = dict((k, members.pop(k)) for k in list(members) if keywords is not None or k in args[1:])
+            obj = cls(**accepted)
+        else:
+            obj = cls.__new__(cls)
+        for k in members:
+            obj.set(k, members[k])
+        return obj
 
     def load_json(self, file_path):
+        """
+        sets the members saved in file_path (see save_json); the file is read incrementally (see JsonReader), and
+        saved objects (e.g. the Clients of a ClientGroup) are rebuilt as instances of their CLASS
+        """
         with open(file_path, "r+") as f:
-            d = json.load(f)
-        for k in d:
-            self.set(k, d[k])
+            for k, val in JsonReader(f).items():
+                if k != 'CLASS':
+                    self.set(str(k), val)
+
+
+# class -> names of its slots (from every base class)
+slot_names = dict()
+
+
+def slots_of(cls):
+    """
+    :return: (frozenset) names of cls' slots, other than Compact's overflow dict
+    """
+    try:
+        return slot_names[cls]
+    except KeyError:
+        names = set()
+        for base in cls.__mro__:
+            names.update(getattr(base, '__slots__', ()))
+        names.difference_update(('_extras', '__dict__', '__weakref__'))
+        slot_names[cls] = frozenset(names)
+        return slot_names[cls]
+
+
+class Compact(Extendable):
+    """
+    base class for objects with a known set of members, listed in the subclass' __slots__ and stored without a per
+    instance __dict__:
+        - known public members that were never set read as None
+        - any other member set with set() goes into an overflow dict (_extras), only created when it's needed; plain
+        attribute assignment only works for known members
+    """
+    __slots__ = ('_extras',)
+
+    def __getattr__(self, name):
+        # only called when regular lookup fails, i.e. for unset slots and overflow members
+        if name == '_extras':
+            return None
+        if self._extras is not None and name in self._extras:
+            return self._extras[name]
+        if not name.startswith('_') and name in slots_of(type(self)):
+            return None
+        raise AttributeError(name)
+
+    def set(self, member_name, val):
+        if hasattr(self, "set_"+member_name):
+            getattr(self, "set_"+member_name)(val)
+        else:
+            try:
+                setattr(self, member_name, val)
+            except AttributeError:
+                if self._extras is None:
+                    self._extras = dict()
+                self._extras[member_name] = val
+
+    def members(self):
+        """
+        :return: (dict) every member that has been set (known and overflow), like vars() of a regular object
+        """
+        d = dict()
+        for name in slots_of(type(self)):
+            try:
+                d[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        if self._extras is not None:
+            d.update(self._extras)
+        return d
+
 
 ##############################################################
 #               NETWORKING CLASSES AND METHODS
 ##############################################################
 
 
+class WhoisCache(object):
+    """
+    two layer cache for RDAP whois results: an in-memory LRU keyed by IP, in front of an on-disk
+    (sqlite) table keyed by the narrowest prefix returned with each result; a single RDAP answer
+    therefore covers every later lookup that falls inside the same prefix
+    """
+    def __init__(self, db_path=None, ttl=30*24*3600, lru_size=4096):
+        """
+        :param db_path: (str) path to the sqlite file; if None, defaults to
+        <data_path>/state_data/whois_cache.db (created on first use)
+        :param ttl: (int) seconds before a cached result is considered stale and re-fetched
+        :param lru_size: (int) max number of IPs held in the in-memory front layer
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.lru_size = lru_size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            if self.db_path is None:
+                self.db_path = format_dirpath(config_data['data_path']+"/state_data/")+"whois_cache.db"
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS prefixes (af INTEGER, start TEXT, stop TEXT, "
+                               "prefixlen INTEGER, cidr TEXT, fetched REAL, result TEXT, "
+                               "PRIMARY KEY (af, start, prefixlen))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS prefixes_range ON prefixes (af, start, stop)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _key(val):
+        # fixed width hex so that string comparison in sqlite matches numeric order for v4 and v6
+        return '%032x' % val
+
+    def _remember(self, ipstr, result, fetched):
+        self._lru[ipstr] = (result, fetched)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def lookup(self, ipstr):
+        """
+        :param ipstr: (str) IP address to look up
+        :return: (dict) cached whois result covering ipstr, or None on a miss (or if stale)
+        """
+        now = time.time()
+        with self._lock:
+            if ipstr in self._lru:
+                result, fetched = self._lru.pop(ipstr)
+                if now - fetched <= self.ttl:
+                    self._lru[ipstr] = (result, fetched)
+                    self.memory_hits += 1
+                    return result
+            ip = IP(ipstr)
+            key = self._key(ip.int())
+            row = self.conn.execute("SELECT result, fetched FROM prefixes WHERE af=? AND start<=? AND stop>=? "
+                                    "AND fetched>=? ORDER BY prefixlen DESC LIMIT 1",
+                                    (ip.version(), key, key, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            result = json.loads(row[0])
+            if 'query' in result:
+                # the result was fetched for another address in the prefix
+                result['query'] = ipstr
+            self._remember(ipstr, result, row[1])
+            self.disk_hits += 1
+            return result
+
+    def store(self, ipstr, result):
+        """
+        :param ipstr: (str) IP address that was looked up
+        :param result: (dict) whois result for ipstr; stored under the narrowest prefix covering ipstr out of
+        result['asn_cidr'] and the CIDR(s) in result['network'] (the registered network is often a much bigger block
+        than the announced prefix the ASN fields belong to)
+        """
+        now = time.time()
+        net = self.narrowest_prefix(ipstr, result)
+        data = json.dumps(result, default=str)
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO prefixes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (net.version(), self._key(net.int()), self._key(net.int() + net.len() - 1),
+                               net.prefixlen(), str(net), now, data))
+            self.conn.commit()
+            self._remember(ipstr, result, now)
+
+    @staticmethod
+    def narrowest_prefix(ipstr, result):
+        """
+        :return: (IP) narrowest prefix in result that covers ipstr; ipstr itself if there is none
+        """
+        ip = IP(ipstr)
+        cidrs = list()
+        try:
+            cidrs.append(result['asn_cidr'])
+        except (KeyError, TypeError):
+            pass
+        try:
+            cidrs += result['network']['cidr'].split(',')
+        except (KeyError, TypeError, AttributeError):
+            pass
+        best = ip
+        for cidr in cidrs:
+            try:
+                net = IP(str(cidr).strip(), make_net=True)
+            except ValueError:
+                # e.g. 'NA' when RDAP didn't give one
+                continue
+            if ip in net and (best is ip or net.prefixlen() > best.prefixlen()):
+                best = net
+        return best
+
+    def purge_expired(self):
+        """removes stale entries from both layers"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for k in [z for z in self._lru if self._lru[z][1] < cutoff]:
+                del self._lru[k]
+            self.conn.execute("DELETE FROM prefixes WHERE fetched<?", (cutoff,))
+            self.conn.commit()
+
+    def stats(self):
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'lru_entries': len(self._lru)}
+
+
+def prefix_cached(cache):
+    """
+    decorator for lookup functions of the form func(ipstr, **kwargs) -> whois result; results are
+    served from / stored to cache (a WhoisCache)
+
+    NOTE: calls that pass kwargs bypass the cache, since kwargs may change the shape of the result
+    """
+    def decorator(func):
+        def wrapper(ipstr, **kwargs):
+            if len(kwargs) > 0:
+                return func(ipstr, **kwargs)
+            result = cache.lookup(ipstr)
+            if result is None:
+                result = func(ipstr)
+                if result is not None:
+                    cache.store(ipstr, result)
+            return result
+        wrapper.cache = cache
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+whois_cache = WhoisCache(db_path=config_data.get('whois_cache_path') or None,
+                         ttl=config_data.get('whois_cache_ttl', 30*24*3600))
+
+
+@prefix_cached(whois_cache)
 def whois_lookup(ipstr, **kwargs):
     """
 
@@ -294,8 +957,7 @@ def whois_lookup(ipstr, **kwargs):
     :param kwargs:
     :return: (dict) result of IPWhois lookup
 
-     NOTE: this should be wrapped by a decorator to implement caching
-     for faster/more reliable lookups
+     NOTE: cached by prefix in whois_cache; see WhoisCache
     """
     obj = IPWhois(ipstr)
     return obj.lookup_rdap(**kwargs)
@@ -320,15 +982,61 @@ def cidr_lookup(ipstr, **kwargs):
 
     :param ipstr:
     :param kwargs:
-    :return:
+    :return: (str) CIDR(s) of the network containing ipstr (comma separated if more than one)
     """
     results = whois_lookup(ipstr, **kwargs)
     if results is not None:
-        return int(results['network']['cidr'])
+        return results['network']['cidr']
     else:
         return None
 
 
+class TokenBucket(object):
+    """thread safe token bucket for rate limiting calls to remote services"""
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: (float) tokens added per second
+        :param capacity: (float) max tokens that can accumulate (i.e. burst size); defaults to max(1, rate)
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, tokens=1):
+        """
+        :return: (float) seconds until tokens will be available (0 if they are available now)
+        """
+        with self._lock:
+            self._refill()
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def consume(self, tokens=1, block=True):
+        """
+        :param tokens: (float) number of tokens to take; can't be more than capacity, which would never be available
+        :param block: (bool) if True, sleep until the tokens are available
+        :return: (bool) True if the tokens were taken
+        """
+        if tokens > self.capacity:
+            raise ValueError("can't consume "+str(tokens)+" tokens from a bucket with capacity "+str(self.capacity))
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+                wait = (tokens - self.tokens) / self.rate
+            if not block:
+                return False
+            time.sleep(wait)
+
+
 class TimeoutError(BaseException):
     pass
 
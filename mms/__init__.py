@@ -3,3 +3,4 @@ import mdo_sequence
 import collector
 import dispatcher
 import mro
+import columnar
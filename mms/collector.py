@@ -1,21 +1,179 @@
 import threading
-from time import sleep
-from ..helpers import mydir, format_dirpath, top_dir, Extendable
+import heapq
+import itertools
+import time
+import Queue
+from ..helpers import mydir, format_dirpath, top_dir, Extendable, logger
 from .. import platform_libs
 import json
 
 with open(top_dir+"config.json", 'r+') as f:
     config_data = json.load(f)
 
-class SpinningCollector(Extendable):
+
+class CollectorEngine(object):
+    """
+    runs any number of collectors on a fixed number of threads: spinning collectors wait in a heap ordered by the
+    time of their next poll, and a scheduling thread sleeps until the earliest one is due (or a collector is added /
+    triggered), then hands it to a bounded pool of workers that run its step (and callbacks); a collector is only put
+    back in the heap once its step has returned, so one slow step doesn't hold up the others, and thread count and
+    memory don't grow with the number of measurements in flight
+    """
+    def __init__(self, trigger_poll=0.5, workers=None):
+        """
+        :param trigger_poll: (float) max seconds between checks of pending triggered collectors' events (only
+        matters for events that are set directly, rather than through TriggeredCollector.trigger)
+        :param workers: (int) number of threads running steps (config: collector_workers)
+        """
+        self.trigger_poll = trigger_poll
+        self.workers = workers if workers is not None else config_data.get('collector_workers', 8)
+        self._heap = list()
+        self._triggered = list()
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._jobs = Queue.Queue()
+        self._pool = list()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap) + len(self._triggered)
+
+    def ensure_running(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='collector-engine')
+                self._thread.daemon = True
+                self._thread.start()
+            self._pool = [z for z in self._pool if z.is_alive()]
+            while len(self._pool) < self.workers:
+                worker = threading.Thread(target=self.work, name='collector-worker-'+str(len(self._pool)))
+                worker.daemon = True
+                worker.start()
+                self._pool.append(worker)
+
+    def add(self, collector, delay=0):
+        """
+        schedules collector.step() to run after delay seconds (and again after every delay it returns)
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._order), collector))
+            self._cond.notify()
+        self.ensure_running()
+
+    def add_triggered(self, collector):
+        """
+        runs collector.step() once its trigger_event is set or its timeout (if any) passes
+        """
+        with self._cond:
+            self._triggered.append(collector)
+            self._cond.notify()
+        self.ensure_running()
+
+    def notify(self):
+        """wakes the engine up to check triggered collectors"""
+        with self._cond:
+            self._cond.notify()
+
+    def next_ready(self):
+        """
+        blocks until at least one collector is due
+        :return: (list) collectors to step
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = list()
+                while len(self._heap) > 0 and self._heap[0][0] <= now:
+                    ready.append(heapq.heappop(self._heap)[2])
+                pending = list()
+                for collector in self._triggered:
+                    if collector.trigger_event.is_set() or (collector.deadline is not None and
+                                                            collector.deadline <= now):
+                        ready.append(collector)
+                    else:
+                        pending.append(collector)
+                self._triggered = pending
+                if len(ready) > 0:
+                    return ready
+                wait = self._heap[0][0] - now if len(self._heap) > 0 else None
+                if len(self._triggered) > 0:
+                    wait = self.trigger_poll if wait is None else min(wait, self.trigger_poll)
+                self._cond.wait(wait)
+
+    def run(self):
+        while True:
+            for collector in self.next_ready():
+                self._jobs.put(collector)
+
+    def work(self):
+        while True:
+            collector = self._jobs.get()
+            try:
+                delay = collector.step()
+            except Exception as e:
+                logger.exception("collector failed: "+str(e))
+                collector.err = e
+                collector.finish(run_callback=False)
+                continue
+            if delay is not None:
+                self.add(collector, delay)
+
+
+# shared by every collector that isn't given an engine of its own
+default_engine = CollectorEngine()
+
+
+class Collector(Extendable):
+    """base class for collectors; see SpinningCollector and TriggeredCollector"""
+
+    def set_retrieval_func(self, meas_type):
+        func_name = meas_type+'_retrieval_func'
+        pl = getattr(platform_libs, self.measro.get('platform'))
+        self.retrieval_func = getattr(pl, func_name)
+
+    def set_callback(self, meas_type):
+        func_name = meas_type+'_callback'
+        pl = getattr(platform_libs, self.measro.get('platform'))
+        self.callback = getattr(pl, func_name)
+
+    def finish(self, run_callback=True):
+        try:
+            if run_callback:
+                self.callback(self)
+        finally:
+            self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        blocks until the collector has finished (i.e. its callback has run)
+        :return: (bool) True if the collector finished
+        """
+        if timeout is None:
+            # a plain Event.wait() can't be interrupted (e.g. by ctrl-c) in python 2
+            while not self._done.wait(60):
+                pass
+            return True
+        return self._done.wait(timeout)
+
+
+class SpinningCollector(Collector):
     def __init__(self, measro, retrieval_func=None, callback=None, spin_time=10,
-            timeout=90):
+            timeout=90, engine=None):
         """
 
         :param meas_kwargs: (dict) will be used as input for retrieval_func
         :param retrieval_func: function to retrieve measurement from file; will use label as parameter input
         :param callback: function to call once measurement has been obtained
         :param spin_time: time to wait between attempts to retrieve measurement results
+        :param engine: (CollectorEngine) engine to poll from; defaults to default_engine
+
+        NOTE: retrieval_func(collector) should make a single attempt and return (result obtained, result data, err);
+        the engine calls it again every spin_time seconds until a result is obtained or timeout passes
         """
 
         self.measro = measro
@@ -35,45 +193,30 @@ class SpinningCollector(Extendable):
         self.time_elapsed = 0
         self.timeout = timeout
 
-        self.grabber_thread = threading.Thread(target=self.get_result)
-        self.grabber_thread.daemon = True
-        self.grabber_thread.start()
-
-
-    def set_retrieval_func(self, meas_type):
-        func_name = meas_type+'_retrieval_func'
-        pl = getattr(platform_libs, self.measro.get('platform'))
-        self.retrieval_func = getattr(pl, func_name)
-
-    def set_callback(self, meas_type):
-        func_name = meas_type+'_callback'
-        pl = getattr(platform_libs, self.measro.get('platform'))
-        self.callback = getattr(pl, func_name)
+        self._done = threading.Event()
+        self._engine = engine if engine is not None else default_engine
+        self._engine.add(self)
 
-    def get_result(self):
-        print "spinning..."
-        while True:
-            print "loop..."
-            self.result_obtained, self.result_data, self.err = self.retrieval_func(self)
-            print "ran func"
-            if self.result_obtained:
-                print "got res"
-                self.callback(self)
-                return
-            elif self.time_elapsed >= self.timeout:
-                print "timed out"
-                self.callback(self)
-                return
-            else:
-                print "sleeping..."
-                self.time_elapsed += self.spin_time
-                sleep(self.spin_time)
-            print "idk"
+    def step(self):
+        """
+        makes one retrieval attempt
+        :return: (float) seconds until the next attempt, or None if the collector is finished
+        """
+        self.result_obtained, self.result_data, self.err = self.retrieval_func(self)
+        if self.result_obtained:
+            logger.debug("got result")
+        elif self.time_elapsed >= self.timeout:
+            logger.debug("timed out")
+        else:
+            self.time_elapsed += self.spin_time
+            return self.spin_time
+        self.finish()
+        return None
 
 
-class TriggeredCollector(Extendable):
+class TriggeredCollector(Collector):
     def __init__(self, measro, trigger_event, retrieval_func=None,
-                 callback=None, timeout=None):
+                 callback=None, timeout=None, engine=None):
         """
 
         :param meas_kwargs: (dict) will be used as input for retrieval_func
@@ -81,6 +224,7 @@ class TriggeredCollector(Extendable):
         :param trigger_event: the event to listen for; once the event has been observed, call retrieval func
         :param callback: function to call once measurement has been obtained
         :param timeout: time to wait for trigger before giving up
+        :param engine: (CollectorEngine) engine to wait on; defaults to default_engine
         """
         self.measro = measro
         self.trigger_event = trigger_event
@@ -96,31 +240,27 @@ class TriggeredCollector(Extendable):
         self.err = None
         self.result_obtained = False
         self.timeout = timeout
+        self.deadline = time.time() + timeout if timeout is not None else None
         self.filename = None
-        self.grabber_thread = threading.Thread(target=self.get_result)
-        self.grabber_thread.daemon = True
-        self.grabber_thread.start()
+        self._done = threading.Event()
+        self._engine = engine if engine is not None else default_engine
+        self._engine.add_triggered(self)
 
-    def set_retrieval_func(self, meas_type):
-        func_name = meas_type+'_retrieval_func'
-        pl = getattr(platform_libs, self.measro.get('platform'))
-        self.retrieval_func = getattr(pl, func_name)
-
-    def set_callback(self, meas_type):
-        func_name = meas_type+'_callback'
-        pl = getattr(platform_libs, self.measro.get('platform'))
-        self.callback = getattr(pl, func_name)
+    def trigger(self):
+        """sets trigger_event and wakes the engine up right away"""
+        self.trigger_event.set()
+        self._engine.notify()
 
-    def get_result(self):
-        self.trigger_event.wait(self.timeout)
+    def step(self):
         self.trigger_event.clear()
         self.result_obtained, self.result, self.err = self.retrieval_func(self)
-        self.callback(self)
+        self.finish()
+        return None
 
 
 def wait_on_collectors(collectors, timeout=None):
-    for collector in collectors:
-        if timeout is None:
-            collector.grabber_thread.join()
-        else:
-            collector.grabber_thread.join(timeout)
+    """
+    :param timeout: (float) max seconds to wait for each collector
+    :return: (bool) True if every collector finished
+    """
+    return all([collector.wait(timeout) for collector in collectors])
@@ -0,0 +1,264 @@
+import os
+import json
+import base64
+import struct
+import numpy as np
+
+"""
+binary, columnar on-disk format for result sets: a directory holding one .npy file per column plus meta.json
+
+    int / float fields      typed arrays (missing values are -1 / nan)
+    string fields           int32 codes (-1 if missing) into a per-column dictionary, kept in meta.json
+    rtt_list                float32 values (nan for lost packets) + int64 offsets
+    answers                 codes of '<rr type> <answer>' strings + int64 offsets
+    raw_response            raw (base64 decoded) DNS abuf bytes + int64 offsets
+
+arrays are memory-mapped when read back, so a scan over millions of results only touches the columns it uses
+"""
+
+int_fields = ('prb_id', 'msm_id', 'af', 'num_sent', 'num_returned', 'size', 'ttl')
+float_fields = ('timestamp', 'response_time')
+string_fields = ('label', 'platform', 'meas_type', 'src_addr', 'src_name', 'local_addr', 'dst_addr', 'dst_name',
+                 'query_domain', 'query_type', 'protocol', 'resolver', 'local_resolver', 'local_resolver_name',
+                 'target_resolver', 'country_code')
+
+
+def result_fields(result, properties={}):
+    """
+    :return: (dict) result's members, including property backed ones (e.g. lazily decoded DNS answers)
+    """
+    if type(result) is dict:
+        return result
+    cls = type(result)
+    if cls not in properties:
+        properties[cls] = [k for k in dir(cls) if isinstance(getattr(cls, k), property)]
+    if len(properties[cls]) == 0:
+        return result.members()
+    fields = dict(result.members())
+    for k in properties[cls]:
+        fields[k] = getattr(result, k)
+    return fields
+
+
+def rtt_value(rtt):
+    try:
+        return float(rtt)
+    except (TypeError, ValueError):
+        # timeouts / errors (e.g. {'x': '*'})
+        return np.nan
+
+
+class ColumnWriter(object):
+    """
+    writes a 1d .npy file a chunk at a time, so a column never has to be held in memory whole; the header (which
+    holds the length) is filled in by close
+    """
+    header_size = 128
+
+    def __init__(self, path, dtype):
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.f = open(path, 'wb')
+        self.f.write(' ' * self.header_size)
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        self.f.write(values.tostring())
+        self.size += len(values)
+
+    def close(self):
+        magic = np.lib.format.magic(1, 0)
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % \
+                 (np.lib.format.dtype_to_descr(self.dtype), self.size)
+        # padded with spaces (and ended with a newline) up to header_size, as the format allows
+        header = header.ljust(self.header_size - len(magic) - 3) + '\n'
+        self.f.seek(0)
+        self.f.write(magic + struct.pack('<H', len(header)) + header)
+        self.f.close()
+
+
+class RaggedWriter(object):
+    """writes a ragged column as '<name>.values' and '<name>.offsets' ColumnWriters"""
+    def __init__(self, dir_path, name, dtype):
+        self.values = ColumnWriter(os.path.join(dir_path, name+'.values.npy'), dtype)
+        self.offsets = ColumnWriter(os.path.join(dir_path, name+'.offsets.npy'), np.int64)
+        self.offsets.append([0])
+
+    def append(self, lists):
+        lists = [np.asarray(z, dtype=self.values.dtype) for z in lists]
+        self.offsets.append(self.values.size + np.cumsum([len(z) for z in lists], dtype=np.int64))
+        if len(lists) > 0:
+            self.values.append(np.concatenate(lists))
+
+    def close(self):
+        self.values.close()
+        self.offsets.close()
+
+
+def write_columnar(results, dir_path, header=None, chunk_size=65536):
+    """
+    :param results: (iter) result objects (e.g. PingResult, DNSResult) or their dicts (e.g. from
+    ResultSet.iter_results)
+    :param dir_path: (str) directory to write to (created if needed)
+    :param header: (dict) extra (json serializable) metadata to save with the columns, e.g. ResultSet members
+    :param chunk_size: (int) number of results converted and written at a time; memory use is bounded by it (plus
+    the string dictionaries), rather than by the number of results
+    :return: (int) number of results written
+    """
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    writers = dict()
+    for fields, dtype in ((int_fields, np.int64), (float_fields, np.float64), (string_fields, np.int32)):
+        for k in fields:
+            writers[k] = ColumnWriter(os.path.join(dir_path, k+'.npy'), dtype)
+    for k, dtype in (('rtt_list', np.float32), ('answers', np.int32), ('raw_response', np.uint8)):
+        writers[k] = RaggedWriter(dir_path, k, dtype)
+    dictionaries = dict((k, dict()) for k in string_fields + ('answers',))
+
+    def encode(name, val):
+        if val is None:
+            return -1
+        return dictionaries[name].setdefault(val, len(dictionaries[name]))
+
+    chunk = dict((k, list()) for k in writers)
+
+    def flush():
+        for k in writers:
+            writers[k].append(chunk[k])
+            chunk[k] = list()
+
+    count = 0
+    for result in results:
+        count += 1
+        fields = result_fields(result)
+        for k in int_fields:
+            val = fields.get(k)
+            chunk[k].append(val if type(val) in (int, long) else -1)
+        for k in float_fields:
+            val = fields.get(k)
+            chunk[k].append(float(val) if val is not None else np.nan)
+        for k in string_fields:
+            val = fields.get(k)
+            chunk[k].append(encode(k, val if val is None else unicode(val)))
+        chunk['rtt_list'].append([rtt_value(z) for z in (fields.get('rtt_list') or list())])
+        ans = fields.get('answers') or dict()
+        chunk['answers'].append([encode('answers', rr_type+' '+z) for rr_type in sorted(ans) for z in ans[rr_type]])
+        abuf = fields.get('raw_response')
+        chunk['raw_response'].append(np.frombuffer(base64.b64decode(abuf), dtype=np.uint8) if abuf else ())
+        if count % chunk_size == 0:
+            flush()
+    flush()
+    for k in writers:
+        writers[k].close()
+
+    columns = [k for k in writers if type(writers[k]) is ColumnWriter]
+    columns += [k+suffix for k in writers if type(writers[k]) is RaggedWriter for suffix in ('.values', '.offsets')]
+    meta = {
+        'count': count,
+        'columns': sorted(columns),
+        # dictionary entries, in code order
+        'dictionaries': dict((k, sorted(dictionaries[k], key=dictionaries[k].get)) for k in dictionaries),
+        'header': header if header is not None else dict()
+    }
+    with open(os.path.join(dir_path, 'meta.json'), 'w+') as f:
+        json.dump(meta, f)
+    return count
+
+
+class ColumnarResults(object):
+    """memory-mapped reader for result sets saved with write_columnar (or ResultSet.save_columnar)"""
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        with open(os.path.join(dir_path, 'meta.json'), 'r+') as f:
+            meta = json.load(f)
+        self.count = meta['count']
+        self.column_names = meta['columns']
+        self.dictionaries = meta['dictionaries']
+        self.header = meta['header']
+        self._columns = dict()
+
+    def __len__(self):
+        return self.count
+
+    def column(self, name):
+        """
+        :param name: (str) field name; ragged fields are split into '<name>.values' and '<name>.offsets'
+        :return: (numpy.ndarray) the (memory-mapped) column; string fields are returned as dictionary codes
+        """
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.dir_path, name+'.npy'), mmap_mode='r')
+        return self._columns[name]
+
+    def code(self, name, val):
+        """
+        :return: (int) dictionary code of string val in column name (-1 if it never occurs), e.g. for
+        column(name) == code(name, val) scans
+        """
+        try:
+            return self.dictionaries[name].index(val)
+        except ValueError:
+            return -1
+
+    def strings(self, name):
+        """
+        :return: (list(str)) decoded values of string column name (None where missing)
+        """
+        entries = self.dictionaries[name]
+        return [entries[z] if z >= 0 else None for z in self.column(name).tolist()]
+
+    def ragged(self, name, i):
+        offsets = self.column(name+'.offsets')
+        return self.column(name+'.values')[offsets[i]:offsets[i+1]]
+
+    def rtts(self, i):
+        """
+        :return: (numpy.ndarray(float32)) rtts of result i; nan for lost packets
+        """
+        return self.ragged('rtt_list', i)
+
+    def abuf(self, i):
+        """
+        :return: (str) raw DNS answer buffer of result i (empty if there isn't one)
+        """
+        return self.ragged('raw_response', i).tostring()
+
+    def answers(self, i):
+        """
+        :return: (dict) rr type -> list of answers for result i
+        """
+        entries = self.dictionaries['answers']
+        ans = dict()
+        for code in self.ragged('answers', i).tolist():
+            rr_type, val = entries[code].split(' ', 1)
+            ans.setdefault(rr_type, list()).append(val)
+        return ans
+
+    def row(self, i):
+        """
+        :return: (dict) the non-missing fields of result i
+        """
+        d = dict()
+        for k in int_fields:
+            if self.column(k)[i] != -1:
+                d[k] = int(self.column(k)[i])
+        for k in float_fields:
+            if not np.isnan(self.column(k)[i]):
+                d[k] = float(self.column(k)[i])
+        for k in string_fields:
+            code = self.column(k)[i]
+            if code >= 0:
+                d[k] = self.dictionaries[k][code]
+        rtts = self.rtts(i)
+        if len(rtts) > 0:
+            d['rtt_list'] = [None if np.isnan(z) else float(z) for z in rtts]
+        answers = self.answers(i)
+        if len(answers) > 0:
+            d['answers'] = answers
+        abuf = self.abuf(i)
+        if len(abuf) > 0:
+            d['raw_response'] = base64.b64encode(abuf)
+        return d
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self.row(i)
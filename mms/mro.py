@@ -1,9 +1,36 @@
 # Measurement Result Object (MRO)
-from ..helpers import Extendable
+from ..helpers import Extendable, Compact, JsonReader, to_dict, logger
+from columnar import write_columnar, ColumnarResults
+from collections import OrderedDict, defaultdict
 import dns.message
+import dns.rdatatype
+import threading
+import hashlib
+import json
 import base64
 
-class PingResult(Extendable):
+class BasePingResult(Extendable):
+    """behavior shared by PingResult and CompactPingResult"""
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<PingResult: "+str(self.label)+">"
+
+    def __str__(self):
+        outstr = str(self.label)+"\n"
+        members = [v for v in self.members() if not callable(v) and not v.startswith("_") and v != "label"]
+        for ind, m in enumerate(members):
+            if ind % 2 == 0:
+                line = "\t" + m + ": " + str(getattr(self, m)) + ",\t\t"
+                while len(line) < 30:
+                    line += " "
+                outstr += line
+            else:
+                outstr += m + ": " + str(getattr(self, m)) + ",\n"
+        return outstr
+
+
+class PingResult(BasePingResult):
     def __init__(self, **kwargs):
         self.label = None
         self.af = None # int
@@ -23,21 +50,17 @@ class PingResult(Extendable):
         for k in kwargs:
             self.set(k, kwargs[k])
 
-    def __repr__(self):
-        return "<PingResult: "+str(self.label)+">"
 
-    def __str__(self):
-        outstr = str(self.label)+"\n"
-        members = [v for v in vars(self) if not callable(v) and not v.startswith("_") and v != "label"]
-        for ind, m in enumerate(members):
-            if ind % 2 == 0:
-                line = "\t" + m + ": " + str(getattr(self, m)) + ",\t\t"
-                while len(line) < 30:
-                    line += " "
-                outstr += line
-            else:
-                outstr += m + ": " + str(getattr(self, m)) + ",\n"
-        return outstr
+class CompactPingResult(Compact, BasePingResult):
+    """PingResult without a per instance __dict__ (see helpers.Compact), for holding very many results"""
+    __slots__ = ('label', 'af', 'dst_addr', 'dst_name', 'local_addr', 'src_addr', 'src_name', 'rtt_list', 'num_sent',
+                 'num_returned', 'size', 'ttl', 'timestamp', 'platform', 'prb_id', 'msm_id')
+
+    def __init__(self, **kwargs):
+        for k in kwargs:
+            self.set(k, kwargs[k])
+        if self.rtt_list is None:
+            self.rtt_list = list()
 
 
 class PingSetResults(Extendable):
@@ -67,18 +90,177 @@ class PingSetResults(Extendable):
 rr_types = {1: 'A', 2: 'NS', 5: 'CNAME', 15: 'MX', 28: 'AAAA'}
 
 
-class DNSResult(Extendable):
+def rr_type_name(rdtype):
+    return rr_types.get(rdtype) or dns.rdatatype.to_text(rdtype)
+
+
+def wire_answers(buf):
+    """
+    :param buf: (str) base64 encoded DNS response
+    :return: (dict) rr type -> list of answers (as text)
+    """
+    msg = dns.message.from_wire(base64.b64decode(buf))
+    answers = dict()
+    for ans in msg.answer:
+        answers[rr_type_name(ans.rdtype)] = [item.to_text() for item in ans.items]
+    return answers
+
+
+def wire_question(buf):
+    """
+    :param buf: (str) base64 encoded DNS query
+    :return: (tuple(str, str)) query domain and type, or None if the query has no question
+    """
+    msg = dns.message.from_wire(base64.b64decode(buf))
+    if len(msg.question) == 0:
+        return None
+    return msg.question[0].name.to_text(), rr_type_name(msg.question[0].rdtype)
+
+
+class DecodeCache(object):
+    """
+    thread safe LRU cache of decoded DNS messages, keyed by a hash of the (base64) wire format; identical responses
+    from many probes are only parsed once
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, buf, decoder):
+        """
+        :param buf: (str) base64 encoded DNS message
+        :param decoder: (func) decodes buf (e.g. wire_answers); exceptions are logged and cached as a None result
+        :return: decoder(buf)
+        """
+        key = (decoder.__name__, hashlib.sha1(buf).digest())
+        with self._lock:
+            if key in self._lru:
+                val = self._lru.pop(key)
+                self._lru[key] = val
+                self.hits += 1
+                return val
+        try:
+            val = decoder(buf)
+        except Exception as e:
+            logger.warning("failed to decode DNS message: "+str(e))
+            val = None
+        with self._lock:
+            self.misses += 1
+            self._lru[key] = val
+            if len(self._lru) > self.size:
+                self._lru.popitem(last=False)
+        return val
+
+    def answers(self, buf):
+        """
+        :return: (dict) see wire_answers; a copy the caller is free to modify ({} if buf couldn't be decoded)
+        """
+        answers = self.get(buf, wire_answers)
+        return dict((k, list(v)) for k, v in answers.items()) if answers is not None else dict()
+
+    def question(self, buf):
+        return self.get(buf, wire_question)
+
+
+# shared by every DNSResult
+decode_cache = DecodeCache()
+
+
+class BaseDNSResult(Extendable):
+    """
+    behavior shared by DNSResult and CompactDNSResult
+
+    NOTE: answers (and query_domain / query_type) are decoded from raw_response (raw_query) the first time they're
+    read, rather than when the result is built; see extract_answers and decode_dns_results. A query field that was
+    set explicitly (tracked in _explicit_query) is never overwritten by a decode, whenever that decode happens
+    """
+    __slots__ = ()
+    # read through the properties (rather than their storage), so pending decodes happen before saving
+    json_properties = ('answers', 'query_domain', 'query_type')
+
+    @property
+    def answers(self):
+        if self._undecoded_answers:
+            self._undecoded_answers = False
+            self._answers = decode_cache.answers(self.raw_response)
+        return self._answers
+
+    @answers.setter
+    def answers(self, answers):
+        self._answers = answers
+        self._undecoded_answers = False
+
+    @property
+    def query_domain(self):
+        self.decode_query()
+        return self._query_domain
+
+    @query_domain.setter
+    def query_domain(self, val):
+        self.store_explicit_query('query_domain', val)
+
+    @property
+    def query_type(self):
+        self.decode_query()
+        return self._query_type
+
+    @query_type.setter
+    def query_type(self, val):
+        self.store_explicit_query('query_type', val)
+
+    def store_explicit_query(self, member, val):
+        if self._explicit_query is None:
+            self._explicit_query = set()
+        self._explicit_query.add(member)
+        setattr(self, '_'+member, val)
+
+    def store_decoded_query(self, question):
+        """
+        :param question: (tuple(str, str)) decoded (query_domain, query_type); fields set explicitly are kept
+        """
+        explicit = self._explicit_query or ()
+        if 'query_domain' not in explicit:
+            self._query_domain = question[0]
+        if 'query_type' not in explicit:
+            self._query_type = question[1]
+
+    def extract_answers(self):
+        """marks answers to be decoded from raw_response the next time they're read"""
+        if self.raw_response is not None:
+            self._undecoded_answers = True
+
+    def extract_query(self):
+        """marks query_domain and query_type to be decoded from raw_query the next time they're read"""
+        if self.raw_query is not None:
+            self._undecoded_query = True
+
+    def decode_query(self):
+        if self._undecoded_query:
+            self._undecoded_query = False
+            question = decode_cache.question(self.raw_query)
+            if question is not None:
+                self.store_decoded_query(question)
+
+
+class DNSResult(BaseDNSResult):
     def __init__(self, **kwargs):
+        self._answers = dict()
+        self._undecoded_answers = False
+        self._query_domain = None
+        self._query_type = None
+        self._undecoded_query = False
+        self._explicit_query = None
         self.label = None
         self.platform = None
         self.meas_type = 'dns'
-        self.query_domain = None
-        self.query_type = None
         self.protocol = None
         self.local_resolver = None
         self.target_resolver = None
-        self.answers = dict()
         self.raw_response = None
+        self.raw_query = None
         self.timestamp = None
         self.src_name = None
         self.src_addr = None
@@ -86,28 +268,160 @@ class DNSResult(Extendable):
         for k in kwargs:
             self.set(k, kwargs[k])
 
-    def extract_answers(self):
-        msg = dns.message.from_wire(base64.b64decode(self.raw_response))
-        if hasattr(msg, 'answer'):
-            self.answers = dict()
-            for ans in msg.answer:
-                rr_type = rr_types[ans.rdtype]
-                self.answers[rr_type] = list()
-                for item in ans.items:
-                    self.answers[rr_type].append(item.to_text())
+
+class CompactDNSResult(Compact, BaseDNSResult):
+    """
+    DNSResult without a per instance __dict__ (see helpers.Compact), for holding very many results; answers is None
+    (rather than an empty dict) until it's set or decoded
+    """
+    __slots__ = ('_answers', '_undecoded_answers', '_query_domain', '_query_type', '_undecoded_query',
+                 '_explicit_query', 'label', 'platform', 'meas_type', 'protocol', 'local_resolver', 'target_resolver',
+                 'raw_response', 'raw_query', 'timestamp', 'src_name', 'src_addr', 'local_addr', 'response_time',
+                 'prb_id', 'msm_id', 'af')
+
+    def __init__(self, **kwargs):
+        self._answers = None
+        self._undecoded_answers = False
+        self._query_domain = None
+        self._query_type = None
+        self._undecoded_query = False
+        self._explicit_query = None
+        self.meas_type = 'dns'
+        for k in kwargs:
+            self.set(k, kwargs[k])
+
+
+def decode_dns_results(results):
+    """
+    decodes the pending answers / questions of many DNSResults at once; each distinct message is parsed (or looked up
+    in decode_cache) only once
+    :param results: (iter) results; anything other than DNSResults (or CompactDNSResults) is skipped
+    """
+    by_response = defaultdict(list)
+    by_query = defaultdict(list)
+    for result in results:
+        if isinstance(result, BaseDNSResult):
+            if result._undecoded_answers:
+                by_response[result.raw_response].append(result)
+            if result._undecoded_query:
+                by_query[result.raw_query].append(result)
+    for buf, group in by_response.items():
+        answers = decode_cache.answers(buf)
+        for result in group:
+            result.answers = dict((k, list(v)) for k, v in answers.items())
+    for buf, group in by_query.items():
+        question = decode_cache.question(buf)
+        for result in group:
+            result._undecoded_query = False
+            if question is not None:
+                result.store_decoded_query(question)
 
 
 class ResultSet(Extendable):
     def __init__(self, **kwargs):
         self.results = list()
+        # raw platform results, as JSON Lines (one result per line, .jsonl; older raw files were a single .json list)
         self.raw_file_path = None
         self.file_path = None
         self.label = None
         self.platform = None
         self.meas_type = None
+        self._stream = None
+        self._streamed = 0
+        self._keep_results = True
         for k in kwargs:
             self.set(k, kwargs[k])
 
     def append(self, result):
         self.results.append(result)
 
+    def open_stream(self, file_path=None, keep_results=True):
+        """
+        starts saving the result set incrementally: every other member is written right away, and results are
+        written as they're added with append_batch(); once close_stream() is called, the file is a regular ResultSet
+        json document (with one result per line, see iter_results)
+        :param file_path: (str) defaults to self.file_path
+        :param keep_results: (bool) if False, results are dropped from memory as soon as they've been written
+        """
+        if file_path is None:
+            file_path = self.get('file_path')
+        header = self.to_dict()
+        results = header.pop('results', list())
+        self._stream = open(file_path, 'w+')
+        self._stream.write(json.dumps(header)[:-1]+', "results": [\n')
+        self._streamed = 0
+        self._keep_results = keep_results
+        self.write_results(results)
+        if not keep_results:
+            self.results = list()
+
+    def write_results(self, dicts):
+        if len(dicts) == 0:
+            return
+        sep = ',\n' if self._streamed > 0 else ''
+        self._stream.write(sep+',\n'.join([json.dumps(z) for z in dicts]))
+        self._stream.flush()
+        self._streamed += len(dicts)
+
+    def append_batch(self, results):
+        """
+        adds results; if the result set is being streamed (see open_stream), they're written out immediately
+        """
+        if self._stream is None:
+            self.results += results
+            return
+        self.write_results([to_dict(z) for z in results])
+        if self._keep_results:
+            self.results += results
+
+    def close_stream(self):
+        if self._stream is not None:
+            self._stream.write('\n]}\n')
+            self._stream.close()
+            self._stream = None
+
+    def decode_dns(self):
+        """decodes the answers of every DNSResult in the set in one batch; see decode_dns_results"""
+        decode_dns_results(self.results)
+
+    def save_columnar(self, dir_path=None):
+        """
+        saves the results in the binary columnar format (see mms.columnar), with the other members as its header
+        :param dir_path: (str) defaults to <file_path>.cols
+        :return: (str) dir_path
+        """
+        if dir_path is None:
+            dir_path = self.get('file_path')+'.cols'
+        header = self.to_dict()
+        del header['results']
+        write_columnar(self.results, dir_path, header)
+        return dir_path
+
+    @staticmethod
+    def load_columnar(dir_path):
+        """
+        :return: (ColumnarResults) memory-mapped reader for a result set saved with save_columnar
+        """
+        return ColumnarResults(dir_path)
+
+    @staticmethod
+    def iter_results(file_path):
+        """
+        :param file_path: (str) saved ResultSet
+        :return: (generator) the saved results (dicts), read one at a time; for files written with open_stream,
+        results written before an interrupted stream was closed are included
+        """
+        with open(file_path, 'r') as f:
+            if not f.readline().rstrip().endswith('"results": ['):
+                f.seek(0)
+                for k, val in JsonReader(f, build=False).items(lazy=('results',)):
+                    if k == 'results':
+                        for result in val:
+                            yield result
+                return
+            for line in f:
+                line = line.strip().rstrip(',')
+                if line in ('', ']}'):
+                    continue
+                yield json.loads(line)
+
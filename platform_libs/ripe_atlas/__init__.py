@@ -2,19 +2,41 @@ import json
 import time
 import ripe.atlas.cousteau as rac
 import datetime
-from collections import defaultdict
-from copy import deepcopy
+import heapq
+import itertools
+import threading
+from collections import defaultdict, deque
 from time import sleep
-from ra_mro import PingResult, DNSResult
-from ...cdo import Client, ClientGroup, Location
+from ra_mro import PingResult, DNSResult, CompactPingResult, CompactDNSResult
+from catalog import ProbeCatalog
+from ...cdo import Client, ClientGroup, Location, CompactLocation, ColumnarClientGroup
 from ...mms.mro import PingSetResults, ResultSet
 from ...helpers import logger, format_dirpath
 from ...helpers import top_dir
 from ...helpers import nowstr, timestr
+from ...helpers import TokenBucket, JsonLinesSink, read_jsonl
+from multiprocessing.pool import ThreadPool
 
 with open(top_dir+'config.json', 'r+') as f:
     config_data = json.load(f)
 
+# shared by every (listing) request this module makes to the Atlas API
+api_limiter = TokenBucket(config_data.get('ripeatlas_api_rate', 5.0), config_data.get('ripeatlas_api_burst'))
+
+# local probe snapshot used for probe selection; disabled (live API queries) unless a catalog path is configured
+if config_data.get('ripeatlas_probe_catalog'):
+    probe_catalog = ProbeCatalog(config_data['ripeatlas_probe_catalog'],
+                                 max_age=config_data.get('ripeatlas_probe_catalog_max_age', 24*3600),
+                                 full_max_age=config_data.get('ripeatlas_probe_catalog_full_max_age', 7*24*3600))
+else:
+    probe_catalog = None
+
+# shared by every measurement creation request this module makes
+create_limiter = TokenBucket(config_data.get('ripeatlas_create_rate', 1.0), config_data.get('ripeatlas_create_burst', 5))
+
+# build results and probe locations as __slots__ based objects (see helpers.Compact), to save memory on large runs
+compact_models = config_data.get('compact_models', False)
+
 
 ##############################################################################
 # MEASUREMENT CREATION
@@ -140,20 +162,102 @@ def format_mdo(measdo):
 # PROBE SELECTION
 ##############################################################################
 
+zones = ["North-Central", "South-Central", "South-East", "West", "North-East"]
+
+
+def limited_stream(request, limiter):
+    """
+    :param request: (RequestGenerator) cousteau listing request (e.g. ProbeRequest)
+    :param limiter: (TokenBucket) a token is taken before each page of results is requested from the API
+    :return: (generator) the request's results
+    """
+    while True:
+        if not request.current_batch:
+            limiter.consume()
+        try:
+            yield next(request)
+        except StopIteration:
+            return
+
+
+def take(stream, n):
+    """
+    :return: (list) up to n items from stream (fewer only if stream runs out)
+    """
+    items = list()
+    for item in stream:
+        items.append(item)
+        if len(items) >= n:
+            break
+    return items
+
+
+def get_spread_probes(total, values=None, scope='area', max_workers=None, limiter=None, **kwargs):
+    """
+    gets probes spread as evenly as possible across areas (or countries); each area is queried concurrently, with
+    every page request waiting on the API rate limiter. When an area runs out of probes, its shortfall is
+    redistributed over the areas that still have probes left
+    :param total: (int) number of probes to get
+    :param values: (list(str)) areas (scope 'area'; defaults to the five Atlas areas) or country codes (scope 'country')
+    :param scope: (str) 'area' or 'country'
+    :param max_workers: (int) max number of concurrent queries; defaults to one per value
+    :param limiter: (TokenBucket) defaults to api_limiter
+    :param kwargs: probe filters, applied to every query
+    :return: (list(dict)) up to total (distinct) probes
+    """
+    if values is None:
+        values = zones
+    if limiter is None:
+        limiter = api_limiter
+    streams = dict()
+    for val in values:
+        filters = dict(kwargs)
+        if scope == 'country':
+            filters['country_code'] = val
+        else:
+            filters['type'] = scope
+            filters['value'] = val
+        filters.setdefault('page_size', max(1, min(500, total / len(values) + 1)))
+        streams[val] = limited_stream(rac.ProbeRequest(**filters), limiter)
+
+    probes = list()
+    seen = set()
+    remaining = list(values)
+    pool = ThreadPool(max_workers if max_workers is not None else len(values))
+    try:
+        while len(probes) < total and len(remaining) > 0:
+            need = total - len(probes)
+            jobs = [(val, need / len(remaining) + (1 if i < need % len(remaining) else 0))
+                    for i, val in enumerate(remaining)]
+            jobs = [z for z in jobs if z[1] > 0]
+            results = pool.map(lambda job: take(streams[job[0]], job[1]), jobs)
+            for (val, quota), got in zip(jobs, results):
+                if len(got) < quota:
+                    remaining.remove(val)
+                for probe in got:
+                    if probe['id'] not in seen:
+                        seen.add(probe['id'])
+                        probes.append(probe)
+            # rotate, so that leftover single probes don't always come from the same areas
+            remaining = remaining[1:] + remaining[:1]
+    finally:
+        pool.close()
+    if len(probes) < total:
+        logger.warning("only found "+str(len(probes))+" of "+str(total)+" requested probes")
+    return probes[:total]
+
+
 def get_probes(**kwargs):
+    """
+    :param kwargs: probe filters; globally_spread=<int> instead gets that many probes spread over the Atlas areas
+    (or, if spread_countries=<list> is also given, over those countries); see get_spread_probes
+    """
     if 'globally_spread' in kwargs:
-        total = kwargs['globally_spread']
-        del kwargs['globally_spread']
-        zones = ["North-Central", "South-Central", "South-East", "West", "North-East"]
-        piece_size = total / len(zones)
-        probes = list()
-        for zone in zones:
-            print('requesting...')
-            probes += list(rac.ProbeRequest(type='area', value=zone,
-                requested=piece_size, **kwargs))
-            print('sleeping...')
-            time.sleep(10)
-        return probes
+        total = kwargs.pop('globally_spread')
+        countries = kwargs.pop('spread_countries', None)
+        if countries is not None:
+            return get_spread_probes(total, countries, scope='country', **kwargs)
+        return get_spread_probes(total, **kwargs)
 
     return rac.ProbeRequest(**kwargs)
 
@@ -173,10 +277,12 @@ def get_TargetLocation_probes(tl, **kwargs):
     if hasattr(tl, 'countries'):
         c = tl.get('countries')
         kwargs['country_code__in'] = c
-    if hasattr(tl, 'ipv4_subnet'):
+    # the API only takes one prefix per address family; prefix lists are applied locally (see
+    # get_TargetLocation_clients)
+    if hasattr(tl, 'ipv4_subnet') and type(tl.get('ipv4_subnet')) is not list:
         v4s = str(tl.get('ipv4_subnet'))
         kwargs['prefix_v4'] = v4s
-    if hasattr(tl, 'ipv6_subnet'):
+    if hasattr(tl, 'ipv6_subnet') and type(tl.get('ipv6_subnet')) is not list:
         v6s = str(tl.get('ipv6_subnet'))
         kwargs['prefix_v6'] = v6s
     if hasattr(tl, 'v4_asns'):
@@ -203,6 +309,16 @@ def probes_to_clients(probes):
             probe['ipv6'] = probe['address_v6']
         if 'id' in probe:
             probe['probe_id'] = probe['id']
+        # same mapping as ClientColumns.from_probes, so both kinds of groups filter alike
+        if probe.get('geometry') is not None and probe['geometry'].get('coordinates') is not None:
+            lon, lat = probe['geometry']['coordinates']
+            probe['coordinates'] = (lat, lon)
+        if type(probe.get('status')) is dict:
+            probe['status'] = probe['status'].get('name')
+        elif probe.get('status_name') is not None:
+            probe['status'] = probe['status_name']
+        if 'status' in probe:
+            probe['status_name'] = probe['status']
         mems = probe.keys()
         for k in mems:
             if probe[k] is None:
@@ -210,15 +326,36 @@ def probes_to_clients(probes):
         clients.add_client(
             Client(
                 platform='ripe_atlas',
-                location=Location(**probe)
+                location=CompactLocation(**probe) if compact_models else Location(**probe)
             )
         )
     return clients
 
 
-def get_TargetLocation_clients(tl, **kwargs):
-    probes = get_TargetLocation_probes(tl, **kwargs)
-    return probes_to_clients(probes)
+def get_TargetLocation_clients(tl, columnar=False, catalog=None, **kwargs):
+    """
+    :param tl: (TargetLocation) location constraints for the probes
+    :param columnar: (bool) if True, return an array backed ColumnarClientGroup (only core probe fields are kept)
+    :param catalog: (ProbeCatalog) local probe snapshot to select from (refreshed first if it's stale); defaults to
+    the configured probe_catalog. Probes are requested from the API instead if there is no catalog, or if kwargs
+    (extra API filters) are given
+    :return: (ClientGroup) clients matching tl
+    """
+    if catalog is None:
+        catalog = probe_catalog
+    if catalog is not None and len(kwargs) == 0:
+        catalog.refresh_if_stale()
+        probes = catalog.query_TargetLocation(tl)
+    else:
+        probes = get_TargetLocation_probes(tl, **kwargs)
+    if columnar:
+        clients = ColumnarClientGroup.from_probes(probes)
+    else:
+        clients = probes_to_clients(probes)
+    for af in ('ipv4', 'ipv6'):
+        if hasattr(tl, af+'_subnet') and type(tl.get(af+'_subnet')) is list:
+            clients = getattr(tl, af+'_subnet_filter')(clients)
+    return clients
 
 
 def probes_to_ids(probes):
@@ -267,78 +404,320 @@ def send_request(probe_ids, measurement, **kwargs):
     return request.create()
 
 
-def launch_measurement(probe_ids, measurement, **kwargs):
-    if len(probe_ids) * len(measurement) < 50:
-        is_success, response = send_request(probe_ids, measurement, **kwargs)
+def measurement_target(meas):
+    """
+    :param meas: (rac.AtlasMeasurement) measurement definition
+    :return: (str) what Atlas counts "same target" limits against: the target, or the query for DNS measurements
+    that use the probes' resolvers
+    """
+    target = getattr(meas, 'target', None)
+    if target is None:
+        target = getattr(meas, 'query_argument', None)
+    return target
+
+
+class AdmissionControl(object):
+    """
+    holds launches back just below the account's concurrent measurement and daily limits, so they aren't rejected:
+    running measurements are counted as the last get_active_count answer plus what we've launched since, minus
+    those of our launches since then that have completed; the count is refreshed every sync_interval seconds (which
+    also picks up completions of older measurements, and measurements launched by anyone else on the account)
+    """
+    def __init__(self, max_active=None, daily_limit=None, headroom=None, sync_interval=None, count_func=None):
+        """
+        :param max_active: (int) account's concurrent measurement limit (config: ripeatlas_max_active)
+        :param daily_limit: (int) account's limit on measurements created per day (config: ripeatlas_daily_limit)
+        :param headroom: (int) how far below the limits to stay (config: ripeatlas_admission_headroom)
+        :param sync_interval: (float) seconds between get_active_count checks (config:
+        ripeatlas_active_sync_interval)
+        :param count_func: function() -> (int) running measurements, or -1 if unknown; defaults to get_active_count
+        """
+        self.max_active = max_active if max_active is not None else config_data.get('ripeatlas_max_active', 100)
+        self.daily_limit = daily_limit if daily_limit is not None else \
+            config_data.get('ripeatlas_daily_limit', 1000)
+        self.headroom = headroom if headroom is not None else config_data.get('ripeatlas_admission_headroom', 2)
+        self.sync_interval = sync_interval if sync_interval is not None else \
+            config_data.get('ripeatlas_active_sync_interval', 30)
+        self.count_func = count_func
+        self.synced_count = 0
+        self.last_sync = None
+        self.reserved = 0
+        # our measurements launched since the last sync that haven't completed
+        self.recent = set()
+        self.launch_times = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def active(self):
+        """(int) estimated number of running (or about to be created) measurements"""
+        return self.synced_count + len(self.recent) + self.reserved
+
+    @property
+    def max_batch(self):
+        """(int) most measurements a single acquire can ever get; bigger batches would wait forever"""
+        return max(1, min(self.max_active, self.daily_limit) - self.headroom)
+
+    def sync(self):
+        with self._cond:
+            # only launches made before the count was asked for are sure to be in it
+            counted = set(self.recent)
+        count = self.count_func() if self.count_func is not None else get_active_count()
+        with self._cond:
+            self.last_sync = time.time()
+            if count < 0:
+                logger.warning("couldn't get active measurement count; keeping local estimate")
+                return
+            self.synced_count = count
+            self.recent -= counted
+            self._cond.notify_all()
+
+    def resync(self):
+        """forces a sync before the next launch (e.g. after a rejection)"""
+        with self._cond:
+            # expired rather than unset, so waits computed from it stay valid
+            self.last_sync = 0
+            self._cond.notify_all()
+
+    def launched_today(self):
+        cutoff = time.time() - 24*3600
+        while len(self.launch_times) > 0 and self.launch_times[0] < cutoff:
+            self.launch_times.popleft()
+        return len(self.launch_times)
+
+    def acquire(self, n=1):
+        """
+        blocks until n more measurements can be created without going over the limits, and reserves them (see
+        launched and release)
+        :return: (bool) True if reserved; False (right away) if n more would go over the daily limit
+        """
+        while True:
+            if self.last_sync is None or time.time() - self.last_sync >= self.sync_interval:
+                self.sync()
+            with self._cond:
+                if self.launched_today() + self.reserved + n > self.daily_limit - self.headroom:
+                    return False
+                if self.active + n <= self.max_active - self.headroom:
+                    self.reserved += n
+                    return True
+                self._cond.wait(max(0.0, self.last_sync + self.sync_interval - time.time()))
+
+    def release(self, n=1):
+        """gives back n reservations that didn't turn into measurements"""
+        with self._cond:
+            self.reserved -= n
+            self._cond.notify_all()
+
+    def launched(self, msm_ids, n=None):
+        """
+        :param msm_ids: (list) ids of the measurements created with the reservations
+        :param n: (int) number of reservations used; defaults to len(msm_ids)
+        """
+        with self._cond:
+            self.reserved -= n if n is not None else len(msm_ids)
+            self.recent.update(msm_ids)
+            now = time.time()
+            self.launch_times.extend([now]*len(msm_ids))
+            self._cond.notify_all()
+
+    def completed(self, msm_id):
+        with self._cond:
+            if msm_id in self.recent:
+                self.recent.remove(msm_id)
+                self._cond.notify_all()
+
+
+# shared by every launch
+admission = AdmissionControl()
+
+
+def pack_requests(measurements, probe_ids, max_definitions=None, max_probes=None, max_size=None):
+    """
+    groups measurement definitions and probes into as few creation requests as the per request limits allow; every
+    definition in a request runs on every probe in its source, so the probe chunk size and the number of definitions
+    per request are traded off against each other
+    :param measurements: (list) measurement definitions (e.g. from make_ping_struct)
+    :param probe_ids: (list) probes to run every measurement on
+    :param max_definitions: (int) max definitions per request (config: ripeatlas_max_definitions_per_request)
+    :param max_probes: (int) max probes per request (config: ripeatlas_max_probes_per_request)
+    :param max_size: (int) max definitions * probes per request (config: ripeatlas_max_request_size)
+    :return: (list(list, list)) (definitions, probe ids) of each request
+    """
+    if max_definitions is None:
+        max_definitions = config_data.get('ripeatlas_max_definitions_per_request', 100)
+    if max_probes is None:
+        max_probes = config_data.get('ripeatlas_max_probes_per_request', 50)
+    if max_size is None:
+        max_size = config_data.get('ripeatlas_max_request_size', 50)
+    if len(measurements) == 0 or len(probe_ids) == 0:
+        return list()
+    best = None
+    # a chunk bigger than max_size wouldn't fit even a single definition
+    max_chunk = max(1, min(max_probes, max_size))
+    # try every number of (evenly sized) probe chunks, each paired with as many definitions as still fit
+    for num_chunks in xrange(-(-len(probe_ids) // max_chunk), len(probe_ids) + 1):
+        chunk = -(-len(probe_ids) // num_chunks)
+        per_request = max(1, min(max_definitions, len(measurements), max_size // chunk))
+        cost = -(-len(probe_ids) // chunk) * -(-len(measurements) // per_request)
+        if best is None or cost < best[0]:
+            best = (cost, chunk, per_request)
+        if per_request == min(max_definitions, len(measurements)):
+            # smaller chunks can't fit more definitions
+            break
+    _, chunk, per_request = best
+    requests = list()
+    for i in xrange(0, len(probe_ids), chunk):
+        for j in xrange(0, len(measurements), per_request):
+            requests.append((measurements[j:j+per_request], probe_ids[i:i+chunk]))
+    return requests
+
+
+# target -> time until which new measurements towards it are held off (None -> hold for every target); shared by
+# every LaunchScheduler, so back-to-back dispatches don't retry a target that was just rejected
+launch_cooldowns = dict()
+
+
+class LaunchScheduler(object):
+    """
+    submits (measurements, probe chunk) jobs (see pack_requests) from a ready queue, so that one throttled target
+    doesn't stall the rest:
+        - "same target" rejections hold off just that target for cooldown seconds; jobs for other targets keep going
+        (a rejected job with several targets is split up and retried, to find out which one was throttled)
+        - "more than" rejections (too many measurements at once) hold off every target
+        - requests are paced by a shared token bucket (create_limiter)
+    rejected jobs go back in the queue and are retried once their hold has passed
+    """
+    def __init__(self, cooldown=None, limiter=None, cooldowns=None, send=None, admission_control=None, **limits):
+        """
+        :param cooldown: (float) seconds to hold off after a rejection; defaults to ripeatlas_launch_cooldown (11
+        minutes)
+        :param limiter: (TokenBucket) defaults to create_limiter
+        :param cooldowns: (dict) hold off times to share; defaults to launch_cooldowns
+        :param send: function(probe_ids, measurements, **kwargs) -> (is_success, response); defaults to send_request
+        :param admission_control: (AdmissionControl) defaults to admission
+        :param limits: per request limits for pack_requests (max_definitions, max_probes, max_size)
+        """
+        self.limits = limits
+        self.cooldown = cooldown if cooldown is not None else config_data.get('ripeatlas_launch_cooldown', 11*60)
+        self.limiter = limiter if limiter is not None else create_limiter
+        self.cooldowns = cooldowns if cooldowns is not None else launch_cooldowns
+        self.send = send if send is not None else send_request
+        self.admission = admission_control if admission_control is not None else admission
+        self._queue = list()
+        self._order = itertools.count()
+        self.responses = list()
+        self.daily_limit_reached = False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def push(self, job, ready=0):
+        heapq.heappush(self._queue, (ready, next(self._order), job))
+
+    def add(self, measurements, probe_ids):
+        """
+        queues measurements to be launched on probe_ids, packed into as few requests as the limits allow
+        """
+        limits = dict(self.limits)
+        # every definition in a request is reserved at once, so a request can't hold more than admission allows
+        max_definitions = limits.get('max_definitions')
+        if max_definitions is None:
+            max_definitions = config_data.get('ripeatlas_max_definitions_per_request', 100)
+        limits['max_definitions'] = min(max_definitions, self.admission.max_batch)
+        for group, probes in pack_requests(measurements, probe_ids, **limits):
+            self.push((tuple([measurement_target(z) for z in group]), group, probes))
+
+    def hold_until(self, targets):
+        return max([self.cooldowns.get(z, 0) for z in targets] + [self.cooldowns.get(None, 0)])
+
+    def submit(self, job, **kwargs):
+        """
+        makes one creation request for job, and requeues it if it was throttled
+        """
+        targets, group, probe_ids = job
+        if not self.admission.acquire(len(group)):
+            logger.warning("holding off launches: daily measurement limit reached")
+            self.push(job)
+            self.daily_limit_reached = True
+            return
+        self.limiter.consume()
+        is_success, response = self.send(probe_ids, group, **kwargs)
         if is_success:
             logger.debug("deployed meas: "+str(response['measurements'][0]))
-            return is_success, False, response
+            self.admission.launched(response['measurements'], len(group))
+            self.responses.append(response)
+            return
+        self.admission.release(len(group))
+        err = json.dumps(response)
+        if "same target" in err and len(group) > 1:
+            logger.warning("same target fail, retrying definitions one by one: "+str(response))
+            for target, meas in zip(targets, group):
+                self.push(((target,), [meas], probe_ids))
+        elif "same target" in err:
+            logger.warning("same target fail, holding off "+str(targets[0])+": "+str(response))
+            self.cooldowns[targets[0]] = time.time() + self.cooldown
+            self.push(job, self.cooldowns[targets[0]])
+        elif "more than" in err:
+            logger.warning("too fast fail, holding off all targets: "+str(response))
+            self.admission.resync()
+            self.cooldowns[None] = time.time() + self.cooldown
+            self.push(job, self.cooldowns[None])
+        elif "daily" in err:
+            logger.warning("daily limit reached: "+str(response))
+            self.daily_limit_reached = True
         else:
-            logger.warning("failed to deploy: "+str(measurement)+"; "+str(response))
-            print str(measurement[0])
-            if "more than" in json.dumps(response) or "more than" in \
-                str(measurement[0]):
-                    return False, True, {}
-
-            return False, False, {}
-    else:
-        msms = deepcopy(measurement)
-        responses = list()
-        mpos = defaultdict(int)
-        jcounts = list()
-        while any([mpos[z] < len(probe_ids) for z in xrange(len(msms))]):
-            for i, meas in enumerate(msms):
-                fresh = True
-                j = mpos[i]
-                firstj = ('starting', str(datetime.datetime.now()), j)
-                while j < len(probe_ids):
-                    print("probe: "+str(j)+"; meas: "+str(i))
-                    is_success, response = send_request(probe_ids[j:j+50], [meas], **kwargs)
-                    if is_success:
-                        logger.debug("deployed meas: "+str(response['measurements'][0]))
-                        responses.append(response)
-                    else:
-                        print str(measurement[0])
-                        if "same target" in json.dumps(response):
-                            logger.warning("same target fail: "+str(measurement)+"; "+str(response))
-                            mpos[i] = j  # store index so we can continue from here later
-                            if fresh:
-                                print("sleeping...")
-                                sleep(11*60)
-                            lastj = ('same target break', str(datetime.datetime.now()), j)
-                            break  # break so we can move on to other doms while we wait
-                        elif "more than" in json.dumps(response):
-                            logger.warning("too fast fail: "+str(measurement)+"; "+str(response))
-                            mpos[i] = j
-                            print("sleeping...")
-                            sleep(11*60)
-                            lastj = ('more than break', str(datetime.datetime.now()), j)
-                            break
-                        elif "daily" in json.dumps(response):
-                            logger.warning("daily limit reached: "+str(measurement)+"; "+str(response))
-                            return True, False, responses
-                        else:
-                            logger.error("failed to launch meas "+str(response))
-                    lastj = ('more than break', str(datetime.datetime.now()), j)
-                    j += 50
-                    fresh = False
-                jcounts.append((firstj, lastj))
-            '''
-            with open('jcounts.json', 'w+') as f:
-                json.dump(jcounts, f)
-            '''
-        return True, False, responses
+            logger.error("failed to launch meas "+str(response))
+
+    def run(self, **kwargs):
+        """
+        submits queued jobs until the queue is empty (or the daily limit is reached), sleeping only when every
+        remaining job is held off
+        :param kwargs: passed on to send (e.g. start_time, key)
+        :return: (list) responses of the successful requests
+        """
+        while len(self._queue) > 0 and not self.daily_limit_reached:
+            ready, _, job = heapq.heappop(self._queue)
+            # holds may have been set (or extended) since the job was queued
+            ready = max(ready, self.hold_until(job[0]))
+            wait = ready - time.time()
+            if wait > 0:
+                if len(self._queue) > 0 and self._queue[0][0] < ready:
+                    self.push(job, ready)
+                    continue
+                logger.debug("every queued target is held off; sleeping "+str(int(wait))+"s")
+                sleep(wait)
+            self.submit(job, **kwargs)
+        return self.responses
+
+
+def launch_measurement(probe_ids, measurement, scheduler=None, **kwargs):
+    """
+    launches measurement on probe_ids through a LaunchScheduler, whatever the number of requests it packs into, so
+    every launch shares the same pacing (create_limiter), per target cooldowns and admission control
+    :param probe_ids: (list) probes to run every measurement on
+    :param measurement: (list) measurement definitions
+    :param scheduler: (LaunchScheduler) defaults to a new one with the shared settings
+    :param kwargs: passed on to send_request (e.g. start_time, key)
+    :return: (bool, bool, list) whether any request succeeded, whether launches stopped at the daily limit, and the
+    responses of the successful requests
+    """
+    if scheduler is None:
+        scheduler = LaunchScheduler()
+    scheduler.add(measurement, probe_ids)
+    responses = scheduler.run(**kwargs)
+    if len(responses) == 0:
+        logger.warning("failed to deploy: "+str(measurement))
+    return len(responses) > 0, scheduler.daily_limit_reached, responses
 
 
 def dispatch_measurement(clients, measdo, **kwargs):
     measurement = format_mdo(measdo)
     if measdo.get('meas_type') == 'ping':
         rfp = format_dirpath(config_data['data_path']+"/raw_data/ripe_atlas/"+nowstr()+"/ping")
-        rfp += measdo.get('label') + timestr(datetime.datetime.utcnow()) + ".json"
+        rfp += measdo.get('label') + timestr(datetime.datetime.utcnow()) + ".jsonl"
         res = ResultSet(platform='ripe_atlas', raw_file_path=rfp, label=measdo.get('label'), meas_type='ping', **kwargs)
     elif measdo.get('meas_type') == 'dns':
         rfp = format_dirpath(config_data['data_path']+"/raw_data/ripe_atlas/"+nowstr()+"/dns")
-        rfp += measdo.get('label') + timestr(datetime.datetime.utcnow()) + ".json"
+        rfp += measdo.get('label') + timestr(datetime.datetime.utcnow()) + ".jsonl"
         res = ResultSet(platform='ripe_atlas', raw_file_path=rfp, label=measdo.get('label'), meas_type='dns',
                         target_resolver=measdo.get('target_resolver'), **kwargs)
 
@@ -368,116 +747,207 @@ def dispatch_measurement(clients, measdo, **kwargs):
 ##############################################################################
 
 
-def ping_retrieval_func(collector):
-    allresults = dict()
-    probe_ids = collector.measro.get('probe_ids')
-    raw_file_path = collector.measro.get('raw_file_path')
-    all_ids = collector.measro.get('running_msm_ids')
-    running_msm_ids = set(deepcopy(all_ids))
-    attempts = defaultdict(int)
-    max_attempts = max([1, (collector.timeout / collector.spin_time)])
-    things_left = len(running_msm_ids)
-    while things_left > 0:
-        for msm_id in all_ids:
-            if msm_id in running_msm_ids:
-                attempts[msm_id] += 1
-                kwargs = {
-                    'msm_id': msm_id,
-                    'probe_ids': probe_ids
-                }
-                is_success, results = rac.AtlasResultsRequest(**kwargs).create()
-                if attempts[msm_id] < max_attempts:
-                    meas = rac.Measurement(id=msm_id)
-                    if meas.status_id in range(5, 8):  # give up if there was an error
-                        running_msm_ids.remove(msm_id)  # we don't need to check it again if it's err'd
-                        allresults[msm_id] = {
-                            'result':None,
-                            'err': results
-                        }
-                    elif len(results) == len(probe_ids):  # finish if all results have been obtained
-                        running_msm_ids.remove(msm_id)  # we don't need to check it again if it's done
-                        allresults[msm_id] = {
-                            'result': results,
-                            'err': None
-                        }
-                    else:
-                        allresults[msm_id] = {
-                            'result': results,
-                            'err': None
-                        }
-                else:
-                    running_msm_ids.remove(msm_id)  # if we've made the max attempts, give up
-                    allresults[msm_id] = {
-                        'result': results,
-                        'err': None
-                    }
-        things_left = len(running_msm_ids)
-        if things_left > 0:
-            collector.time_elapsed += collector.spin_time
-            sleep(collector.spin_time)
+# measurement status ids (see the measurements API): stopped or archived measurements won't get any more results,
+# and measurements that were forced to stop, found no suitable probes or failed are given up on as errors
+finished_statuses = (4, 8)
+error_statuses = (5, 6, 7)
 
-    # format for output to collector
-    res = list()
-    errs = list()
-    for msm_id in all_ids:
-        if msm_id in allresults:
-            res.append(allresults[msm_id]['result'])
-            errs.append(allresults[msm_id]['err'])
-        else:
-            res.append(None)
-            errs.append({'err': 'no result...'})
-    with open(raw_file_path, "w+") as f:
-        json.dump(res, f)
-    return True, res, errs
+poll_pool = None
 
 
-def dns_retrieval_func(collector):
-    allresults = dict()
-    probe_ids = collector.measro.get('probe_ids')
-    raw_file_path = collector.measro.get('raw_file_path')
+def get_poll_pool():
+    """
+    :return: (ThreadPool) pool shared by every poll_results call, created on first use
+    """
+    global poll_pool
+    if poll_pool is None:
+        poll_pool = ThreadPool(config_data.get('ripeatlas_poll_workers', 64))
+    return poll_pool
+
+
+def poll_request(job):
+    """
+    makes one (rate limited) API call for poll_results
+    :param job: (tuple) ('status', msm_id) or ('results', msm_id, probe_ids, start); start (unix time) may be None
+    :return: the measurement's status id or list of results, or None if the call failed
+    """
+    api_limiter.consume()
+    try:
+        if job[0] == 'status':
+            return rac.Measurement(id=job[1]).status_id
+        kwargs = {
+            'msm_id': job[1],
+            'probe_ids': job[2]
+        }
+        if job[3] is not None:
+            kwargs['start'] = datetime.datetime.utcfromtimestamp(job[3])
+        is_success, results = rac.AtlasResultsRequest(**kwargs).create()
+        if is_success:
+            return results
+        logger.warning("failed to fetch results for "+str(job[1])+": "+str(results))
+    except Exception as e:
+        logger.warning("failed to poll "+str(job[1])+": "+str(e))
+    return None
+
+
+def results_job(state, msm_id, probe_ids, is_oneoff):
+    """
+    :return: (tuple) poll_request job that only asks for results of msm_id that haven't been merged yet: the results
+    of probes that haven't reported (one-off measurements), or results since the latest one seen (otherwise); None
+    if there's nothing left to ask for
+    """
+    if len(state['seen'][msm_id]) == 0:
+        return 'results', msm_id, probe_ids, None
+    if is_oneoff:
+        reported = state['reported'][msm_id]
+        missing = [z for z in probe_ids if z not in reported]
+        # NOTE: an empty probe_ids filter would fetch every probe's results
+        return ('results', msm_id, missing, None) if len(missing) > 0 else None
+    return 'results', msm_id, probe_ids, state['latest'][msm_id]
+
+
+def merge_results(state, msm_id, results):
+    """
+    adds the results that haven't been seen yet (by (prb_id, timestamp)) to those merged for msm_id
+    :return: (list) the results that were added
+    """
+    seen = state['seen'][msm_id]
+    added = list()
+    for result in results:
+        key = (result.get('prb_id'), result.get('timestamp'))
+        if key in seen:
+            continue
+        seen.add(key)
+        added.append(result)
+        state['reported'][msm_id].add(key[0])
+        if key[1] is not None and key[1] > state['latest'].get(msm_id, 0):
+            state['latest'][msm_id] = key[1]
+    if state['keep_raw']:
+        state['merged'][msm_id] += added
+    return added
+
+
+def stream_results(collector, results):
+    """
+    parses results and adds them to the collector's measro right away, if its results are being streamed
+    """
+    if not collector.poll_state['streaming'] or len(results) == 0:
+        return
+    parser = result_parsers[collector.measro.get('meas_type')]
+    parsed = list()
+    for result in results:
+        try:
+            parsed.append(parser(result))
+        except Exception as e:
+            logger.warning("failed to parse result from probe "+str(result.get('prb_id'))+": "+str(e))
+    collector.measro.append_batch(parsed)
+
+
+def resume_poll_state(collector, all_ids, raw_file_path):
+    """
+    merges the results already persisted to raw_file_path (by an earlier, interrupted collector) into the collector's
+    poll_state, so only the missing results are fetched again
+    """
+    state = collector.poll_state
+    resumed = list()
+    for result in read_jsonl(raw_file_path):
+        msm_id = result.get('msm_id')
+        if msm_id in all_ids:
+            resumed += merge_results(state, msm_id, [result])
+            state['allresults'][msm_id] = {
+                'result': state['merged'][msm_id],
+                'err': None
+            }
+    stream_results(collector, resumed)
+    if len(resumed) > 0:
+        logger.info("resumed "+str(len(resumed))+" results from "+raw_file_path)
+
+
+def poll_results(collector):
+    """
+    makes one pass over the collector's running measurements: the status and results of every one of them are
+    fetched concurrently (each call waiting on api_limiter), and measurements whose status is final, or that have
+    results for every probe, aren't polled again. Only results that haven't been seen are requested (see results_job)
+    and merged in (see merge_results); progress is kept in collector.poll_state between passes
+
+    the new results of every pass are appended to the measro's raw_file_path in a single write at the end of the pass;
+    the file is JSON Lines (one raw result per line, hence the .jsonl suffix dispatch_measurement gives it), and a new
+    collector for the same measro picks up from whatever that file already holds (see read_jsonl for older .json files)
+
+    if the measro has a file_path (and supports streaming, like ResultSet), each batch is also parsed and streamed to
+    it once per pass (see ResultSet.open_stream), and results_callback only has to close the stream; set
+    keep_streamed_results to false in config.json to also drop the results from memory once they're written
+    :param collector: (SpinningCollector)
+    :return: (bool, list, list) whether every measurement has finished (or been given up on), then the results and
+    errors so far for each msm id
+    """
     all_ids = collector.measro.get('running_msm_ids')
-    running_msm_ids = set(deepcopy(all_ids))
-    attempts = defaultdict(int)
+    state = getattr(collector, 'poll_state', None)
+    if state is None:
+        state = {
+            'allresults': dict(),
+            'running_msm_ids': set(all_ids),
+            'attempts': defaultdict(int),
+            'seen': defaultdict(set),
+            'reported': defaultdict(set),
+            'merged': defaultdict(list),
+            'latest': dict(),
+            'sink': JsonLinesSink(collector.measro.get('raw_file_path')),
+            'streaming': False,
+            'keep_raw': True
+        }
+        collector.poll_state = state
+        if hasattr(collector.measro, 'open_stream') and getattr(collector.measro, 'file_path', None) is not None:
+            keep = config_data.get('keep_streamed_results', True)
+            collector.measro.open_stream(keep_results=keep)
+            state['streaming'] = True
+            state['keep_raw'] = keep
+        resume_poll_state(collector, all_ids, collector.measro.get('raw_file_path'))
+    allresults = state['allresults']
+    running_msm_ids = state['running_msm_ids']
+    attempts = state['attempts']
+    probe_ids = collector.measro.get('probe_ids')
     max_attempts = max([1, (collector.timeout / collector.spin_time)])
-    things_left = len(running_msm_ids)
-    while things_left > 0:
-        for msm_id in all_ids:
-            if msm_id in running_msm_ids:
-                attempts[msm_id] += 1
-                kwargs = {
-                    'msm_id': msm_id,
-                    'probe_ids': probe_ids
-                }
-                is_success, results = rac.AtlasResultsRequest(**kwargs).create()
-                if attempts[msm_id] < max_attempts:
-                    meas = rac.Measurement(id=msm_id)
-                    if meas.status_id in range(5, 8):  # give up if there was an error
-                        running_msm_ids.remove(msm_id)  # we don't need to check it again if it's err'd
-                        allresults[msm_id] = {
-                            'result':None,
-                            'err': results
-                        }
-                    elif len(results) == len(probe_ids):  # finish if all results have been obtained
-                        running_msm_ids.remove(msm_id)  # we don't need to check it again if it's done
-                        allresults[msm_id] = {
-                            'result': results,
-                            'err': None
-                        }
-                    else:
-                        allresults[msm_id] = {
-                            'result': results,
-                            'err': None
-                        }
-                else:
-                    running_msm_ids.remove(msm_id)  # if we've made the max attempts, give up
-                    allresults[msm_id] = {
-                        'result': results,
-                        'err': None
-                    }
-        things_left = len(running_msm_ids)
-        if things_left > 0:
-            collector.time_elapsed += collector.spin_time
-            sleep(collector.spin_time)
+    is_oneoff = getattr(collector.measro, 'is_oneoff', True)
+
+    running = [z for z in all_ids if z in running_msm_ids]
+    for msm_id in running:
+        attempts[msm_id] += 1
+    jobs = [results_job(state, z, probe_ids, is_oneoff) for z in running]
+    fetched = [z for z, job in zip(running, jobs) if job is not None]
+    # no need to check the status on the last attempt; we give up either way
+    checked = [z for z in running if attempts[z] < max_attempts]
+    answers = get_poll_pool().map(poll_request, [z for z in jobs if z is not None] + [('status', z) for z in checked])
+    new_results = dict(zip(fetched, answers[:len(fetched)]))
+    statuses = dict(zip(checked, answers[len(fetched):]))
+    # new results of every measurement in this pass, written (and fsynced) once
+    batch = list()
+    for msm_id in running:
+        status = statuses.get(msm_id)
+        results = new_results.get(msm_id, list())
+        if results is not None:
+            batch += merge_results(state, msm_id, results)
+        if status in error_statuses:
+            running_msm_ids.remove(msm_id)  # we don't need to check it again if it's err'd
+            admission.completed(msm_id)
+            # whatever it returned before failing is still written out with this pass's batch
+            allresults[msm_id] = {
+                'result': None,
+                'err': {'err': 'measurement status '+str(status), 'result': state['merged'][msm_id]}
+            }
+            continue
+        if results is not None:
+            allresults[msm_id] = {
+                'result': state['merged'][msm_id],
+                'err': None
+            }
+        if msm_id not in checked or status in finished_statuses or \
+                len(state['reported'][msm_id]) >= len(probe_ids):
+            running_msm_ids.remove(msm_id)  # we don't need to check it again if it's done (or out of attempts)
+            admission.completed(msm_id)
+    if len(batch) > 0:
+        state['sink'].append(batch)
+        stream_results(collector, batch)
 
     # format for output to collector
     res = list()
@@ -489,44 +959,83 @@ def dns_retrieval_func(collector):
         else:
             res.append(None)
             errs.append({'err': 'no result...'})
-    with open(raw_file_path, "w+") as f:
-        json.dump(res, f)
+    if len(running_msm_ids) > 0:
+        return False, res, errs
+    state['sink'].close()
     return True, res, errs
 
 
-def ping_callback(collector):
+def ping_retrieval_func(collector):
+    return poll_results(collector)
+
+
+def dns_retrieval_func(collector):
+    return poll_results(collector)
+
+
+def results_callback(collector):
+    """
+    appends every retrieved result to the collector's measro (converted with the parser for its meas_type, see
+    result_parsers) and saves it
+    """
+    state = getattr(collector, 'poll_state', None)
+    if state is not None:
+        state['sink'].close()
+        if state['streaming']:
+            # results were parsed and saved as they arrived
+            for err in collector.get('err'):
+                if err is not None:
+                    logger.warning(str(err))
+            collector.measro.close_stream()
+            return
+    parser = result_parsers[collector.measro.get('meas_type')]
     for results, err in zip(collector.get('result_data'), collector.get('err')):
         if err is None:
             for res in results:
-                collector.measro.append(format_ping_result(res))
+                collector.measro.append(parser(res))
         else:
             logger.warning(str(err))
     collector.measro.save_json()
 
 
+def ping_callback(collector):
+    results_callback(collector)
+
+
 def dns_callback(collector):
-    for results, err in zip(collector.get('result_data'), collector.get('err')):
-        if err is None:
-            for res in results:
-                collector.measro.append(format_dns_result(res))
-        else:
-            logger.warning(str(err))
-    collector.measro.save_json()
+    results_callback(collector)
 
 
 def format_ping_result(raw_ping_data):
+    if compact_models:
+        return CompactPingResult(platform='ripe_atlas', **raw_ping_data)
     return PingResult(platform='ripe_atlas', **raw_ping_data)
 
 
 def format_dns_result(rawdat):
+    if compact_models:
+        return CompactDNSResult(platform='ripe_atlas', **rawdat)
     return DNSResult(platform='ripe_atlas', **rawdat)
 
 
-def get_active_count(mykey=None):
+# meas_type -> function converting one raw result into a result object
+result_parsers = {
+    'ping': format_ping_result,
+    'dns': format_dns_result,
+}
+
+
+def get_active_count(mykey=None, statuses=(0, 1, 2)):
+    """
+    :param statuses: (tuple) measurement statuses to count; just created measurements stay specified (0) until
+    they're scheduled, but already count against the concurrent limit
+    :return: (int) number of the account's measurements in statuses, or -1 if the request failed
+    """
     if mykey is None:
         mykey = config_data['ripeatlas_schedule_meas_key']
-    url_path = '/api/v2/measurements/my/?key='+mykey+'&status=1,2'
+    url_path = '/api/v2/measurements/my/?key='+mykey+'&status='+','.join([str(z) for z in statuses])
     request = rac.AtlasRequest(**{"url_path": url_path})
+    api_limiter.consume()
     is_success, results = request.get()
     if is_success:
         return results['count']
@@ -534,4 +1043,3 @@ def get_active_count(mykey=None):
         print results, mykey
         return -1
 
-
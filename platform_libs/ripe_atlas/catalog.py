@@ -0,0 +1,286 @@
+import json
+import time
+import itertools
+import sqlite3
+import hashlib
+import threading
+import ripe.atlas.cousteau as rac
+from IPy import IP
+from ...helpers import logger, format_dirpath, config_data
+from ...prefixes import ip_to_int, PrefixIndex
+from ...geocoding import haversine
+
+"""
+local snapshot of the RIPE Atlas probe list, so that probe selection is a local (indexed) query instead of a set of
+paginated API calls
+"""
+
+# probe fields that change on (nearly) every refresh without the probe itself changing; ignored when deciding
+# whether a stored probe needs to be rewritten
+volatile_fields = ('last_connected', 'total_uptime')
+# sqlite allows at most 999 bound parameters per statement, so longer IN lists are matched through temp tables
+max_inline_params = 100
+# probes per id__in request when rechecking probes that dropped out of the connected list
+recheck_batch = 200
+
+
+def probe_digest(probe):
+    stable = dict((k, probe[k]) for k in probe if k not in volatile_fields)
+    return hashlib.md5(json.dumps(stable, sort_keys=True, default=str)).hexdigest()
+
+
+def probe_row(probe, now):
+    """
+    :param probe: (dict) probe, as returned by the probes API
+    :return: (tuple) values for a row of the probes table
+    """
+    status = probe.get('status') or dict()
+    lat, lon = None, None
+    geometry = probe.get('geometry') or dict()
+    if geometry.get('coordinates') is not None:
+        lon, lat = geometry['coordinates'][:2]
+    v4_int = None
+    if probe.get('address_v4') is not None:
+        try:
+            v4_int = ip_to_int(probe['address_v4'])[1]
+        except Exception:
+            logger.debug("unparseable address_v4 for probe "+str(probe.get('id')))
+    return (probe['id'], status.get('name'), int(bool(probe.get('is_public'))), int(bool(probe.get('is_anchor'))),
+            probe.get('country_code'), probe.get('asn_v4'), probe.get('asn_v6'), probe.get('address_v4'), v4_int,
+            probe.get('address_v6'), lat, lon, probe_digest(probe), now, json.dumps(probe, default=str))
+
+
+class ProbeCatalog(object):
+    """
+    on-disk (sqlite) catalog of RIPE Atlas probes, indexed by status, country, ASN, address and coordinates
+    """
+    def __init__(self, db_path=None, max_age=24*3600, full_max_age=7*24*3600, fetch=None):
+        """
+        :param db_path: (str) path to the sqlite file; if None, defaults to <data_path>/state_data/probe_catalog.db
+        (created on first use)
+        :param max_age: (int) seconds after a refresh before refresh_if_stale() refreshes again
+        :param full_max_age: (int) seconds after a full refresh before refresh() does another one, rather than an
+        incremental one
+        :param fetch: function(**filters) -> iter(dict) probes from the probes API; defaults to rac.ProbeRequest
+        """
+        self.db_path = db_path
+        self.max_age = max_age
+        self.full_max_age = full_max_age
+        self.fetch = fetch if fetch is not None else rac.ProbeRequest
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            if self.db_path is None:
+                self.db_path = format_dirpath(config_data['data_path']+"/state_data/")+"probe_catalog.db"
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS probes (id INTEGER PRIMARY KEY, status_name TEXT, "
+                               "is_public INTEGER, is_anchor INTEGER, country_code TEXT, asn_v4 INTEGER, "
+                               "asn_v6 INTEGER, address_v4 TEXT, address_v4_int INTEGER, address_v6 TEXT, "
+                               "latitude REAL, longitude REAL, digest TEXT, updated REAL, probe TEXT)")
+            for col in ('status_name', 'country_code', 'asn_v4', 'asn_v6', 'address_v4_int', 'latitude'):
+                self._conn.execute("CREATE INDEX IF NOT EXISTS probes_"+col+" ON probes ("+col+")")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.commit()
+        return self._conn
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set_meta(self, key, val):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(val)))
+            self.conn.commit()
+
+    def max_id(self):
+        with self._lock:
+            return self.conn.execute("SELECT MAX(id) FROM probes").fetchone()[0] or 0
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+
+    def update(self, probes):
+        """
+        stores probes, rewriting only the ones that are new or have changed since they were last stored
+        :param probes: (iter) probe dicts, as returned by the probes API
+        :return: (dict) number of probes 'added', 'changed' and 'unchanged'
+        """
+        now = time.time()
+        counts = {'added': 0, 'changed': 0, 'unchanged': 0}
+        with self._lock:
+            digests = dict(self.conn.execute("SELECT id, digest FROM probes"))
+            rows = list()
+            for probe in probes:
+                row = probe_row(probe, now)
+                if row[0] not in digests:
+                    counts['added'] += 1
+                elif digests[row[0]] != row[12]:
+                    counts['changed'] += 1
+                else:
+                    counts['unchanged'] += 1
+                    continue
+                rows.append(row)
+            self.conn.executemany("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  rows)
+            self.conn.commit()
+        return counts
+
+    def refresh(self, new_only=False, full=None, **kwargs):
+        """
+        pulls probes from the API and applies them with update(); unless told otherwise, only what selection needs
+        kept current is fetched (see refresh_incremental), and the whole list is only pulled every full_max_age
+        :param new_only: (bool) only fetch probes with ids above the highest one already in the catalog (cheap top up;
+        doesn't pick up changes to known probes)
+        :param full: (bool) True to fetch every probe, False for an incremental refresh; None picks based on
+        full_max_age
+        :param kwargs: passed on to fetch as filters (fetches just the matching probes)
+        :return: (dict) see update()
+        """
+        if new_only:
+            kwargs['id__gt'] = self.max_id()
+        if len(kwargs) > 0:
+            return self.update(self.fetch(**kwargs))
+        started = time.time()
+        if full is None:
+            last_full = self.get_meta('last_full_refresh')
+            full = last_full is None or started - last_full > self.full_max_age
+        if full:
+            counts = self.update(self.fetch())
+            self.set_meta('last_full_refresh', started)
+        else:
+            counts = self.refresh_incremental()
+        self.set_meta('last_refresh', started)
+        logger.info("refreshed probe catalog ("+("full" if full else "incremental")+"): "+json.dumps(counts))
+        return counts
+
+    def refresh_incremental(self):
+        """
+        fetches the connected probes, any new ones, and (in batches, by id) the stored connected probes that are no
+        longer in the connected list; most probes in the API are disconnected or abandoned and rarely change, so this
+        is a fraction of a full download
+        :return: (dict) see update()
+        """
+        with self._lock:
+            was_connected = set([z[0] for z in self.conn.execute("SELECT id FROM probes WHERE status_name=?",
+                                                                    ('Connected',))])
+        max_id = self.max_id()
+        seen = set()
+        dropped = list()
+
+        def probes():
+            for probe in itertools.chain(self.fetch(status=1), self.fetch(id__gt=max_id)):
+                if probe['id'] not in seen:
+                    seen.add(probe['id'])
+                    yield probe
+            dropped.extend(sorted(was_connected - seen))
+            for i in xrange(0, len(dropped), recheck_batch):
+                for probe in self.fetch(id__in=','.join([str(z) for z in dropped[i:i+recheck_batch]])):
+                    seen.add(probe['id'])
+                    yield probe
+
+        counts = self.update(probes())
+        gone = [z for z in dropped if z not in seen]
+        if len(gone) > 0:
+            # no longer returned by the API at all
+            with self._lock:
+                self.conn.executemany("UPDATE probes SET status_name=NULL WHERE id=?", [(z,) for z in gone])
+                self.conn.commit()
+        return counts
+
+    def is_stale(self):
+        last = self.get_meta('last_refresh')
+        return last is None or time.time() - last > self.max_age
+
+    def refresh_if_stale(self):
+        if self.is_stale():
+            return self.refresh()
+
+    def query(self, status_name='Connected', is_public=True, countries=None, v4_asns=None, v6_asns=None,
+              coordinate_circle=None, ipv4_subnet=None, ipv6_subnet=None, ids=None):
+        """
+        :param status_name: (str) required probe status (None for any)
+        :param is_public: (bool) required probe visibility (None for any)
+        :param countries: (list(str)) 2 char country codes
+        :param v4_asns: (list(int))
+        :param v6_asns: (list(int))
+        :param coordinate_circle: (dict) {'coordinates': (lat, long), 'radius': km}; distance is great circle
+        :param ipv4_subnet: (str, IPy.IP or list) prefix or prefixes the probe's IPv4 address must fall in
+        :param ipv6_subnet: (str, IPy.IP or list) prefix or prefixes the probe's IPv6 address must fall in
+        :param ids: (list(int)) probe ids
+        :return: (list(dict)) matching probes, as returned by the probes API, in id order
+        """
+        clauses, params, in_lists = list(), list(), list()
+        if status_name is not None:
+            clauses.append("status_name=?")
+            params.append(status_name)
+        if is_public is not None:
+            clauses.append("is_public=?")
+            params.append(int(bool(is_public)))
+        for col, vals in (('country_code', countries), ('asn_v4', v4_asns), ('asn_v6', v6_asns), ('id', ids)):
+            if vals is not None:
+                vals = list(vals)
+                if len(vals) > max_inline_params:
+                    in_lists.append((col, vals))
+                    clauses.append(col+" IN (SELECT val FROM temp.query_"+col+")")
+                else:
+                    clauses.append(col+" IN ("+", ".join(["?"]*len(vals))+")")
+                    params += vals
+        if coordinate_circle is not None:
+            lat, lon = coordinate_circle['coordinates']
+            # bounding box on latitude only (the index); longitude is checked exactly below
+            dlat = coordinate_circle['radius'] / 111.0 + 0.01
+            clauses.append("latitude BETWEEN ? AND ?")
+            params += [lat - dlat, lat + dlat]
+        v4_index = self.subnet_index(ipv4_subnet)
+        if v4_index is not None and len(v4_index) <= 100:
+            # a handful of prefixes are cheapest as index range scans
+            ranges = list(v4_index.intervals(4))
+            clauses.append("("+" OR ".join(["address_v4_int BETWEEN ? AND ?"]*len(ranges))+")")
+            params += [z for r in ranges for z in r]
+            v4_index = None
+        sql = "SELECT address_v4_int, address_v6, latitude, longitude, probe FROM probes"
+        if len(clauses) > 0:
+            sql += " WHERE "+" AND ".join(clauses)
+        with self._lock:
+            for col, vals in in_lists:
+                self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS query_"+col+" (val PRIMARY KEY)")
+                self.conn.execute("DELETE FROM temp.query_"+col)
+                self.conn.executemany("INSERT OR IGNORE INTO temp.query_"+col+" VALUES (?)", [(z,) for z in vals])
+            rows = self.conn.execute(sql+" ORDER BY id", params).fetchall()
+        if v4_index is not None:
+            rows = [z for z, i in zip(rows, v4_index.lookup_ints([-1 if r[0] is None else r[0] for r in rows]))
+                    if i >= 0]
+        v6_index = self.subnet_index(ipv6_subnet)
+        if v6_index is not None:
+            rows = [z for z in rows if z[1] is not None and z[1] in v6_index]
+        if coordinate_circle is not None:
+            lat, lon = coordinate_circle['coordinates']
+            rows = [z for z in rows if z[2] is not None and
+                    haversine(lat, lon, z[2], z[3]) <= coordinate_circle['radius']]
+        return [json.loads(z[4]) for z in rows]
+
+    @staticmethod
+    def subnet_index(subnets):
+        if subnets is None:
+            return None
+        if isinstance(subnets, (str, type(u''), IP)):
+            subnets = [subnets]
+        index = PrefixIndex([(IP(z, make_net=True), True) for z in subnets])
+        index.build()
+        return index
+
+    def query_TargetLocation(self, tl, **kwargs):
+        """
+        :param tl: (TargetLocation)
+        :param kwargs: passed on to query (e.g. status_name, is_public)
+        :return: (list(dict)) probes matching tl
+        """
+        for member in ('countries', 'v4_asns', 'v6_asns', 'coordinate_circle', 'ipv4_subnet', 'ipv6_subnet'):
+            if hasattr(tl, member):
+                kwargs[member] = tl.get(member)
+        return self.query(**kwargs)
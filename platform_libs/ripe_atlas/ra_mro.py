@@ -1,8 +1,9 @@
 from ...mms import mro
-import dns.message
-import base64
 
-class PingResult(mro.PingResult):
+class PingFormat(object):
+    """maps RIPE Atlas ping result fields onto (Compact)PingResult members"""
+    __slots__ = ()
+
     def set_from(self, addr):
         self.src_addr = addr
 
@@ -24,7 +25,19 @@ class PingResult(mro.PingResult):
         self.num_returned = count
 
 
-class DNSResult(mro.DNSResult):
+class PingResult(PingFormat, mro.PingResult):
+    pass
+
+
+class CompactPingResult(PingFormat, mro.CompactPingResult):
+    __slots__ = ('fw', 'lts', 'proto', 'type', 'step', 'group_id', 'stored_timestamp', 'msm_name', 'min', 'max', 'avg',
+                 'dup')
+
+
+class DNSFormat(object):
+    """maps RIPE Atlas DNS result fields onto (Compact)DNSResult members"""
+    __slots__ = ()
+
     def set_from(self, addr):
         self.src_addr = addr
 
@@ -60,10 +73,16 @@ class DNSResult(mro.DNSResult):
 
     def set_qbuf(self, qbuf):
         self.raw_query = qbuf
-        d = dns.message.from_wire(base64.b64decode(qbuf))
-        if hasattr(d, 'question'):
-            self.query_domain = d.question[0].name.to_text()
-            self.query_type = mro.rr_types[d.question[0].rdtype]
+        self.extract_query()
 
     def set_rt(self, rt):
         self.response_time = rt
+
+
+class DNSResult(DNSFormat, mro.DNSResult):
+    pass
+
+
+class CompactDNSResult(DNSFormat, mro.CompactDNSResult):
+    __slots__ = ('local_resolver_name', 'resolver', 'fw', 'lts', 'type', 'group_id', 'stored_timestamp', 'msm_name',
+                 'size', 'ID', 'ANCOUNT', 'ARCOUNT', 'NSCOUNT', 'QDCOUNT')
@@ -0,0 +1,229 @@
+import socket
+import struct
+import gzip
+from bisect import bisect_right
+import numpy as np
+from helpers import logger
+
+"""
+offline IP prefix tables (e.g. prefix -> origin AS) with longest prefix match lookups
+
+prefixes are flattened into sorted, non-overlapping integer intervals (one list per address family)
+so that a lookup is a single binary search, no matter how deeply the original prefixes were nested
+"""
+
+MAXBITS = {4: 32, 6: 128}
+
+
+def ip_to_int(ip):
+    """
+    :param ip: (str or IPy.IP) IPv4 or IPv6 address
+    :return: (int, int) address family (4 or 6), integer value of the address
+    """
+    if hasattr(ip, 'int') and hasattr(ip, 'version'):
+        return ip.version(), ip.int()
+    ip = str(ip)
+    if ':' in ip:
+        hi, lo = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, ip))
+        return 6, (hi << 64) | lo
+    return 4, struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def cidr_to_range(cidr):
+    """
+    :param cidr: (str or IPy.IP) prefix, as 'addr/len' (a bare address is treated as a host prefix)
+    :return: (int, int, int, int) address family, first address, last address, prefix length
+    """
+    if hasattr(cidr, 'prefixlen') and hasattr(cidr, 'len'):
+        return cidr.version(), cidr.int(), cidr.int() + cidr.len() - 1, cidr.prefixlen()
+    parts = str(cidr).strip().split('/')
+    af, addr = ip_to_int(parts[0])
+    bits = MAXBITS[af]
+    masklen = int(parts[1]) if len(parts) > 1 else bits
+    hostmask = (1 << (bits - masklen)) - 1
+    start = addr & ~hostmask
+    return af, start, start | hostmask, masklen
+
+
+class PrefixIndex(object):
+    """longest prefix match table mapping IP prefixes to arbitrary values"""
+    def __init__(self, prefixes=None):
+        """
+        :param prefixes: (iter) optional (prefix, value) pairs to load; see add()
+        """
+        self._pending = {4: list(), 6: list()}
+        self._starts = {4: list(), 6: list()}
+        self._ends = {4: list(), 6: list()}
+        self._values = {4: list(), 6: list()}
+        self._np_starts = None
+        self._np_ends = None
+        self._dirty = False
+        self.prefix_count = 0
+        if prefixes is not None:
+            for prefix, value in prefixes:
+                self.add(prefix, value)
+
+    def add(self, prefix, value=True):
+        """
+        :param prefix: (str or IPy.IP) prefix, as 'addr/len'
+        :param value: value returned by lookups that match this prefix (and no more specific one)
+        """
+        af, start, end, masklen = cidr_to_range(prefix)
+        self._pending[af].append((start, masklen, end, value))
+        self.prefix_count += 1
+        self._dirty = True
+
+    def build(self):
+        """flattens added prefixes into disjoint intervals; called automatically before lookups"""
+        for af in (4, 6):
+            # less specific prefixes first, so more specific ones are pushed above them on the stack
+            prefixes = sorted(self._pending[af], key=lambda z: (z[0], z[1]))
+            starts, ends, values = list(), list(), list()
+
+            def emit(s, e, v):
+                if s > e:
+                    return
+                if len(ends) > 0 and ends[-1] == s - 1 and values[-1] == v:
+                    ends[-1] = e
+                else:
+                    starts.append(s)
+                    ends.append(e)
+                    values.append(v)
+
+            stack = list()
+            cur = 0
+            for start, masklen, end, value in prefixes:
+                while len(stack) > 0 and stack[-1][0] < start:
+                    e, v = stack.pop()
+                    emit(cur, e, v)
+                    cur = max(cur, e + 1)
+                if len(stack) > 0:
+                    emit(cur, start - 1, stack[-1][1])
+                stack.append((end, value))
+                cur = start
+            while len(stack) > 0:
+                e, v = stack.pop()
+                emit(cur, e, v)
+                cur = max(cur, e + 1)
+            self._starts[af], self._ends[af], self._values[af] = starts, ends, values
+        self._np_starts = np.asarray(self._starts[4], dtype=np.int64)
+        self._np_ends = np.asarray(self._ends[4], dtype=np.int64)
+        self._dirty = False
+
+    def lookup(self, ip):
+        """
+        :param ip: (str or IPy.IP) address to look up
+        :return: value of the longest matching prefix, or None if no prefix matches
+        """
+        if self._dirty:
+            self.build()
+        af, val = ip_to_int(ip)
+        i = bisect_right(self._starts[af], val) - 1
+        if i >= 0 and val <= self._ends[af][i]:
+            return self._values[af][i]
+        return None
+
+    def lookup_ints(self, vals):
+        """
+        vectorized lookup for IPv4 addresses
+
+        :param vals: (array-like) integer IPv4 addresses
+        :return: (numpy.ndarray) index into the flattened interval table for each address (-1 if unmatched);
+        use values_at() to turn these into lookup values
+        """
+        if self._dirty:
+            self.build()
+        vals = np.asarray(vals, dtype=np.int64)
+        inds = np.searchsorted(self._np_starts, vals, side='right') - 1
+        found = inds >= 0
+        found[found] = vals[found] <= self._np_ends[inds[found]]
+        inds[~found] = -1
+        return inds
+
+    def intervals(self, af=4):
+        """
+        :return: (list(tuple(int, int))) the flattened, disjoint (first address, last address) intervals for af
+        """
+        if self._dirty:
+            self.build()
+        return zip(self._starts[af], self._ends[af])
+
+    def values_at(self, inds, af=4):
+        values = self._values[af]
+        return [values[i] if i >= 0 else None for i in inds]
+
+    def lookup_many(self, ips):
+        """
+        :param ips: (iter) addresses (str or IPy.IP); IPv4 addresses are resolved in one vectorized pass
+        :return: (list) lookup result for each address, in order
+        """
+        if self._dirty:
+            self.build()
+        ips = list(ips)
+        out = [None] * len(ips)
+        v4pos, v4vals = list(), list()
+        for pos, ip in enumerate(ips):
+            if ip is None:
+                continue
+            af, val = ip_to_int(ip)
+            if af == 4:
+                v4pos.append(pos)
+                v4vals.append(val)
+            else:
+                out[pos] = self.lookup(ip)
+        for pos, value in zip(v4pos, self.values_at(self.lookup_ints(v4vals))):
+            out[pos] = value
+        return out
+
+    def __contains__(self, ip):
+        return self.lookup(ip) is not None
+
+    def __len__(self):
+        return self.prefix_count
+
+
+def parse_origin_asn(field):
+    """
+    :param field: (str) origin AS field; multi-origin (e.g. '123_456') and AS set (e.g. '{123,456}') entries
+    resolve to their first AS
+    :return: (int) ASN
+    """
+    for sep in ('_', ','):
+        field = field.split(sep)[0]
+    return int(field.strip('{}'))
+
+
+def load_pfx2as(path):
+    """
+    :param path: (str) path to a prefix -> AS table (optionally gzipped); each line may be in any of
+    the following formats:
+        CAIDA pfx2as:       <addr>\t<masklen>\t<asn>
+        plain:              <addr>/<masklen> <asn>
+        bgpdump -m (RIB):   TABLE_DUMP2|<time>|B|<peer>|<peer as>|<prefix>|<as path>|...
+    :return: (PrefixIndex) table mapping prefix -> origin ASN (int)
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    index = PrefixIndex()
+    skipped = 0
+    with opener(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            try:
+                if '|' in line:
+                    fields = line.split('|')
+                    prefix, asn = fields[5], parse_origin_asn(fields[6].split()[-1])
+                else:
+                    fields = line.split()
+                    if len(fields) >= 3:
+                        prefix, asn = fields[0]+'/'+fields[1], parse_origin_asn(fields[2])
+                    else:
+                        prefix, asn = fields[0], parse_origin_asn(fields[1])
+                index.add(prefix, asn)
+            except (ValueError, IndexError, KeyError, socket.error):
+                skipped += 1
+    if skipped > 0:
+        logger.warning("skipped "+str(skipped)+" unparseable lines in "+path)
+    index.build()
+    return index
@@ -0,0 +1,79 @@
+import unittest
+import shutil
+import tempfile
+from easiest.platform_libs.ripe_atlas.catalog import ProbeCatalog
+
+
+def make_probe(probe_id, status='Connected', country='NL'):
+    return {'id': probe_id, 'status': {'id': 1 if status == 'Connected' else 2, 'name': status},
+            'country_code': country, 'is_public': True, 'asn_v4': 64500 + probe_id % 7,
+            'address_v4': '10.0.'+str(probe_id // 256)+'.'+str(probe_id % 256)}
+
+
+class FakeAPI(object):
+
+    def __init__(self, probes):
+        self.probes = dict((z['id'], z) for z in probes)
+        self.calls = list()
+        self.sent = 0
+
+    def __call__(self, **filters):
+        self.calls.append(filters)
+        probes = sorted(self.probes.values(), key=lambda z: z['id'])
+        if 'status' in filters:
+            probes = [z for z in probes if z['status']['id'] == filters['status']]
+        if 'id__gt' in filters:
+            probes = [z for z in probes if z['id'] > filters['id__gt']]
+        if 'id__in' in filters:
+            ids = set([int(z) for z in filters['id__in'].split(',')])
+            probes = [z for z in probes if z['id'] in ids]
+        self.sent += len(probes)
+        return iter(probes)
+
+
+class ProbeCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        # mostly disconnected probes, as in the real probe list
+        self.api = FakeAPI([make_probe(i, 'Connected' if i % 4 == 0 else 'Abandoned') for i in range(1, 2001)])
+        self.catalog = ProbeCatalog(self.tmp+'/catalog.db', fetch=self.api)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def connected_ids(self):
+        return [z['id'] for z in self.catalog.query(status_name='Connected')]
+
+    def test_incremental_refresh(self):
+        self.assertEqual(self.catalog.refresh()['added'], 2000)
+        self.assertEqual(self.api.sent, 2000)
+        # probe 4 disconnects, 5 connects, 2001 is new, and 8 disappears from the API
+        self.api.probes[4] = make_probe(4, 'Disconnected')
+        self.api.probes[5] = make_probe(5, 'Connected')
+        self.api.probes[2001] = make_probe(2001, 'Connected')
+        del self.api.probes[8]
+        self.api.sent = 0
+        counts = self.catalog.refresh()
+        self.assertLess(self.api.sent, 600)
+        self.assertEqual((counts['added'], counts['changed']), (1, 2))
+        expected = sorted([i for i in range(1, 2001) if i % 4 == 0 and i not in (4, 8)] + [5, 2001])
+        self.assertEqual(self.connected_ids(), expected)
+
+    def test_full_refresh_when_old(self):
+        self.catalog.refresh()
+        self.catalog.full_max_age = -1
+        self.api.sent = 0
+        self.catalog.refresh()
+        self.assertEqual(self.api.sent, 2000)
+
+    def test_long_in_lists(self):
+        self.catalog.refresh()
+        ids = range(1, 2001, 2) + range(4, 2001, 4)
+        probes = self.catalog.query(status_name=None, ids=ids, v4_asns=range(64500, 65500), countries=['NL'])
+        self.assertEqual([z['id'] for z in probes], sorted(set(ids)))
+        self.assertEqual(len(self.catalog.query(ids=range(1, 1500), countries=['DE'])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
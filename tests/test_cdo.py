@@ -0,0 +1,328 @@
+import unittest
+import copy
+from IPy import IP
+import math
+import random
+from collections import Counter
+from easiest.cdo import Client, ClientGroup, ColumnarClientGroup, BaseLocation, Location, CompactLocation, \
+    TargetLocation, TargetClientGroup, stratified_sample
+from easiest.platform_libs import ripe_atlas
+
+
+class FakeResolver(object):
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def lookup(self, ip):
+        return self.answer
+
+    def reverse(self, coordinates):
+        return self.answer
+
+
+class EnrichTest(unittest.TestCase):
+
+    def setUp(self):
+        CompactLocation.asn_resolver = FakeResolver(64500)
+        CompactLocation.geocoder = FakeResolver('NL')
+        Location.asn_resolver = FakeResolver(64501)
+        Location.geocoder = FakeResolver('DE')
+
+    def tearDown(self):
+        for cls in (Location, CompactLocation):
+            del cls.asn_resolver
+            del cls.geocoder
+
+    def test_uses_each_location_class_settings(self):
+        compact = CompactLocation(ipv4='10.0.0.1', coordinates=[52.3, 4.9])
+        regular = Location(ipv4='10.0.0.1', coordinates=[52.3, 4.9])
+        group = ClientGroup([Client('ripe_atlas', compact), Client('ripe_atlas', regular)])
+        lookups = group.enrich(fields=('asn_v4', 'country_code'), max_workers=2)
+        self.assertEqual(lookups, {'asn_v4': 2, 'country_code': 2})
+        self.assertEqual((compact.asn_v4, compact.country_code), (64500, 'NL'))
+        self.assertEqual((regular.asn_v4, regular.country_code), (64501, 'DE'))
+
+    def test_columnar(self):
+        BaseLocation.asn_resolver = FakeResolver(64502)
+        BaseLocation.geocoder = FakeResolver('FR')
+        try:
+            probes = [{'id': i, 'address_v4': '10.0.0.'+str(i), 'geometry': {'coordinates': [2.3, 48.8 + i]}}
+                      for i in range(1, 6)]
+            group = ColumnarClientGroup.from_probes(probes)
+            self.assertEqual(group.enrich(fields=('asn_v4', 'country_code'), max_workers=2),
+                             {'asn_v4': 5, 'country_code': 5})
+            self.assertEqual([z.asn_v4 for z in group], [64502]*5)
+            self.assertEqual([z.country_code for z in group], ['FR']*5)
+        finally:
+            BaseLocation.asn_resolver = None
+            BaseLocation.geocoder = None
+
+    def test_failures_arent_counted(self):
+        class Failing(object):
+            def lookup(self, ip):
+                raise ValueError("no route")
+
+        Location.asn_resolver = Failing()
+        loc = Location(ipv4='10.0.0.1')
+        self.assertEqual(ClientGroup([Client('ripe_atlas', loc)]).enrich(fields=('asn_v4',)), {'asn_v4': 0})
+        self.assertFalse(hasattr(loc, '_asn_v4'))
+
+
+def make_probes():
+    probes = list()
+    for i, (lat, lon, status) in enumerate([(52.3, 4.9, 'Connected'), (52.4, 4.8, 'Disconnected'),
+                                            (48.8, 2.3, 'Connected'), (52.1, 5.1, 'Connected')]):
+        probes.append({'id': i + 1, 'address_v4': '10.0.0.'+str(i + 1), 'asn_v4': 64500 + i, 'country_code': 'NL',
+                       'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+                       'status': {'id': 1, 'name': status, 'since': '2017-07-14T02:40:00Z'}})
+    # older API style
+    probes.append({'id': 5, 'address_v4': '10.0.0.5', 'country_code': 'NL', 'status': 1, 'status_name': 'Connected',
+                   'geometry': {'type': 'Point', 'coordinates': [4.9, 52.35]}})
+    return probes
+
+
+class GroupTypesTest(unittest.TestCase):
+
+    def filtered(self, **constraints):
+        ids = list()
+        groups = [ripe_atlas.probes_to_clients(make_probes()), ColumnarClientGroup.from_probes(make_probes())]
+        for compact in (True, False):
+            ripe_atlas.compact_models = compact
+            groups.append(ripe_atlas.probes_to_clients(make_probes()))
+        for group in groups:
+            ids.append(sorted(TargetLocation(**copy.deepcopy(constraints)).filter(group).probe_ids))
+        return ids
+
+    def tearDown(self):
+        ripe_atlas.compact_models = False
+
+    def test_coordinate_circle(self):
+        ids = self.filtered(coordinate_circle={'coordinates': (52.3, 4.9), 'radius': 50.0})
+        self.assertEqual(ids[0], [1, 2, 4, 5])
+        self.assertTrue(all([z == ids[0] for z in ids]))
+
+    def test_status(self):
+        for member in ('status', 'status_name'):
+            ids = self.filtered(**{member: 'Connected'})
+            self.assertEqual(ids[0], [1, 3, 4, 5])
+            self.assertTrue(all([z == ids[0] for z in ids]))
+
+
+def points_near_circle(center, radius, n, seed=0):
+    """
+    :return: (list(tuple(float, float))) n points whose (spherical) distance to center is within 2% of radius
+    """
+    rand = random.Random(seed)
+    lat0, lon0 = [math.radians(z) for z in center]
+    points = list()
+    for _ in range(n):
+        d = radius * rand.uniform(0.98, 1.02) / 6371.0088
+        bearing = rand.uniform(0, 2 * math.pi)
+        lat = math.asin(math.sin(lat0) * math.cos(d) + math.cos(lat0) * math.sin(d) * math.cos(bearing))
+        lon = lon0 + math.atan2(math.sin(bearing) * math.sin(d) * math.cos(lat0),
+                                math.cos(d) - math.sin(lat0) * math.sin(lat))
+        points.append((math.degrees(lat), math.degrees(lon)))
+    return points
+
+
+class CoordinateCircleTest(unittest.TestCase):
+
+    def test_filter_agrees_with_contains_near_radius(self):
+        for center, radius in (((52.3, 4.9), 50.0), ((-33.9, 151.2), 1000.0), ((70.0, -20.0), 5.0)):
+            target = TargetLocation(coordinate_circle={'coordinates': center, 'radius': radius})
+            clients = [Client('ripe_atlas', Location(coordinates=list(z), probe_id=i))
+                       for i, z in enumerate(points_near_circle(center, radius, 200))]
+            clients.append(Client('ripe_atlas', Location(probe_id=len(clients))))
+            expected = [z.location.probe_id for z in clients if z in target]
+            # points on both sides of the edge
+            self.assertTrue(0 < len(expected) < len(clients) - 1)
+            self.assertEqual(sorted(target.coordinate_circle_filter(clients).probe_ids), expected)
+            columnar = ColumnarClientGroup.from_clients(clients)
+            self.assertEqual(sorted(target.coordinate_circle_filter(columnar).probe_ids), expected)
+
+
+def random_probes(n, seed=0):
+    rand = random.Random(seed)
+    probes = list()
+    for i in range(n):
+        probes.append({'id': i + 1, 'address_v4': '10.%d.%d.1' % (rand.randint(0, 3), rand.randint(0, 255)),
+                       'asn_v4': rand.choice([64500, 64501, 64502]), 'country_code': rand.choice(['NL', 'DE', 'FR']),
+                       'geometry': {'type': 'Point', 'coordinates': [rand.uniform(0, 10), rand.uniform(45, 55)]},
+                       'status': {'id': 1, 'name': rand.choice(['Connected', 'Disconnected'])}})
+    return probes
+
+
+class CompiledConstraintsTest(unittest.TestCase):
+
+    constraints = [
+        {'countries': ['NL', 'DE']},
+        {'v4_asns': [64500]},
+        {'ipv4_subnet': '10.1.0.0/16'},
+        {'ipv4_subnet': ['10.0.0.0/16', '10.2.128.0/17'], 'countries': ['FR']},
+        {'coordinate_circle': {'coordinates': (50.0, 5.0), 'radius': 300.0}, 'v4_asns': [64501, 64502]},
+        {'coordinate_circle': {'coordinates': (50.0, 5.0), 'radius': 400.0}, 'countries': ['NL'],
+         'ipv4_subnet': ['10.0.0.0/15']},
+    ]
+
+    def groups(self):
+        groups = [ripe_atlas.probes_to_clients(random_probes(300)), ColumnarClientGroup.from_probes(random_probes(300))]
+        ripe_atlas.compact_models = True
+        groups.append(ripe_atlas.probes_to_clients(random_probes(300)))
+        ripe_atlas.compact_models = False
+        return groups
+
+    def test_filter_agrees_with_check(self):
+        for constraints in self.constraints:
+            for group in self.groups():
+                target = TargetLocation(**copy.deepcopy(constraints))
+                expected = [z.probe_id for z in group if target.check(z.location)]
+                self.assertEqual(sorted(target.filter(group).probe_ids), sorted(expected))
+                self.assertTrue(0 < len(expected) < len(group))
+                clients = TargetClientGroup(target, status_name='Connected')
+                expected = [z.probe_id for z in group if clients.check(z)]
+                self.assertEqual(sorted(clients.filter(group).probe_ids), sorted(expected))
+
+    def test_recompiled_when_set(self):
+        group = ripe_atlas.probes_to_clients(random_probes(50))
+        target = TargetLocation(countries=['NL'])
+        self.assertEqual(set(z.location.country_code for z in target.filter(group)), set(['NL']))
+        target.countries = ['DE']
+        self.assertEqual(set(z.location.country_code for z in target.filter(group)), set(['DE']))
+
+
+def skewed_probes():
+    # 200 NL, 50 DE and 5 FR probes; every 10th probe of a country shares its /24 and ASN with the probe before it
+    probes = list()
+    for country, n in (('NL', 200), ('DE', 50), ('FR', 5)):
+        for i in range(n):
+            pid = len(probes) + 1
+            key = pid - 1 if i % 10 == 9 else pid
+            probes.append({'id': pid, 'address_v4': '10.0.%d.%d' % (key, 1 + (i % 10 == 9)), 'asn_v4': 64500 + key,
+                           'country_code': country})
+    return probes
+
+
+class StratifiedSampleTest(unittest.TestCase):
+
+    def groups(self):
+        return [ripe_atlas.probes_to_clients(skewed_probes()), ColumnarClientGroup.from_probes(skewed_probes())]
+
+    def test_balanced(self):
+        for group in self.groups():
+            sample = stratified_sample(group, 'country_code', 60, seed=1)
+            self.assertIs(type(sample), type(group))
+            self.assertEqual(len(set(sample.probe_ids)), 60)
+            # FR only has 5 probes; the rest of its share is split evenly between NL and DE
+            counts = Counter(sample.values('country_code'))
+            self.assertEqual((counts['FR'], sorted([counts['NL'], counts['DE']])), (5, [27, 28]))
+
+    def test_quotas(self):
+        for group in self.groups():
+            sample = stratified_sample(group, 'country_code', 100, quotas={'NL': 10}, seed=1)
+            self.assertEqual(Counter(sample.values('country_code')), {'NL': 10, 'DE': 50, 'FR': 5})
+            sample = stratified_sample(group, 'country_code', 100, quotas=3, seed=1)
+            self.assertEqual(len(sample), 9)
+
+    def test_dedupe(self):
+        for group in self.groups():
+            for dedupe in ('/24', 'asn'):
+                sample = stratified_sample(group, 'country_code', 255, dedupe=dedupe, seed=1)
+                self.assertEqual(len(sample), 230)
+                self.assertEqual(len(set(sample.values('asn_v4'))), 230)
+            self.assertEqual(len(stratified_sample(group, 'country_code', 255, dedupe=None, seed=1)), 255)
+
+    def test_seed(self):
+        group = ripe_atlas.probes_to_clients(skewed_probes())
+        first = stratified_sample(group, 'country_code', 30, seed=7).probe_ids
+        self.assertEqual(stratified_sample(group, 'country_code', 30, seed=7).probe_ids, first)
+        self.assertNotEqual(stratified_sample(group, 'country_code', 30, seed=8).probe_ids, first)
+        columnar = ColumnarClientGroup.from_probes(skewed_probes())
+        self.assertEqual(stratified_sample(columnar, 'country_code', 30, seed=7).probe_ids, first)
+
+
+def numbered_probes(ids):
+    return [{'id': i, 'address_v4': '10.0.0.'+str(i), 'country_code': 'NL'} for i in ids]
+
+
+class SetAlgebraTest(unittest.TestCase):
+
+    def pairs(self):
+        a, b = numbered_probes(range(1, 7)), numbered_probes(range(4, 10))
+        return [(ripe_atlas.probes_to_clients(a), ripe_atlas.probes_to_clients(b)),
+                (ColumnarClientGroup.from_probes(a), ColumnarClientGroup.from_probes(b)),
+                (ColumnarClientGroup.from_probes(a), ripe_atlas.probes_to_clients(b))]
+
+    def test_union(self):
+        for a, b in self.pairs():
+            union = a.union(b)
+            self.assertEqual(union.probe_ids, range(1, 10))
+            self.assertEqual(ClientGroup.merge(a, b, a).probe_ids, range(1, 10))
+            # the first client with each probe_id is kept
+            self.assertEqual(union.get_client(probe_id=5).location.ipv4, a.get_client(probe_id=5).location.ipv4)
+
+    def test_union_keeps_clients_without_probe_id(self):
+        a = ClientGroup([Client('ripe_atlas', Location(ipv4='10.0.1.1')), Client('ripe_atlas', Location(probe_id=1))])
+        b = ClientGroup([Client('ripe_atlas', Location(ipv4='10.0.1.1')), Client('ripe_atlas', Location(probe_id=1))])
+        self.assertEqual(len(a.union(b)), 3)
+
+    def test_intersection_and_difference(self):
+        for a, b in self.pairs():
+            self.assertEqual(a.intersection(b).probe_ids, [4, 5, 6])
+            self.assertEqual(a.difference(b).probe_ids, [1, 2, 3])
+            self.assertEqual(b.difference(a).probe_ids, [7, 8, 9])
+            self.assertEqual(len(a.difference(a)), 0)
+
+    def test_membership(self):
+        for a, b in self.pairs():
+            self.assertIn(4, a)
+            self.assertNotIn(7, a)
+            self.assertIn('10.0.0.2', a)
+            self.assertNotIn('10.0.0.8', a)
+            self.assertIn(b.get_client(probe_id=5), a)
+            self.assertNotIn(b.get_client(probe_id=9), a)
+
+    def test_dedupe(self):
+        for a, b in self.pairs():
+            if isinstance(a, ColumnarClientGroup) and isinstance(b, ColumnarClientGroup):
+                both = ColumnarClientGroup.concat(a, b)
+            else:
+                both = ClientGroup(list(a) + list(b))
+            self.assertEqual(len(both), 12)
+            self.assertEqual(both.dedupe().probe_ids, range(1, 10))
+            self.assertEqual(both.dedupe('ipv4').probe_ids, range(1, 10))
+
+
+class SubnetListTest(unittest.TestCase):
+
+    def test_single_prefix(self):
+        target = TargetLocation(ipv4_subnet='10.1.2.3/16')
+        self.assertEqual(target.ipv4_subnet, IP('10.1.0.0/16'))
+        self.assertIn(Location(ipv4='10.1.200.1'), target)
+        self.assertNotIn(Location(ipv4='10.2.0.1'), target)
+
+    def test_prefix_list(self):
+        target = TargetLocation(ipv4_subnet=['10.1.0.0/16', '192.0.2.0/24', '10.1.2.0/24'])
+        self.assertEqual(target.ipv4_subnet, [IP('10.1.0.0/16'), IP('192.0.2.0/24'), IP('10.1.2.0/24')])
+        ips = ['10.1.0.1', '10.1.2.1', '192.0.2.255', '192.0.3.1', '10.0.255.255']
+        clients = [Client('ripe_atlas', Location(ipv4=z, probe_id=i)) for i, z in enumerate(ips)]
+        clients.append(Client('ripe_atlas', Location(probe_id=len(ips))))
+        self.assertEqual([z in target for z in clients], [True, True, True, False, False, False])
+        for group in (ClientGroup(clients), ColumnarClientGroup.from_clients(clients)):
+            self.assertEqual(sorted(target.filter(group).probe_ids), [0, 1, 2])
+
+    def test_ipv6_prefix_list(self):
+        target = TargetLocation(ipv6_subnet=['2001:db8::/48', '2001:db8:ff::/48'])
+        ips = ['2001:db8::1', '2001:db8:ff::1', '2001:db8:1::1']
+        clients = [Client('ripe_atlas', Location(ipv6=z, probe_id=i)) for i, z in enumerate(ips)]
+        clients.append(Client('ripe_atlas', Location(probe_id=len(ips))))
+        self.assertEqual([z in target for z in clients], [True, True, False, False])
+        self.assertEqual(sorted(target.filter(ClientGroup(clients)).probe_ids), [0, 1])
+
+    def test_wrong_version(self):
+        self.assertRaises(ValueError, TargetLocation, ipv4_subnet=['10.0.0.0/8', '2001:db8::/32'])
+        self.assertRaises(ValueError, TargetLocation, ipv6_subnet='10.0.0.0/8')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import threading
+from easiest.mms.collector import CollectorEngine
+
+
+class BlockingCollector(object):
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def step(self):
+        self.started.set()
+        self.release.wait(5)
+        return None
+
+
+class CollectorEngineTest(unittest.TestCase):
+
+    def test_slow_step_doesnt_block_others(self):
+        engine = CollectorEngine(workers=2)
+        slow = BlockingCollector()
+        fast = BlockingCollector()
+        fast.release.set()
+        engine.add(slow)
+        self.assertTrue(slow.started.wait(5))
+        engine.add(fast)
+        # fast runs on the other worker while slow is still in its step
+        self.assertTrue(fast.started.wait(5))
+        slow.release.set()
+
+    def test_step_repeats_after_delay(self):
+        engine = CollectorEngine(workers=1)
+        done = threading.Event()
+        counts = list()
+
+        class Spinner(object):
+            def step(self):
+                counts.append(1)
+                if len(counts) == 3:
+                    done.set()
+                    return None
+                return 0.01
+
+        engine.add(Spinner())
+        self.assertTrue(done.wait(5))
+        self.assertEqual(len(counts), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+import base64
+import shutil
+import tempfile
+import numpy as np
+from easiest.mms.columnar import write_columnar, ColumnarResults
+
+
+def make_results(n):
+    results = list()
+    for i in xrange(n):
+        results.append({'prb_id': i, 'msm_id': 1000 + i % 3, 'timestamp': 1500000000.0 + i, 'meas_type': 'dns',
+                        'resolver': '10.0.0.'+str(i % 4), 'local_resolver_name': 'ns'+str(i % 2),
+                        'rtt_list': [1.5*j for j in range(i % 4)] + ([{'x': '*'}] if i % 5 == 0 else []),
+                        'answers': {'A': ['1.2.3.'+str(j) for j in range(i % 3)]} if i % 2 else {},
+                        'raw_response': base64.b64encode('abuf'*(i % 3))})
+    return results
+
+
+class WriteColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_chunked_matches_unchunked(self):
+        results = make_results(23)
+        rows = None
+        for chunk_size in (1, 4, 23, 1000):
+            path = self.tmp+'/'+str(chunk_size)
+            self.assertEqual(write_columnar(results, path, chunk_size=chunk_size), 23)
+            columnar = ColumnarResults(path)
+            chunk_rows = list(columnar)
+            if rows is None:
+                rows = chunk_rows
+            self.assertEqual(chunk_rows, rows)
+            self.assertEqual(columnar.column('prb_id').tolist(), range(23))
+        self.assertEqual(rows[5]['resolver'], '10.0.0.1')
+        self.assertEqual(rows[5]['local_resolver_name'], 'ns1')
+        self.assertEqual(rows[5]['rtt_list'], [0.0, None])
+        self.assertEqual(rows[5]['answers'], {'A': ['1.2.3.0', '1.2.3.1']})
+        self.assertEqual(base64.b64decode(rows[5]['raw_response']), 'abufabuf')
+
+    def test_empty(self):
+        self.assertEqual(write_columnar(list(), self.tmp+'/empty'), 0)
+        columnar = ColumnarResults(self.tmp+'/empty')
+        self.assertEqual(len(columnar), 0)
+        self.assertEqual(len(columnar.column('rtt_list.offsets')), 1)
+        self.assertEqual(columnar.column('timestamp').dtype, np.float64)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from easiest import geocoding
+from easiest.geocoding import OfflineGeocoder, NetworkGeocoder
+
+
+class OfflineGeocoderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.geocoder = OfflineGeocoder()
+
+    def test_inland(self):
+        self.assertEqual(self.geocoder.reverse((48.8566, 2.3522)), 'FR')
+        self.assertEqual(self.geocoder.reverse((52.37, 4.9)), 'NL')
+
+    def test_border_cities_are_ambiguous(self):
+        # Geneva, CH and Windsor, ON: a few km from the border, well within the simplified polygons' error
+        self.assertIsNone(self.geocoder.reverse((46.2044, 6.1432)))
+        self.assertIsNone(self.geocoder.reverse((42.3149, -83.0364)))
+
+    def test_no_margin(self):
+        geocoder = OfflineGeocoder(border_margin=0)
+        self.assertIsNotNone(geocoder.reverse((46.2044, 6.1432)))
+
+    def test_countries_near(self):
+        self.assertEqual(self.geocoder.countries_near(46.2044, 6.1432, 25.0), set(['CH', 'FR']))
+
+
+class Nominatim(object):
+    calls = 0
+
+    def reverse(self, coordinates):
+        Nominatim.calls += 1
+
+        class Location(object):
+            # geopy hands back json decoded (unicode) strings
+            raw = {'address': {'country_code': u'fr'}}
+        return Location()
+
+
+class NetworkGeocoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = geocoding.Nominatim
+        geocoding.Nominatim = Nominatim
+        Nominatim.calls = 0
+
+    def tearDown(self):
+        geocoding.Nominatim = self.original
+
+    def test_unicode_country_code(self):
+        geocoder = NetworkGeocoder()
+        self.assertEqual(geocoder.reverse((48.8566, 2.3522)), 'FR')
+        self.assertEqual(geocoder.reverse((48.85661, 2.35221)), 'FR')
+        self.assertEqual(Nominatim.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import unittest
+import datetime
+import json
+from StringIO import StringIO
+import shutil
+import tempfile
+from easiest.helpers import WhoisCache, Extendable, from_dict
+from easiest.helpers import JsonLinesSink, read_jsonl, TokenBucket, write_json
+
+
+class WhoisCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = WhoisCache(db_path=self.tmp+"/whois.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_keys_on_narrowest_prefix(self):
+        result = {'query': '24.1.2.3', 'asn': '7922', 'asn_cidr': '24.0.0.0/12',
+                  'network': {'cidr': '24.0.0.0/8'}}
+        self.cache.store('24.1.2.3', result)
+        hit = self.cache.lookup('24.8.0.1')
+        self.assertEqual(hit['asn'], '7922')
+        self.assertEqual(hit['query'], '24.8.0.1')
+        # inside the registered block, but outside the announced prefix the ASN belongs to
+        self.assertIsNone(self.cache.lookup('24.200.0.1'))
+
+    def test_network_narrower_than_asn_cidr(self):
+        result = {'query': '10.1.2.3', 'asn': '1', 'asn_cidr': '10.0.0.0/8',
+                  'network': {'cidr': '10.1.0.0/16, 10.2.0.0/16'}}
+        self.cache.store('10.1.2.3', result)
+        self.assertIsNotNone(self.cache.lookup('10.1.200.1'))
+        self.assertIsNone(self.cache.lookup('10.2.0.1'))
+
+    def test_no_prefix(self):
+        self.cache.store('192.0.2.1', {'query': '192.0.2.1', 'asn_cidr': 'NA', 'network': None})
+        self.assertIsNotNone(self.cache.lookup('192.0.2.1'))
+        self.assertIsNone(self.cache.lookup('192.0.2.2'))
+
+
+class Required(Extendable):
+    def __init__(self, name, size=1):
+        self.name = name
+        self.size = size
+        self.initialized = True
+
+
+class Keywords(Extendable):
+    def __init__(self, **kwargs):
+        for k in kwargs:
+            self.set(k, kwargs[k])
+
+
+class FromDictTest(unittest.TestCase):
+
+    def test_extra_members_are_set(self):
+        obj = Required.from_dict({'CLASS': 'Required', 'name': 'a', 'size': 2, 'extra': 3})
+        self.assertEqual((obj.name, obj.size, obj.extra), ('a', 2, 3))
+        self.assertTrue(obj.initialized)
+
+    def test_missing_required_args(self):
+        obj = Required.from_dict({'size': 2, 'extra': 3})
+        self.assertEqual((obj.size, obj.extra), (2, 3))
+        self.assertFalse(hasattr(obj, 'initialized'))
+
+    def test_keywords(self):
+        obj = Keywords.from_dict({'a': 1, 'b': 2})
+        self.assertEqual((obj.a, obj.b), (1, 2))
+
+    def test_client_group(self):
+        from easiest.cdo import ClientGroup, ColumnarClientGroup, Client, Location
+        clients = [Client('ripe_atlas', Location(ipv4='10.0.0.'+str(i), probe_id=i)) for i in range(1, 4)]
+        for cls in (ClientGroup, ColumnarClientGroup):
+            d = ClientGroup(clients).to_dict()
+            d['CLASS'] = cls.__name__
+            group = json.loads(json.dumps(d), object_hook=from_dict)
+            self.assertIs(type(group), cls)
+            self.assertEqual(len(group), 3)
+            self.assertIsNotNone(group.get_client(probe_id=2))
+
+
+class JsonLinesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = self.tmp+'/raw.jsonl'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_partial_last_line(self):
+        sink = JsonLinesSink(self.path, fsync=False)
+        sink.append([{'prb_id': 1}, {'prb_id': 2}])
+        sink.close()
+        with open(self.path, 'a') as f:
+            f.write('{"prb_id": 3')
+        self.assertEqual([z['prb_id'] for z in read_jsonl(self.path)], [1, 2])
+        sink.append([{'prb_id': 4}])
+        sink.close()
+        self.assertEqual([z['prb_id'] for z in read_jsonl(self.path)], [1, 2, 4])
+
+    def test_legacy_json_list(self):
+        with open(self.path, 'w') as f:
+            json.dump([[{'prb_id': 1}, {'prb_id': 2}], [{'prb_id': 3}]], f)
+        self.assertEqual([z['prb_id'] for z in read_jsonl(self.path)], [1, 2, 3])
+        sink = JsonLinesSink(self.path, fsync=False)
+        sink.append([{'prb_id': 4}])
+        sink.close()
+        self.assertEqual([z['prb_id'] for z in read_jsonl(self.path)], [1, 2, 3, 4])
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_more_than_capacity(self):
+        bucket = TokenBucket(100, capacity=2)
+        self.assertRaises(ValueError, bucket.consume, 3)
+        self.assertTrue(bucket.consume(2))
+
+    def test_non_blocking(self):
+        bucket = TokenBucket(0.001, capacity=1)
+        self.assertTrue(bucket.consume(block=False))
+        self.assertFalse(bucket.consume(block=False))
+
+
+def legacy_to_dict(item):
+    """the to_dict Extendable used before serializers were compiled (see Schema), kept here as the reference"""
+    if isinstance(item, Extendable):
+        d = dict()
+        for m in [v for v in vars(item) if not v.startswith('_')]:
+            val = legacy_to_dict(item.get(m))
+            if val is not None:
+                d[m] = val
+        d['CLASS'] = item.__class__.__name__
+        return d
+    elif hasattr(item, '__iter__') and type(item) is not dict:
+        return [legacy_to_dict(z) for z in item]
+    try:
+        _ = json.dumps({"entry": item})
+        return item
+    except:
+        return str(item)
+
+
+class Nested(Extendable):
+    def __init__(self, **kwargs):
+        self.name = None
+        self.children = list()
+        self._private = 'hidden'
+        for k in kwargs:
+            self.set(k, kwargs[k])
+
+    def get_name(self):
+        return None if self.name is None else self.name.upper()
+
+
+class SchemaTest(unittest.TestCase):
+
+    def objects(self):
+        from easiest.mms.mro import PingResult, ResultSet
+        leaf = Nested(name='leaf', when=datetime.datetime(2017, 7, 14), tags=set(['a']), point=(1.5, 2),
+                      counts={1: 'a', 'b': [1, 2]}, odd={(1, 2): 'x'}, empty=None, text=u'caf\xe9')
+        root = Nested(name='root', children=[leaf, Nested(), [leaf, 3]], size=10**20)
+        results = ResultSet(label='ping', meas_type='ping',
+                            results=[PingResult(label='ping', src_addr='10.0.0.'+str(i), rtt_list=[1.0, 2.5])
+                                     for i in range(3)])
+        return [leaf, root, results]
+
+    def test_to_dict_matches_legacy(self):
+        for obj in self.objects():
+            self.assertEqual(obj.to_dict(), legacy_to_dict(obj))
+
+    def test_write_json_matches_to_dict(self):
+        for obj in self.objects():
+            for chunk_size in (1, 2, 1000):
+                f = StringIO()
+                write_json(obj, f, chunk_size=chunk_size)
+                self.assertEqual(json.loads(f.getvalue()), json.loads(json.dumps(legacy_to_dict(obj))))
+
+    def test_write_json_keeps_nones(self):
+        f = StringIO()
+        write_json(Nested(), f, skip_nones=False)
+        self.assertEqual(json.loads(f.getvalue()), {'name': None, 'children': [], 'CLASS': 'Nested'})
+
+
+if __name__ == '__main__':
+    unittest.main()
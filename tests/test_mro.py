@@ -0,0 +1,99 @@
+import unittest
+import base64
+import json
+import shutil
+import tempfile
+import dns.message
+import dns.rrset
+from easiest.mms.mro import DNSResult, CompactDNSResult, decode_dns_results, PingResult, ResultSet
+
+
+def make_response():
+    response = dns.message.make_response(dns.message.make_query('example.com', 'A'))
+    response.answer.append(dns.rrset.from_text('example.com.', 300, 'IN', 'A', '192.0.2.1'))
+    return base64.b64encode(response.to_wire())
+
+
+class DNSQueryTest(unittest.TestCase):
+
+    raw_query = base64.b64encode(dns.message.make_query('example.com', 'A').to_wire())
+    raw_response = make_response()
+
+    def test_decoded_on_read(self):
+        for cls in (DNSResult, CompactDNSResult):
+            result = cls(raw_query=self.raw_query)
+            result.extract_query()
+            self.assertEqual((result.query_domain, result.query_type), ('example.com.', 'A'))
+
+    def test_set_after_extract(self):
+        for cls in (DNSResult, CompactDNSResult):
+            result = cls(raw_query=self.raw_query)
+            result.extract_query()
+            result.query_domain = 'example.org.'
+            self.assertEqual((result.query_domain, result.query_type), ('example.org.', 'A'))
+            # a later decode doesn't overwrite the explicitly set query_domain either
+            result.extract_query()
+            result.query_type = 'AAAA'
+            self.assertEqual((result.query_domain, result.query_type), ('example.org.', 'AAAA'))
+
+    def test_set_after_answers(self):
+        for cls in (DNSResult, CompactDNSResult):
+            result = cls(raw_query=self.raw_query, raw_response=self.raw_response)
+            result.extract_answers()
+            result.extract_query()
+            self.assertEqual(result.answers, {'A': ['192.0.2.1']})
+            result.query_type = 'AAAA'
+            decode_dns_results([result])
+            self.assertEqual((result.query_domain, result.query_type), ('example.com.', 'AAAA'))
+            result.extract_query()
+            decode_dns_results([result])
+            self.assertEqual((result.query_domain, result.query_type), ('example.com.', 'AAAA'))
+
+
+def ping_results(start, n):
+    return [PingResult(label='ping', dst_addr='192.0.2.1', src_addr='10.0.0.'+str(i), rtt_list=[1.5, 2.0 + i],
+                       num_sent=2, num_returned=2, timestamp=1500000000.0 + i) for i in range(start, start + n)]
+
+
+class ResultSetStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = self.tmp+'/results.json'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        expected = ResultSet(label='ping', platform='ripe_atlas', meas_type='ping', file_path=self.path)
+        streamed = ResultSet(label='ping', platform='ripe_atlas', meas_type='ping', file_path=self.path)
+        expected.append(ping_results(0, 1)[0])
+        streamed.append(ping_results(0, 1)[0])
+        streamed.open_stream()
+        for start, n in ((1, 3), (4, 0), (4, 5)):
+            expected.append_batch(ping_results(start, n))
+            streamed.append_batch(ping_results(start, n))
+        streamed.close_stream()
+        self.assertEqual(len(streamed.results), 9)
+        # the streamed file is a regular ResultSet document
+        with open(self.path, 'r') as f:
+            self.assertEqual(json.load(f), expected.to_dict())
+        self.assertEqual(list(ResultSet.iter_results(self.path)), expected.to_dict()['results'])
+        loaded = ResultSet()
+        loaded.load_json(self.path)
+        self.assertEqual(loaded.to_dict(), expected.to_dict())
+
+    def test_interrupted_stream(self):
+        streamed = ResultSet(label='ping', meas_type='ping', file_path=self.path)
+        streamed.open_stream(keep_results=False)
+        streamed.append_batch(ping_results(0, 2))
+        streamed.append_batch(ping_results(2, 2))
+        self.assertEqual(streamed.results, list())
+        # never closed: every batch written so far can still be read back
+        self.assertEqual([z['src_addr'] for z in ResultSet.iter_results(self.path)],
+                         ['10.0.0.'+str(i) for i in range(4)])
+        streamed.close_stream()
+
+
+if __name__ == '__main__':
+    unittest.main()
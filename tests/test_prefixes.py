@@ -0,0 +1,72 @@
+import unittest
+import gzip
+import random
+import shutil
+import tempfile
+from easiest.prefixes import PrefixIndex, load_pfx2as, ip_to_int, cidr_to_range
+
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def test_longest_match(self):
+        index = PrefixIndex([('10.0.0.0/8', 'a'), ('10.1.0.0/16', 'b'), ('10.1.2.0/24', 'c'), ('10.1.2.128/25', 'a')])
+        self.assertEqual(index.lookup('10.2.0.1'), 'a')
+        self.assertEqual(index.lookup('10.1.0.1'), 'b')
+        self.assertEqual(index.lookup('10.1.2.1'), 'c')
+        self.assertEqual(index.lookup('10.1.2.200'), 'a')
+        self.assertEqual(index.lookup('10.1.3.0'), 'b')
+        self.assertIsNone(index.lookup('11.0.0.1'))
+        self.assertNotIn('9.255.255.255', index)
+        self.assertEqual(len(index), 4)
+
+    def test_ipv6(self):
+        index = PrefixIndex([('2001:db8::/32', 1), ('2001:db8:1::/48', 2), ('10.0.0.0/8', 3)])
+        self.assertEqual(index.lookup('2001:db8::1'), 1)
+        self.assertEqual(index.lookup('2001:db8:1::1'), 2)
+        self.assertIsNone(index.lookup('2001:db9::1'))
+        self.assertEqual(index.lookup_many(['2001:db8:1::1', '10.0.0.1', None]), [2, 3, None])
+
+    def test_matches_brute_force(self):
+        rand = random.Random(1)
+        prefixes = dict()
+        for i in range(300):
+            prefix = '%d.%d.0.0/%d' % (rand.randint(0, 255), rand.randint(0, 255), rand.randint(8, 28))
+            # one value per distinct (normalized) prefix
+            prefixes.setdefault(cidr_to_range(prefix), (prefix, i))
+        index = PrefixIndex(prefixes.values())
+        ips = ['%d.%d.1.1' % (rand.randint(0, 255), rand.randint(0, 255)) for _ in range(1000)]
+        for ip, found in zip(ips, index.lookup_many(ips)):
+            val = ip_to_int(ip)[1]
+            matches = [(r[3], v[1]) for r, v in prefixes.items() if r[1] <= val <= r[2]]
+            self.assertEqual(found, max(matches)[1] if len(matches) > 0 else None)
+            self.assertEqual(index.lookup(ip), found)
+
+
+class LoadPfx2asTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_formats(self):
+        lines = ['# comment',
+                 '10.0.0.0\t8\t100',
+                 '10.1.0.0/16 200_201',
+                 'TABLE_DUMP2|1500000000|B|192.0.2.1|64496|10.1.2.0/24|64496 3356 {300,301}|IGP',
+                 'not a prefix line',
+                 '']
+        path = self.tmp+'/pfx2as.gz'
+        f = gzip.open(path, 'w')
+        f.write('\n'.join(lines))
+        f.close()
+        index = load_pfx2as(path)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.lookup('10.9.9.9'), 100)
+        self.assertEqual(index.lookup('10.1.9.9'), 200)
+        self.assertEqual(index.lookup('10.1.2.9'), 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,505 @@
+import unittest
+import base64
+import json
+import shutil
+import tempfile
+import threading
+import time
+import dns.message
+import dns.rrset
+from easiest.helpers import JsonLinesSink, read_jsonl, from_dict, Compact
+from easiest.platform_libs import ripe_atlas
+
+
+class PackRequestsTest(unittest.TestCase):
+
+    def check_packing(self, num_measurements, num_probes, **limits):
+        measurements = range(num_measurements)
+        probe_ids = range(num_probes)
+        requests = ripe_atlas.pack_requests(measurements, probe_ids, **limits)
+        for defs, probes in requests:
+            self.assertLessEqual(len(defs)*len(probes), limits['max_size'])
+            self.assertLessEqual(len(defs), limits['max_definitions'])
+            self.assertLessEqual(len(probes), limits['max_probes'])
+        # every (definition, probe) pair is sent exactly once
+        pairs = sorted((m, p) for defs, probes in requests for m in defs for p in probes)
+        self.assertEqual(pairs, sorted((m, p) for m in measurements for p in probe_ids))
+        return requests
+
+    def test_chunk_larger_than_max_size(self):
+        requests = self.check_packing(1, 50, max_definitions=100, max_probes=50, max_size=20)
+        self.assertEqual(len(requests), 3)
+
+    def test_within_limits(self):
+        for num_measurements in (1, 3, 17, 120):
+            for num_probes in (1, 7, 49, 50, 51, 230):
+                for max_size in (1, 10, 20, 50, 200):
+                    self.check_packing(num_measurements, num_probes, max_definitions=100, max_probes=50,
+                                       max_size=max_size)
+
+    def test_empty(self):
+        self.assertEqual(ripe_atlas.pack_requests(list(), range(5)), list())
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def test_sync_keeps_launches_it_may_have_missed(self):
+        admission = ripe_atlas.AdmissionControl(max_active=10, daily_limit=1000, headroom=0, sync_interval=1000)
+
+        def count():
+            # launched while the count was being fetched
+            admission.launched([2], 0)
+            return 1
+
+        admission.count_func = count
+        admission.launched([1], 0)
+        admission.sync()
+        self.assertEqual(admission.recent, set([2]))
+        self.assertEqual(admission.active, 2)
+
+    def test_resync_while_waiting(self):
+        counts = [3, 0]
+        admission = ripe_atlas.AdmissionControl(max_active=3, daily_limit=1000, headroom=0, sync_interval=1000,
+                                                count_func=lambda: counts.pop(0))
+        acquired = list()
+        waiter = threading.Thread(target=lambda: acquired.append(admission.acquire(1)))
+        waiter.daemon = True
+        waiter.start()
+        # the first sync finds no room; resync wakes the waiting acquire, and its sync finds room
+        while admission.last_sync is None:
+            time.sleep(0.01)
+        admission.resync()
+        waiter.join(5)
+        self.assertEqual(acquired, [True])
+
+
+class LaunchSchedulerTest(unittest.TestCase):
+
+    def test_requests_fit_admission(self):
+        admission = ripe_atlas.AdmissionControl(max_active=10, daily_limit=1000, headroom=2, sync_interval=0,
+                                                count_func=lambda: 0)
+        sent = list()
+
+        def send(probe_ids, measurements, **kwargs):
+            sent.append(len(measurements))
+            return True, {'measurements': range(len(measurements))}
+
+        scheduler = ripe_atlas.LaunchScheduler(admission_control=admission, send=send, cooldowns=dict(),
+                                               max_definitions=100, max_probes=50, max_size=1000)
+        scheduler.add(range(30), range(5))
+        scheduler.run()
+        self.assertEqual(sum(sent), 30)
+        self.assertLessEqual(max(sent), admission.max_batch)
+
+    def requeueing(self, rejected, cooldowns=None, **limits):
+        """
+        :param rejected: (dict) target -> number of times its requests are rejected as "same target" before succeeding
+        :return: (list) (time, targets) of every request sent, in order
+        """
+        sent = list()
+
+        def send(probe_ids, measurements, **kwargs):
+            targets = [z.target for z in measurements]
+            sent.append((time.time(), targets))
+            if any([rejected.get(z, 0) > 0 for z in targets]):
+                for z in targets:
+                    rejected[z] = rejected.get(z, 0) - 1
+                return False, {'error': {'detail': 'too many measurements to the same target'}}
+            return True, {'measurements': range(len(measurements))}
+
+        admission = ripe_atlas.AdmissionControl(max_active=100, daily_limit=1000, headroom=0, sync_interval=1000,
+                                                count_func=lambda: 0)
+        scheduler = ripe_atlas.LaunchScheduler(cooldown=0.2, limiter=CountingLimiter(), send=send,
+                                               cooldowns=cooldowns if cooldowns is not None else dict(),
+                                               admission_control=admission, **limits)
+        scheduler.add([Definition(z) for z in ('a', 'b', 'c')], [1])
+        self.assertEqual(len(scheduler.run()), 3)
+        return sent
+
+    def test_held_target_is_requeued_behind_the_others(self):
+        sent = self.requeueing({'a': 1}, max_definitions=1)
+        self.assertEqual([z[1] for z in sent], [['a'], ['b'], ['c'], ['a']])
+        self.assertGreaterEqual(sent[-1][0] - sent[0][0], 0.2)
+        # b and c didn't wait for a's cooldown
+        self.assertLess(sent[2][0] - sent[0][0], 0.2)
+
+    def test_rejected_request_is_split_by_target(self):
+        sent = self.requeueing({'b': 2}, max_definitions=3)
+        # the whole request, then one request per target; b is held off and retried last
+        self.assertEqual([z[1] for z in sent], [['a', 'b', 'c'], ['a'], ['b'], ['c'], ['b']])
+        self.assertGreaterEqual(sent[-1][0] - sent[2][0], 0.2)
+
+    def test_shared_cooldowns(self):
+        start = time.time()
+        sent = self.requeueing(dict(), cooldowns={'c': start + 0.2}, max_definitions=1)
+        self.assertEqual([z[1] for z in sent], [['a'], ['b'], ['c']])
+        self.assertGreaterEqual(sent[-1][0], start + 0.2)
+
+
+class Definition(object):
+
+    def __init__(self, target):
+        self.target = target
+
+
+class CountingLimiter(object):
+
+    def __init__(self):
+        self.consumed = 0
+
+    def consume(self, tokens=1):
+        self.consumed += tokens
+
+
+class LaunchMeasurementTest(unittest.TestCase):
+
+    def scheduler(self, send, cooldowns, **kwargs):
+        admission = ripe_atlas.AdmissionControl(max_active=100, daily_limit=1000, headroom=0, sync_interval=1000,
+                                                count_func=lambda: 0)
+        return ripe_atlas.LaunchScheduler(cooldown=0.2, limiter=CountingLimiter(), cooldowns=cooldowns, send=send,
+                                          admission_control=admission, **kwargs)
+
+    def test_single_request_is_paced_and_held(self):
+        sent = list()
+
+        def send(probe_ids, measurements, **kwargs):
+            sent.append(time.time())
+            return True, {'measurements': [1]}
+
+        held_until = time.time() + 0.2
+        scheduler = self.scheduler(send, {'a': held_until})
+        is_success, daily_limit_reached, responses = ripe_atlas.launch_measurement([1, 2], [Definition('a')],
+                                                                                   scheduler=scheduler)
+        self.assertEqual((is_success, daily_limit_reached, len(responses)), (True, False, 1))
+        self.assertEqual(scheduler.limiter.consumed, 1)
+        self.assertGreaterEqual(sent[0], held_until)
+
+    def test_same_target_rejection_sets_cooldown(self):
+        answers = [(False, {'error': {'detail': 'too many measurements to the same target'}}),
+                   (True, {'measurements': [7]})]
+        cooldowns = dict()
+        scheduler = self.scheduler(lambda probe_ids, measurements, **kwargs: answers.pop(0), cooldowns)
+        is_success, _, responses = ripe_atlas.launch_measurement([1], [Definition('a')], scheduler=scheduler)
+        self.assertTrue(is_success)
+        self.assertIn('a', cooldowns)
+        self.assertEqual(scheduler.limiter.consumed, 2)
+        self.assertEqual(responses, [{'measurements': [7]}])
+
+    def test_single_request_admission(self):
+        sent = list()
+
+        def send(probe_ids, measurements, **kwargs):
+            sent.append(len(measurements))
+            return True, {'measurements': [1]}
+
+        scheduler = self.scheduler(send, dict())
+        scheduler.admission.daily_limit = 1
+        is_success, daily_limit_reached, responses = ripe_atlas.launch_measurement([1], [Definition('a')]*2,
+                                                                                   scheduler=scheduler)
+        # one definition fits under the daily limit, the other is held back
+        self.assertEqual((is_success, daily_limit_reached, sent), (True, True, [1]))
+        self.assertEqual(len(scheduler), 1)
+
+    def test_concurrent_limit_rejection_backs_off(self):
+        answers = [(False, {'error': {'detail': 'You are not permitted to run more than 100 concurrent '
+                                                'measurements'}}),
+                   (True, {'measurements': [7]})]
+        cooldowns = dict()
+        scheduler = self.scheduler(lambda probe_ids, measurements, **kwargs: answers.pop(0), cooldowns)
+        syncs = list()
+        scheduler.admission.count_func = lambda: syncs.append(1) or 0
+        is_success, _, responses = ripe_atlas.launch_measurement([1], [Definition('a')], scheduler=scheduler)
+        self.assertTrue(is_success)
+        # held off every target, and re-counted running measurements before retrying
+        self.assertIn(None, cooldowns)
+        self.assertEqual(len(syncs), 2)
+        self.assertEqual((scheduler.admission.reserved, scheduler.admission.recent), (0, set([7])))
+
+
+class ProbeRequest(object):
+    """stands in for cousteau's ProbeRequest: pages through the probes of one area (or country)"""
+    probes = dict()
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self, **filters):
+        self.remaining = list(ProbeRequest.probes[filters.get('value', filters.get('country_code'))])
+        self.page_size = filters['page_size']
+        self.current_batch = list()
+
+    def next(self):
+        if len(self.current_batch) == 0:
+            if len(self.remaining) == 0:
+                raise StopIteration
+            with ProbeRequest.lock:
+                ProbeRequest.active += 1
+                ProbeRequest.max_active = max(ProbeRequest.max_active, ProbeRequest.active)
+            time.sleep(0.05)
+            with ProbeRequest.lock:
+                ProbeRequest.active -= 1
+            self.current_batch = self.remaining[:self.page_size]
+            self.remaining = self.remaining[self.page_size:]
+        return self.current_batch.pop(0)
+
+
+class Cousteau(object):
+    ProbeRequest = ProbeRequest
+
+
+class SpreadProbesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = ripe_atlas.rac
+        ripe_atlas.rac = Cousteau
+        ProbeRequest.max_active = 0
+
+    def tearDown(self):
+        ripe_atlas.rac = self.original
+
+    def test_shortfall_is_redistributed(self):
+        sizes = dict(zip(ripe_atlas.zones, [100, 1, 100, 3, 100]))
+        ProbeRequest.probes = dict((zone, [{'id': zone+str(i)} for i in range(sizes[zone])]) for zone in sizes)
+        limiter = CountingLimiter()
+        probes = ripe_atlas.get_spread_probes(50, limiter=limiter)
+        self.assertEqual(len(set(z['id'] for z in probes)), 50)
+        counts = dict((zone, len([z for z in probes if z['id'].startswith(zone)])) for zone in sizes)
+        self.assertEqual((counts['South-Central'], counts['West']), (1, 3))
+        self.assertLessEqual(max(counts.values()) - min([counts[z] for z in counts if sizes[z] == 100]), 1)
+        # every zone was fetched concurrently, taking a token per page
+        self.assertGreater(ProbeRequest.max_active, 1)
+        self.assertGreaterEqual(limiter.consumed, 5)
+
+    def test_countries_are_deduplicated(self):
+        ProbeRequest.probes = {'NL': [{'id': i} for i in range(10)], 'DE': [{'id': i} for i in range(5, 20)]}
+        probes = ripe_atlas.get_probes(globally_spread=18, spread_countries=['NL', 'DE'], limiter=CountingLimiter())
+        self.assertEqual(sorted(z['id'] for z in probes), range(18))
+
+
+def raw_ping():
+    return {'fw': 4790, 'lts': 20, 'af': 4, 'dst_name': '192.0.2.1', 'dst_addr': '192.0.2.1', 'src_addr': '10.0.0.5',
+            'from': '198.51.100.1', 'proto': 'ICMP', 'ttl': 55, 'size': 48, 'prb_id': 1, 'msm_id': 1000,
+            'timestamp': 1500000000, 'type': 'ping', 'step': None, 'group_id': 1000, 'msm_name': 'Ping',
+            'stored_timestamp': 1500000001, 'min': 1.5, 'max': 2.0, 'avg': 1.75, 'dup': 0, 'sent': 3, 'rcvd': 2,
+            'result': [{'rtt': 1.5}, {'rtt': 2.0}, {'x': '*'}], 'new_api_field': [1, 2]}
+
+
+def raw_dns():
+    query = dns.message.make_query('example.com', 'A')
+    query.id = 1
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text('example.com.', 300, 'IN', 'A', '192.0.2.1'))
+    return {'fw': 4790, 'lts': 20, 'af': 4, 'from': '198.51.100.1', 'dst_addr': '10.0.0.53', 'src_addr': '10.0.0.5',
+            'proto': 'UDP', 'prb_id': 1, 'msm_id': 1001, 'timestamp': 1500000000, 'type': 'dns', 'group_id': 1001,
+            'msm_name': 'Tdig', 'stored_timestamp': 1500000001, 'qbuf': base64.b64encode(query.to_wire()),
+            'result': {'rt': 10.5, 'size': 45, 'ID': 1, 'ANCOUNT': 1, 'ARCOUNT': 0, 'NSCOUNT': 0, 'QDCOUNT': 1,
+                       'abuf': base64.b64encode(response.to_wire())},
+            'new_api_field': {'a': 1}}
+
+
+def raw_probes():
+    return [{'id': i, 'address_v4': '10.0.0.'+str(i), 'asn_v4': 64500 + i, 'country_code': 'NL', 'is_anchor': False,
+             'geometry': {'type': 'Point', 'coordinates': [4.9, 52.3 + i / 10.0]}, 'tags': [{'slug': 'home'}],
+             'status': {'id': 1, 'name': 'Connected', 'since': '2017-07-14T02:40:00Z'}, 'new_api_field': i}
+            for i in range(1, 4)]
+
+
+class CompactModelsTest(unittest.TestCase):
+
+    def tearDown(self):
+        ripe_atlas.compact_models = False
+
+    def parse(self, meas_type, raw, compact):
+        ripe_atlas.compact_models = compact
+        return ripe_atlas.result_parsers[meas_type](raw)
+
+    def test_same_output_as_regular_models(self):
+        for meas_type, raw in (('ping', raw_ping), ('dns', raw_dns)):
+            regular = self.parse(meas_type, raw(), False).to_dict()
+            compact = self.parse(meas_type, raw(), True)
+            self.assertIsInstance(compact, Compact)
+            self.assertFalse(hasattr(compact, '__dict__'))
+            d = compact.to_dict()
+            self.assertEqual(d.pop('CLASS'), 'Compact'+regular.pop('CLASS'))
+            self.assertEqual(d, regular)
+            self.assertEqual(d['new_api_field'], raw()['new_api_field'])
+
+    def test_json_round_trip(self):
+        for meas_type, raw in (('ping', raw_ping), ('dns', raw_dns)):
+            compact = self.parse(meas_type, raw(), True)
+            loaded = json.loads(json.dumps(compact.to_dict()), object_hook=from_dict)
+            self.assertIsInstance(loaded, Compact)
+            self.assertEqual(loaded.to_dict(), compact.to_dict())
+        dns_result = json.loads(json.dumps(self.parse('dns', raw_dns(), True).to_dict()), object_hook=from_dict)
+        self.assertEqual((dns_result.query_domain, dns_result.answers), ('example.com.', {'A': ['192.0.2.1']}))
+
+    def test_locations(self):
+        probes = raw_probes()
+        for compact in (False, True):
+            ripe_atlas.compact_models = compact
+            group = ripe_atlas.probes_to_clients(probes)
+            loaded = json.loads(json.dumps(group.to_dict()), object_hook=from_dict)
+            self.assertEqual(loaded.to_dict(), group.to_dict())
+            self.assertEqual([type(z.location) for z in loaded], [type(z.location) for z in group])
+        ripe_atlas.compact_models = False
+        regular = ripe_atlas.probes_to_clients(probes).to_dict()
+        ripe_atlas.compact_models = True
+        compact = ripe_atlas.probes_to_clients(probes).to_dict()
+        for client in compact['clients']:
+            self.assertEqual(client['location'].pop('CLASS'), 'CompactLocation')
+        for client in regular['clients']:
+            self.assertEqual(client['location'].pop('CLASS'), 'Location')
+            # compact locations only create inferences once something is inferred
+            self.assertEqual(client['location'].pop('inferences'), list())
+        self.assertEqual(compact, regular)
+
+
+class CountingSink(JsonLinesSink):
+    appends = 0
+
+    def append(self, records):
+        CountingSink.appends += 1
+        JsonLinesSink.append(self, records)
+
+
+class Measro(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def get(self, member):
+        return getattr(self, member)
+
+
+class PollResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.originals = ripe_atlas.poll_request, ripe_atlas.JsonLinesSink
+        ripe_atlas.JsonLinesSink = CountingSink
+        CountingSink.appends = 0
+
+    def tearDown(self):
+        ripe_atlas.poll_request, ripe_atlas.JsonLinesSink = self.originals
+        shutil.rmtree(self.tmp)
+
+    def test_one_append_per_poll(self):
+        msm_ids = range(1, 11)
+        probe_ids = [101, 102]
+
+        def poll_request(job):
+            if job[0] == 'status':
+                return 2
+            return [{'msm_id': job[1], 'prb_id': z, 'timestamp': 1500000000} for z in job[2][:1]]
+
+        ripe_atlas.poll_request = poll_request
+        measro = Measro(running_msm_ids=msm_ids, probe_ids=probe_ids, raw_file_path=self.tmp+'/raw.jsonl')
+        collector = Measro(measro=measro, timeout=100, spin_time=10)
+        for expected in (1, 2):
+            done, res, errs = ripe_atlas.poll_results(collector)
+            self.assertEqual(CountingSink.appends, expected)
+        self.assertTrue(done)
+        self.assertEqual(len(list(read_jsonl(measro.raw_file_path))), 20)
+        self.assertEqual([len(z) for z in res], [2]*10)
+
+    def test_error_status_results_are_written(self):
+        def poll_request(job):
+            if job[0] == 'status':
+                return 7 if job[1] == 1 else 2
+            return [{'msm_id': job[1], 'prb_id': 101, 'timestamp': 1500000000}]
+
+        ripe_atlas.poll_request = poll_request
+        measro = Measro(running_msm_ids=[1, 2], probe_ids=[101], raw_file_path=self.tmp+'/raw.jsonl')
+        collector = Measro(measro=measro, timeout=100, spin_time=10)
+        done, res, errs = ripe_atlas.poll_results(collector)
+        self.assertTrue(done)
+        self.assertEqual(sorted(z['msm_id'] for z in read_jsonl(measro.raw_file_path)), [1, 2])
+        self.assertIsNone(res[0])
+        self.assertEqual(len(errs[0]['result']), 1)
+
+    def test_concurrent_polls(self):
+        calls = list()
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def poll_request(job):
+            with lock:
+                calls.append(job[:2])
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            if job[0] == 'status':
+                # even measurements are stopped; odd ones keep running without results
+                return 4 if job[1] % 2 == 0 else 2
+            return [{'msm_id': job[1], 'prb_id': 101, 'timestamp': 1500000000}] if job[1] % 2 == 0 else list()
+
+        ripe_atlas.poll_request = poll_request
+        measro = Measro(running_msm_ids=range(1, 21), probe_ids=[101, 102], raw_file_path=self.tmp+'/raw.jsonl')
+        collector = Measro(measro=measro, timeout=30, spin_time=10)
+        start = time.time()
+        done, res, errs = ripe_atlas.poll_results(collector)
+        # 40 calls, made concurrently rather than one after the other
+        self.assertLess(time.time() - start, 1.0)
+        self.assertGreater(active[1], 1)
+        self.assertFalse(done)
+        # stopped measurements aren't polled again; the others are until they run out of attempts
+        del calls[:]
+        for expected in (False, True):
+            done, res, errs = ripe_atlas.poll_results(collector)
+            self.assertEqual(done, expected)
+        self.assertEqual(sorted(set(z[1] for z in calls)), range(1, 21, 2))
+        # no status check on the last attempt
+        self.assertEqual(len([z for z in calls if z[0] == 'status']), 10)
+        self.assertEqual([len(z) for z in res], [0, 1]*10)
+
+    def poll(self, answers, **kwargs):
+        """
+        :param answers: (list) results returned for each successive results request
+        :return: (list, list) the results jobs that were made, then the results poll_results returned
+        """
+        jobs = list()
+
+        def poll_request(job):
+            if job[0] == 'status':
+                return 2
+            jobs.append(job)
+            return answers.pop(0)
+
+        ripe_atlas.poll_request = poll_request
+        measro = Measro(running_msm_ids=[1], probe_ids=[101, 102, 103], raw_file_path=self.tmp+'/raw.jsonl',
+                        **kwargs)
+        collector = Measro(measro=measro, timeout=100, spin_time=10)
+        while len(answers) > 0:
+            done, res, errs = ripe_atlas.poll_results(collector)
+        return jobs, res[0]
+
+    def test_oneoff_only_asks_for_missing_probes(self):
+        answers = [[{'msm_id': 1, 'prb_id': 101, 'timestamp': 10}, {'msm_id': 1, 'prb_id': 102, 'timestamp': 10},
+                    {'msm_id': 1, 'prb_id': 101, 'timestamp': 10}],
+                   [{'msm_id': 1, 'prb_id': 101, 'timestamp': 10}, {'msm_id': 1, 'prb_id': 103, 'timestamp': 11}]]
+        jobs, res = self.poll(answers)
+        self.assertEqual([z[2:] for z in jobs], [([101, 102, 103], None), ([103], None)])
+        self.assertEqual(sorted(z['prb_id'] for z in res), [101, 102, 103])
+        self.assertEqual(len(list(read_jsonl(self.tmp+'/raw.jsonl'))), 3)
+
+    def test_recurring_asks_for_newer_results(self):
+        answers = [[{'msm_id': 1, 'prb_id': 101, 'timestamp': 10}, {'msm_id': 1, 'prb_id': 102, 'timestamp': 20}],
+                   [{'msm_id': 1, 'prb_id': 102, 'timestamp': 20}, {'msm_id': 1, 'prb_id': 101, 'timestamp': 30}],
+                   list()]
+        jobs, res = self.poll(answers, is_oneoff=False)
+        self.assertEqual([z[3] for z in jobs], [None, 20, 30])
+        self.assertEqual(sorted((z['prb_id'], z['timestamp']) for z in res), [(101, 10), (101, 30), (102, 20)])
+
+    def test_resumes_from_raw_file(self):
+        sink = JsonLinesSink(self.tmp+'/raw.jsonl')
+        sink.append([{'msm_id': 1, 'prb_id': 102, 'timestamp': 10}, {'msm_id': 2, 'prb_id': 101, 'timestamp': 10}])
+        sink.close()
+        jobs, res = self.poll([[{'msm_id': 1, 'prb_id': 101, 'timestamp': 10}]])
+        self.assertEqual([z[2] for z in jobs], [[101, 103]])
+        self.assertEqual(sorted(z['prb_id'] for z in res), [101, 102])
+
+
+if __name__ == '__main__':
+    unittest.main()